@@ -637,6 +637,9 @@ document.addEventListener("DOMContentLoaded", async () => {
                 requestBody.mode = 'normal';
             }
             
+            // Ask for a token stream so the answer shows up while it is being generated
+            requestBody.stream = true;
+            
             const response = await fetch('http://localhost:5001/api/chat', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
@@ -645,25 +648,26 @@ document.addEventListener("DOMContentLoaded", async () => {
 
             if (!response.ok) throw new Error(`HTTP error! status: ${response.status}`);
 
-            const data = await response.json();
+            let streamedText = '';
+            const data = await readChatStream(response, (token) => {
+                streamedText += token;
+                thinkingMessageElement.innerHTML = streamedText.replace(/\n/g, '<br>');
+                chatHistory.scrollTop = chatHistory.scrollHeight;
+            });
             const aiResponse = data.response;
             const dishName = data.dish_name;
             
-            thinkingMessageElement.style.opacity = '0';
-            setTimeout(() => {
-                thinkingMessageElement.innerHTML = aiResponse.replace(/\n/g, '<br>');
-                thinkingMessageElement.style.opacity = '1';
-                
-                // Only show shopping list button in normal mode
-                if (!isDarkMode && !aiResponse.includes('?')) {
-                    addShoppingListButton(thinkingMessageElement, aiResponse, dishName);
-                }
-                
-                // In dark mode, if a recipe was generated, show scanned ingredients used
-                if (isDarkMode && scannedIngredients.length > 0) {
-                    showUsedIngredientsInfo(thinkingMessageElement);
-                }
-            }, 300);
+            thinkingMessageElement.innerHTML = aiResponse.replace(/\n/g, '<br>');
+            
+            // Only show shopping list button in normal mode
+            if (!isDarkMode && !aiResponse.includes('?')) {
+                addShoppingListButton(thinkingMessageElement, aiResponse, dishName);
+            }
+            
+            // In dark mode, if a recipe was generated, show scanned ingredients used
+            if (isDarkMode && scannedIngredients.length > 0) {
+                showUsedIngredientsInfo(thinkingMessageElement);
+            }
 
         } catch (error) {
             console.error("Error fetching AI response:", error);
@@ -676,6 +680,36 @@ document.addEventListener("DOMContentLoaded", async () => {
         }
     }
 
+    // Reads the backend's NDJSON chat stream: "token" events as Ollama generates, then one "done" event
+    async function readChatStream(response, onToken) {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffered = '';
+        
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            
+            buffered += decoder.decode(value, { stream: true });
+            const lines = buffered.split('\n');
+            buffered = lines.pop();
+            
+            for (const line of lines) {
+                if (!line.trim()) continue;
+                const event = JSON.parse(line);
+                if (event.type === 'token') {
+                    onToken(event.token);
+                } else if (event.type === 'done') {
+                    return event;
+                } else if (event.type === 'error') {
+                    throw new Error(event.error);
+                }
+            }
+        }
+        
+        throw new Error('Chat stream ended before the response was complete');
+    }
+
     function showUsedIngredientsInfo(messageElement) {
         const ingredientsInfo = document.createElement('div');
         ingredientsInfo.classList.add('used-ingredients-info');
@@ -0,0 +1,601 @@
+"""ASGI entry point for the backend, for serving many concurrent chat and barcode requests.
+
+    uvicorn asgi:app --port 5001
+
+/api/chat, /api/recipe-cart and /api/barcode-lookup run as async handlers that talk to
+Ollama and the UPC sites through one shared aiohttp.ClientSession, so a request that is
+only waiting on them holds no thread. Chats go through the Ollama admission queue in
+backend.py and share generations with identical chats. Every other route, including the
+CPU-bound product matching behind /api/shopping-list, is handed to the Flask app in
+backend.py on a worker thread pool.
+"""
+import asyncio
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import aiohttp
+import requests
+
+import backend
+
+# Threads running Flask routes and HTML parsing, i.e. how much CPU-bound work runs at once
+ASGI_WORKER_THREADS = int(os.environ.get('ASGI_WORKER_THREADS', '8'))
+
+# Connections the async client opens at once to Ollama and the UPC sites; further requests wait for one
+ASGI_HTTP_CONNECTIONS = int(os.environ.get('ASGI_HTTP_CONNECTIONS', '512'))
+
+worker_executor = ThreadPoolExecutor(max_workers=ASGI_WORKER_THREADS, thread_name_prefix='asgi-worker')
+
+# Created on the server's event loop at startup and closed at shutdown
+http_client = None
+
+# UPC -> Task resolving it, so concurrent scans of one code share a single scrape
+barcode_lookups_in_flight = {}
+
+def create_http_client():
+    """Async counterpart of backend.create_http_session, pooling keep-alive connections."""
+    return aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=ASGI_HTTP_CONNECTIONS))
+
+def get_http_client():
+    global http_client
+    if http_client is None:
+        http_client = create_http_client()
+    return http_client
+
+def client_timeout(timeout):
+    """Convert a requests-style (connect, read) timeout."""
+    connect, read = timeout
+    return aiohttp.ClientTimeout(sock_connect=connect, sock_read=read)
+
+async def run_in_worker(function, *args):
+    """Run blocking or CPU-bound work on the worker pool without stalling the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(worker_executor, function, *args)
+
+async def read_body(receive):
+    body = bytearray()
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return bytes(body)
+
+async def send_json(send, data, status=200):
+    body = json.dumps(data).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status, 'headers': [
+        (b'content-type', b'application/json'),
+        (b'content-length', str(len(body)).encode('latin-1')),
+        (b'access-control-allow-origin', b'*')
+    ]})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def send_stream(send, chunks, content_type):
+    """Send each text chunk of an async iterator as soon as it is produced."""
+    await send({'type': 'http.response.start', 'status': 200, 'headers': [
+        (b'content-type', content_type.encode('latin-1')),
+        (b'access-control-allow-origin', b'*')
+    ]})
+    async for chunk in chunks:
+        await send({'type': 'http.response.body', 'body': chunk.encode('utf-8'), 'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+async def iterate(chunks):
+    """Wrap an ordinary iterable of text chunks for send_stream."""
+    for chunk in chunks:
+        yield chunk
+
+async def wait_for_disconnect(receive):
+    """Return once the client has gone away. Call it only after the request body has been read."""
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+async def cancel_on_disconnect(receive, coroutine):
+    """Run coroutine, cancelling it if the client disconnects first; its finally blocks still run."""
+    task = asyncio.ensure_future(coroutine)
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        await asyncio.wait({task, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        disconnected.cancel()
+        task.cancel()
+        await asyncio.wait({task})
+    if not task.cancelled():
+        task.result()
+
+# Generations streaming from Ollama on the event loop, referenced until they finish
+generation_tasks = set()
+
+def generate_on(loop):
+    """A runner for backend.join_ollama_generation that streams the generation on loop.
+
+    The scheduler calls it from whichever thread or task frees a slot."""
+    def run(generation, payload):
+        loop.call_soon_threadsafe(start_generation_task, generation, payload)
+    return run
+
+def start_generation_task(generation, payload):
+    task = asyncio.ensure_future(run_ollama_generation(generation, payload))
+    generation_tasks.add(task)
+    task.add_done_callback(generation_tasks.discard)
+    loop = asyncio.get_running_loop()
+    generation.interrupt = lambda: loop.call_soon_threadsafe(task.cancel)
+
+async def run_ollama_generation(generation, payload):
+    """Async version of backend.run_ollama_generation, streaming from Ollama through the shared aiohttp session."""
+    error = None
+    try:
+        if generation.cancelled:
+            return
+        async with get_http_client().post(backend.OLLAMA_API_URL, json={**payload, 'stream': True}, timeout=client_timeout(backend.OLLAMA_TIMEOUT)) as response:
+            if response.status != 200:
+                backend.logger.error("Ollama answered with status %s", response.status)
+                return
+            generation.start()
+            async for line in response.content:
+                if not line.strip():
+                    continue
+                token, done = backend.parse_ollama_chunk(line)
+                if token:
+                    generation.append(token)
+                if done:
+                    break
+        backend.cache_chat_response(generation.cache_key, ''.join(generation.tokens).strip())
+    except asyncio.CancelledError:
+        # Nobody follows the generation any more; closing the response makes Ollama stop generating
+        pass
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        backend.logger.warning("Ollama generation failed: %s", e)
+        # Followers, including recipe carts matching on worker threads, handle the errors of backend's client
+        error = requests.ConnectionError(f"Ollama request failed: {e}")
+    except Exception as e:
+        backend.logger.warning("Ollama generation failed: %s", e)
+        error = e
+    finally:
+        backend.generation_scheduler.release()
+        backend.end_ollama_generation(generation, error)
+
+class GenerationWatcher:
+    """Wakes a coroutine whenever a backend.OllamaGeneration changes, instead of blocking a thread on it."""
+
+    def __init__(self, generation):
+        self.generation = generation
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+
+    def __enter__(self):
+        self.generation.add_listener(self._notify)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.generation.remove_listener(self._notify)
+
+    async def wait_for(self, predicate, timeout=None):
+        """Wait until predicate() holds; False if timeout seconds pass first."""
+        deadline = None if timeout is None else self._loop.time() + timeout
+        while True:
+            self._changed.clear()
+            if predicate():
+                return True
+            if deadline is None:
+                await self._changed.wait()
+                continue
+            try:
+                await asyncio.wait_for(self._changed.wait(), deadline - self._loop.time())
+            except asyncio.TimeoutError:
+                return predicate()
+
+    def _notify(self):
+        # Called on the thread that changed the generation
+        try:
+            self._loop.call_soon_threadsafe(self._changed.set)
+        except RuntimeError:
+            pass  # the event loop has closed
+
+async def wait_generation_started(generation):
+    """Async version of backend.wait_for_ollama_generation."""
+    try:
+        with GenerationWatcher(generation) as watcher:
+            while not await watcher.wait_for(lambda: generation.started or generation.finished, generation.queue_time_left()):
+                backend.expire_ollama_generation(generation)
+        if not generation.started and generation.error is not None:
+            raise generation.error
+    except BaseException:
+        backend.leave_ollama_generation(generation)
+        raise
+    if not generation.started:
+        backend.leave_ollama_generation(generation)
+    return generation.started
+
+async def follow_generation(generation):
+    """Async version of backend.follow_ollama_generation."""
+    sent = 0
+    try:
+        with GenerationWatcher(generation) as watcher:
+            while True:
+                await watcher.wait_for(lambda: len(generation.tokens) > sent or generation.finished)
+                # Tokens are appended before the generation finishes, so none can be missed after this check
+                finished = generation.finished
+                tokens = generation.tokens[sent:]
+                for token in tokens:
+                    yield token
+                sent += len(tokens)
+                if finished:
+                    break
+        if generation.error is not None:
+            raise generation.error
+    finally:
+        backend.leave_ollama_generation(generation)
+
+async def stream_chat_events(tokens, metadata):
+    """Async version of backend.stream_chat_events."""
+    collected = []
+    try:
+        async for token in tokens:
+            collected.append(token)
+            yield json.dumps({'type': 'token', 'token': token}) + '\n'
+    except (requests.RequestException, ValueError) as e:
+        backend.logger.warning("Ollama stream error: %s", e)
+        yield json.dumps({'type': 'error', 'error': 'Ollama stopped responding mid-generation'}) + '\n'
+        return
+
+    response = ''.join(collected).strip()
+    yield json.dumps({'type': 'done', 'response': response, 'cached': False, **metadata}) + '\n'
+
+async def recipe_cart_events(tokens, metadata, cached=False):
+    """Async version of backend.recipe_cart_events; ingredients are matched on the worker pool."""
+    cart = backend.RecipeCartStream(metadata, cached)
+    try:
+        async for token in tokens:
+            for event in await run_in_worker(list, cart.add_token(token)):
+                yield event
+    except (requests.RequestException, ValueError) as e:
+        backend.logger.warning("Ollama stream error: %s", e)
+        yield json.dumps({'type': 'error', 'error': 'Ollama stopped responding mid-generation'}) + '\n'
+        return
+    for event in await run_in_worker(list, cart.finish()):
+        yield event
+
+async def answer_chat(send, payload, metadata, cache_key):
+    # Identical chats in flight share one generation, like in backend.chat
+    generation = backend.join_ollama_generation(payload, metadata['mode'], cache_key, run=generate_on(asyncio.get_running_loop()))
+    with backend.timed_stage('ollama_first_chunk'):
+        started = await wait_generation_started(generation)
+    if not started:
+        await send_json(send, {'error': 'Failed to get response from Ollama'}, 500)
+        return
+
+    tokens = follow_generation(generation)
+    try:
+        if payload['stream']:
+            await send_stream(send, stream_chat_events(tokens, metadata), 'application/x-ndjson')
+            return
+
+        with backend.timed_stage('ollama'):
+            ai_response = ''.join([token async for token in tokens]).strip()
+    finally:
+        # Leave the generation now rather than whenever the abandoned generator is collected
+        await tokens.aclose()
+    await send_json(send, {'response': ai_response, 'cached': False, **metadata})
+
+async def chat(scope, receive, send):
+    try:
+        prepared = backend.prepare_chat(json.loads(await read_body(receive)))
+        if prepared is None:
+            await send_json(send, {'error': 'Prompt is required'}, 400)
+            return
+        payload, metadata, cache_key = prepared
+
+        with backend.timed_stage('chat_cache'):
+            cached = backend.get_cached_chat(cache_key)
+        if cached is not None:
+            if payload['stream']:
+                await send_stream(send, iterate(backend.cached_chat_events(cached, metadata)), 'application/x-ndjson')
+            else:
+                await send_json(send, {'response': cached, 'cached': True, **metadata})
+            return
+
+        # A client that hangs up stops following the generation, which is cancelled once nobody follows it
+        await cancel_on_disconnect(receive, answer_chat(send, payload, metadata, cache_key))
+
+    except backend.GenerationRejected as e:
+        await send_json(send, {'error': str(e)}, e.status)
+    except requests.RequestException as e:
+        backend.logger.error("Ollama request error: %s", e)
+        await send_json(send, {'error': 'Failed to connect to Ollama. Make sure it\'s running.'}, 500)
+    except Exception as e:
+        backend.logger.error("Chat error: %s", e)
+        await send_json(send, {'error': f'Chat failed: {str(e)}'}, 500)
+
+async def answer_recipe_cart(send, payload, metadata, cache_key):
+    generation = backend.join_ollama_generation(payload, metadata['mode'], cache_key, run=generate_on(asyncio.get_running_loop()))
+    with backend.timed_stage('ollama_first_chunk'):
+        started = await wait_generation_started(generation)
+    if not started:
+        await send_json(send, {'error': 'Failed to get response from Ollama'}, 500)
+        return
+    tokens = follow_generation(generation)
+    try:
+        await send_stream(send, recipe_cart_events(tokens, metadata), 'application/x-ndjson')
+    finally:
+        await tokens.aclose()
+
+async def recipe_cart(scope, receive, send):
+    """Async front of backend.recipe_cart: the wait for Ollama holds no thread, matching runs on the worker pool."""
+    try:
+        body = await read_body(receive)
+        try:
+            data = json.loads(body) if body else {}
+        except ValueError:
+            data = {}
+        prepared = backend.prepare_chat({**data, 'mode': 'normal', 'stream': True})
+        if prepared is None:
+            await send_json(send, {'error': 'Prompt is required'}, 400)
+            return
+        payload, metadata, cache_key = prepared
+
+        with backend.timed_stage('chat_cache'):
+            cached = backend.get_cached_chat(cache_key)
+        if cached is not None:
+            await send_stream(send, recipe_cart_events(iterate([cached]), metadata, cached=True), 'application/x-ndjson')
+            return
+
+        await cancel_on_disconnect(receive, answer_recipe_cart(send, payload, metadata, cache_key))
+
+    except backend.GenerationRejected as e:
+        await send_json(send, {'error': str(e)}, e.status)
+    except requests.RequestException as e:
+        backend.logger.error("Ollama request error: %s", e)
+        await send_json(send, {'error': 'Failed to connect to Ollama. Make sure it\'s running.'}, 500)
+    except Exception as e:
+        backend.logger.error("Recipe cart error: %s", e)
+        await send_json(send, {'error': f'Recipe cart failed: {str(e)}'}, 500)
+
+async def scrape_go_upc(upc_code):
+    """Async version of backend.scrape_go_upc; the page is parsed on the worker pool."""
+    try:
+        url = backend.GO_UPC_SEARCH_URL.format(upc=upc_code)
+        backend.logger.debug("Requesting URL: %s", url)
+        async with get_http_client().get(url, headers=backend.GO_UPC_HEADERS, timeout=client_timeout(backend.GO_UPC_TIMEOUT)) as response:
+            backend.logger.debug("Response status: %s", response.status)
+            content = await response.read()
+
+        if response.status == 200:
+            return await run_in_worker(backend.extract_go_upc_product_name, content)
+        backend.logger.info("Request failed with status: %s", response.status)
+        return 'N/A'
+
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        backend.logger.warning("Request error: %s", e)
+        return 'N/A'
+    except Exception as e:
+        backend.logger.warning("Scraping error: %s", e)
+        return 'N/A'
+
+async def scrape_upcitemdb(upc_code):
+    """Async version of backend.scrape_upcitemdb."""
+    try:
+        url = backend.UPCITEMDB_LOOKUP_URL.format(upc=upc_code)
+        backend.logger.debug("Trying UPCItemDB API: %s", url)
+        async with get_http_client().get(url, headers=backend.UPCITEMDB_HEADERS, timeout=client_timeout(backend.UPCITEMDB_TIMEOUT)) as response:
+            data = await response.json(content_type=None) if response.status == 200 else None
+
+        if data is not None:
+            product_name = backend.extract_upcitemdb_product_name(data)
+            if product_name:
+                return product_name
+
+        backend.logger.info("UPCItemDB lookup failed")
+        return 'N/A'
+
+    except Exception as e:
+        backend.logger.warning("UPCItemDB error: %s", e)
+        return 'N/A'
+
+# Built-in scrapers with an async version; other registered providers run on the provider thread pool
+ASYNC_SCRAPERS = {
+    backend.scrape_go_upc: scrape_go_upc,
+    backend.scrape_upcitemdb: scrape_upcitemdb
+}
+
+def async_provider(name, lookup):
+    """Timed async lookup for a registered provider."""
+    scraper = ASYNC_SCRAPERS.get(lookup)
+
+    async def timed_lookup(upc_code):
+        with backend.timed_stage(f'upc_{name}'):
+            if scraper is not None:
+                return await scraper(upc_code)
+            return await asyncio.get_running_loop().run_in_executor(backend.barcode_provider_executor, lookup, upc_code)
+    return timed_lookup
+
+async def race_barcode_providers(upc_code, providers):
+    """Async version of backend.race_barcode_providers; losing requests are cancelled."""
+    tasks = {asyncio.ensure_future(lookup(upc_code)): name for name, lookup in providers}
+    pending = set(tasks)
+    deadline = asyncio.get_running_loop().time() + backend.BARCODE_LOOKUP_TIMEOUT
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=deadline - asyncio.get_running_loop().time(), return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                backend.logger.warning("No provider answered UPC %s within %ss", upc_code, backend.BARCODE_LOOKUP_TIMEOUT)
+                break
+            for task in done:
+                try:
+                    product_name = task.result()
+                except Exception as e:
+                    backend.logger.warning("Provider %s failed: %s", tasks[task], e)
+                    continue
+                if backend.is_product_name(product_name):
+                    return product_name, tasks[task]
+                backend.logger.debug("Provider %s has no product for UPC %s", tasks[task], upc_code)
+    finally:
+        for task in tasks:
+            task.cancel()
+    return None, None
+
+async def scrape_product_name(upc_code):
+    """Async version of backend.scrape_product_name."""
+    providers = [(name, async_provider(name, lookup)) for name, lookup in backend.barcode_providers]
+    product_name, source = None, None
+    if backend.BARCODE_LOOKUP_MODE == 'sequential':
+        for name, lookup in providers:
+            backend.logger.debug("Trying lookup provider %s...", name)
+            found = await lookup(upc_code)
+            if backend.is_product_name(found):
+                product_name, source = found, name
+                break
+    else:
+        product_name, source = await race_barcode_providers(upc_code, providers)
+    return backend.settle_provider_result(upc_code, product_name, source)
+
+async def resolve_product_name(upc_code):
+    try:
+        product_name, source = await scrape_product_name(upc_code)
+        backend.cache_barcode_result(upc_code, product_name, source)
+        return product_name, source
+    finally:
+        barcode_lookups_in_flight.pop(upc_code, None)
+
+async def lookup_product_name(upc_code):
+    """Async version of backend.lookup_product_name, returning (product_name, source, cached)."""
+    # Local SQLite reads are quick enough to run on the event loop
+    if backend.barcode_cache is not None:
+        cached = backend.barcode_cache.get(upc_code)
+        if cached is not None:
+            return cached[0], cached[1], True
+
+    lookup = barcode_lookups_in_flight.get(upc_code)
+    if lookup is None:
+        lookup = barcode_lookups_in_flight[upc_code] = asyncio.ensure_future(resolve_product_name(upc_code))
+    else:
+        backend.logger.debug("Joining in-flight lookup for UPC %s", upc_code)
+
+    # A client hanging up must not cancel the scrape other scans are waiting on
+    product_name, source = await asyncio.shield(lookup)
+    return product_name, source, False
+
+async def barcode_lookup(scope, receive, send):
+    try:
+        data = json.loads(await read_body(receive))
+        upc_code = data.get('upc', '').strip()
+
+        if not upc_code:
+            await send_json(send, {'error': 'UPC code is required'}, 400)
+            return
+
+        backend.logger.debug("Looking up UPC: %s", upc_code)
+
+        product_name, source, cached = await lookup_product_name(upc_code)
+        await send_json(send, backend.barcode_lookup_result(upc_code, product_name, source, cached))
+
+    except Exception as e:
+        backend.logger.error("Barcode lookup failed: %s", e)
+        await send_json(send, {'error': f'Lookup failed: {str(e)}'}, 500)
+
+ASYNC_ROUTES = {
+    ('POST', '/api/chat'): chat,
+    ('POST', '/api/recipe-cart'): recipe_cart,
+    ('POST', '/api/barcode-lookup'): barcode_lookup
+}
+
+async def serve_instrumented(handler, scope, receive, send):
+    """Run an async route with the request metrics and opt-in Server-Timing header the Flask routes get."""
+    wants_profile = any(name == backend.PROFILE_HEADER.lower().encode('latin-1') for name, value in scope['headers'])
+    profile = backend.new_request_profile() if wants_profile else None
+    token = backend.request_profile.set(profile)
+    started = time.perf_counter()
+
+    async def send_instrumented(message):
+        if message['type'] == 'http.response.start':
+            elapsed = time.perf_counter() - started
+            backend.record_request(scope['path'], message['status'], elapsed, profile)
+            if profile is not None:
+                message = {**message, 'headers': list(message['headers']) + [
+                    (b'server-timing', backend.format_server_timing(profile, elapsed).encode('latin-1')),
+                    (b'access-control-expose-headers', b'Server-Timing')
+                ]}
+        await send(message)
+
+    try:
+        await handler(scope, receive, send_instrumented)
+    finally:
+        backend.request_profile.reset(token)
+
+def build_wsgi_environ(scope, body):
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': '',
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False
+    }
+    for name, value in scope['headers']:
+        name, value = name.decode('latin-1'), value.decode('latin-1')
+        if name == 'content-type':
+            environ['CONTENT_TYPE'] = value
+        elif name != 'content-length':
+            key = 'HTTP_' + name.upper().replace('-', '_')
+            environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+async def call_flask(scope, receive, send):
+    """Serve a request with the Flask app on the worker pool, relaying its (possibly streamed) response."""
+    environ = build_wsgi_environ(scope, await read_body(receive))
+    response_start = {}
+
+    def start_response(status, headers, exc_info=None):
+        response_start['status'] = int(status.split(' ', 1)[0])
+        response_start['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+        return lambda data: None
+
+    body = await run_in_worker(backend.app, environ, start_response)
+    chunks = iter(body)
+    try:
+        await send({'type': 'http.response.start', **response_start})
+        while True:
+            chunk = await run_in_worker(next, chunks, None)
+            if chunk is None:
+                break
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+    finally:
+        if hasattr(body, 'close'):
+            await run_in_worker(body.close)
+
+async def lifespan(receive, send):
+    global http_client
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            http_client = create_http_client()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if http_client is not None:
+                await http_client.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    elif scope['type'] == 'http':
+        handler = ASYNC_ROUTES.get((scope['method'], scope['path']))
+        if handler is None:
+            await call_flask(scope, receive, send)
+        else:
+            await serve_instrumented(handler, scope, receive, send)
@@ -1,253 +1,2006 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response
 from flask_cors import CORS
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import csv
 import re
 from difflib import SequenceMatcher
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from functools import lru_cache
 import os
 import sys
 import json
 import hashlib
+import hmac
 import string
+import pickle
+import queue
+import gc
+import threading
+import sqlite3
+import time
+import heapq
+import io
+import itertools
+import multiprocessing
+import logging
+import contextvars
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from array import array
+from bisect import bisect_left, insort
 from urllib.parse import quote_plus
-from bs4 import BeautifulSoup
+from html.parser import HTMLParser
+from bs4 import BeautifulSoup, UnicodeDammit
+from bs4.builder import HTMLTreeBuilder
+from bs4.dammit import EntitySubstitution
+
+try:
+    import numpy as np
+except ImportError:  # The vectorized match engine is optional
+    np = None
+
+try:
+    import resource
+except ImportError:  # Windows; reload memory is then not reported
+    resource = None
 
 app = Flask(__name__)
-CORS(app)
+# Any origin may call the public API; the admin endpoints are left out, so browsers keep them same-origin
+CORS(app, resources={r'/api/(?!admin/).*': {'origins': '*'}})
+
+# LOG_LEVEL=DEBUG traces every catalog load step, chat prompt and UPC scrape
+logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'INFO').upper(), format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger('cooker')
 
 OLLAMA_API_URL = "http://localhost:11434/api/generate"
 
-# Global variable to store grocery data
-grocery_data = []
+# Outbound HTTP: (connect, read) timeouts in seconds, keep-alive connections per host and retries
+OLLAMA_TIMEOUT = (float(os.environ.get('OLLAMA_CONNECT_TIMEOUT', '5')), float(os.environ.get('OLLAMA_READ_TIMEOUT', '300')))
+GO_UPC_TIMEOUT = (float(os.environ.get('UPC_CONNECT_TIMEOUT', '5')), float(os.environ.get('GO_UPC_READ_TIMEOUT', '15')))
+UPCITEMDB_TIMEOUT = (float(os.environ.get('UPC_CONNECT_TIMEOUT', '5')), float(os.environ.get('UPCITEMDB_READ_TIMEOUT', '10')))
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '10'))
+HTTP_MAX_RETRIES = int(os.environ.get('HTTP_MAX_RETRIES', '2'))
+
+# Persistent UPC -> product name cache; unresolved UPCs are remembered for a much shorter time
+BARCODE_CACHE_PATH = os.environ.get('BARCODE_CACHE_PATH', 'barcode_cache.sqlite3')
+BARCODE_CACHE_TTL = int(os.environ.get('BARCODE_CACHE_TTL', str(30 * 24 * 3600)))
+BARCODE_NEGATIVE_TTL = int(os.environ.get('BARCODE_NEGATIVE_TTL', '600'))
+
+# Persistent cache of normal-mode chat answers: lifetime in seconds and most answers kept (0 disables it)
+CHAT_CACHE_PATH = os.environ.get('CHAT_CACHE_PATH', 'chat_cache.sqlite3')
+CHAT_CACHE_TTL = int(os.environ.get('CHAT_CACHE_TTL', str(7 * 24 * 3600)))
+CHAT_CACHE_MAX_ENTRIES = int(os.environ.get('CHAT_CACHE_MAX_ENTRIES', '5000'))
+
+# Opt-in greedy, seeded sampling for normal-mode chats, so a cached ingredient list is the one Ollama would generate again
+CHAT_DETERMINISTIC = os.environ.get('CHAT_DETERMINISTIC', '0') == '1'
+CHAT_DETERMINISTIC_OPTIONS = {'temperature': 0, 'top_k': 1, 'seed': 42}
+
+# Ollama generations run at once; more wait in a queue of at most OLLAMA_MAX_QUEUE (beyond it: 429) for up to
+# OLLAMA_QUEUE_TIMEOUT seconds (then: 503), normal-mode ingredient lists ahead of recipes
+OLLAMA_MAX_CONCURRENCY = int(os.environ.get('OLLAMA_MAX_CONCURRENCY', '2'))
+OLLAMA_MAX_QUEUE = int(os.environ.get('OLLAMA_MAX_QUEUE', '32'))
+OLLAMA_QUEUE_TIMEOUT = float(os.environ.get('OLLAMA_QUEUE_TIMEOUT', '60'))
+
+# UPC lookup services; 'concurrent' queries all providers at once and keeps the first name found
+GO_UPC_SEARCH_URL = os.environ.get('GO_UPC_SEARCH_URL', 'https://go-upc.com/search?q={upc}')
+UPCITEMDB_LOOKUP_URL = os.environ.get('UPCITEMDB_LOOKUP_URL', 'https://api.upcitemdb.com/prod/trial/lookup?upc={upc}')
+BARCODE_LOOKUP_MODE = os.environ.get('BARCODE_LOOKUP_MODE', 'concurrent')
+BARCODE_LOOKUP_TIMEOUT = float(os.environ.get('BARCODE_LOOKUP_TIMEOUT', '20'))
+BARCODE_PROVIDER_WORKERS = int(os.environ.get('BARCODE_PROVIDER_WORKERS', '8'))
+
+CSV_FILE_PATH = 'WMT_Grocery_202209.csv'
+
+# Product scorer: 'python' (default), 'numpy' (vectorized, needs numpy installed) or 'sharded' (parallel worker processes)
+MATCH_ENGINE = os.environ.get('MATCH_ENGINE', 'python')
+
+# Catalog shards, one worker process each, for the 'sharded' engine
+MATCH_SHARDS = int(os.environ.get('MATCH_SHARDS', str(os.cpu_count() or 1)))
+
+# Number of ingredient rankings kept in the match cache (0 disables it)
+MATCH_CACHE_SIZE = int(os.environ.get('MATCH_CACHE_SIZE', '1024'))
+
+# Compiled copy of the CSV plus its match features and index, rebuilt whenever the CSV changes
+CATALOG_SNAPSHOT_PATH = 'WMT_Grocery_202209.snapshot'
+CATALOG_SNAPSHOT_VERSION = 2
+
+# Streaming CSV parse: rows per chunk, worker processes parsing chunks (1 parses in-process) and the largest
+# field accepted, in characters; a row longer than all 16 WMT columns at that limit is rejected unread
+CSV_CHUNK_ROWS = int(os.environ.get('CSV_CHUNK_ROWS', '10000'))
+CSV_PARSE_WORKERS = int(os.environ.get('CSV_PARSE_WORKERS', '1'))
+CSV_FIELD_SIZE_LIMIT = int(os.environ.get('CSV_FIELD_SIZE_LIMIT', str(128 * 1024)))
+CSV_LINE_SIZE_LIMIT = 16 * CSV_FIELD_SIZE_LIMIT
+
+# Seconds between checks of the CSV for changes that trigger a hot reload (0 disables the watcher)
+CATALOG_WATCH_INTERVAL = float(os.environ.get('CATALOG_WATCH_INTERVAL', '0'))
+
+# Most dishes accepted by one /api/meal-plan request
+MEAL_PLAN_MAX_DISHES = int(os.environ.get('MEAL_PLAN_MAX_DISHES', '50'))
+
+# Value /api/admin endpoints require in the X-Admin-Token header; while unset they refuse every request
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+def create_http_session(pool_size=HTTP_POOL_SIZE, max_retries=HTTP_MAX_RETRIES, retry_reads=True):
+    """Create a requests session that keeps up to pool_size connections alive per host and retries with backoff.
+
+    Connection failures are always retried. With retry_reads, so are read errors and 429/5xx
+    answers to GET requests; without it a request that reached the server is never sent twice."""
+    retry = Retry(
+        total=max_retries,
+        connect=max_retries,
+        read=max_retries if retry_reads else 0,
+        status=max_retries if retry_reads else 0,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({'GET', 'HEAD'}),
+        backoff_factor=0.3,
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+# Shared sessions so repeated calls reuse TCP/TLS connections; a generation is never resubmitted
+ollama_session = create_http_session(retry_reads=False)
+upc_session = create_http_session()
+
+class LRUCache:
+    """Bounded, thread-safe least-recently-used cache with hit/miss counters."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the cached value for key (marking it recently used), or None."""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Store a value, evicting the least recently used entries beyond max_size."""
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """Drop every entry; the hit/miss counters keep counting."""
+        with self._lock:
+            self._entries.clear()
+
+    def rekey(self, new_key):
+        """Replace every key by new_key(key), dropping the entries it returns None for; recency order is kept."""
+        with self._lock:
+            entries = ((new_key(key), value) for key, value in self._entries.items())
+            self._entries = OrderedDict((key, value) for key, value in entries if key is not None)
+
+    def stats(self):
+        """Current size, capacity and hit/miss counters."""
+        with self._lock:
+            return {'size': len(self._entries), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses}
+
+# Histogram buckets for stage timings (seconds) and per-request candidate counts
+TIMING_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+CANDIDATE_BUCKETS = (0, 10, 100, 1000, 10000, 100000, 1000000)
+
+# Requests sending this header get their stage timings back in a Server-Timing response header
+PROFILE_HEADER = 'X-Cooker-Profile'
+
+class Metrics:
+    """Thread-safe counters and histograms, rendered in the Prometheus text exposition format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)
+        self._histograms = {}
+        self._help = {}
+
+    def describe(self, name, kind, help_text):
+        self._help[name] = (kind, help_text)
+
+    def inc(self, name, amount=1, **labels):
+        with self._lock:
+            self._counters[name, tuple(sorted(labels.items()))] += amount
+
+    def observe(self, name, value, buckets=TIMING_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram['counts'][i] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def render(self, gauges=()):
+        """Exposition text for every metric recorded so far plus the given (name, labels, value) gauges."""
+        samples = defaultdict(list)
+        with self._lock:
+            for (name, labels), value in self._counters.items():
+                samples[name].append((name, labels, value))
+            for (name, labels), histogram in self._histograms.items():
+                for bound, count in zip(histogram['buckets'], histogram['counts']):
+                    samples[name].append((name + '_bucket', labels + (('le', format_metric_value(bound)),), count))
+                samples[name].append((name + '_bucket', labels + (('le', '+Inf'),), histogram['count']))
+                samples[name].append((name + '_sum', labels, histogram['sum']))
+                samples[name].append((name + '_count', labels, histogram['count']))
+        for name, labels, value in gauges:
+            samples[name].append((name, tuple(sorted(labels.items())), value))
+
+        lines = []
+        for name in sorted(samples):
+            if name in self._help:
+                kind, help_text = self._help[name]
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+            for sample_name, labels, value in samples[name]:
+                label_text = ','.join(f'{key}="{escape_label_value(label)}"' for key, label in labels)
+                lines.append(f"{sample_name}{{{label_text}}} {format_metric_value(value)}" if label_text else f"{sample_name} {format_metric_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+def format_metric_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+metrics = Metrics()
+metrics.describe('cooker_stage_seconds', 'histogram', 'Time spent in each request stage.')
+metrics.describe('cooker_request_seconds', 'histogram', 'Request latency by endpoint, up to the response headers.')
+metrics.describe('cooker_requests_total', 'counter', 'Requests by endpoint and status code.')
+metrics.describe('cooker_candidates_scored_total', 'counter', 'Catalog products scored against an ingredient.')
+metrics.describe('cooker_request_candidates_scored', 'histogram', 'Catalog products scored per request.')
+metrics.describe('cooker_catalog_products', 'gauge', 'Products in the loaded catalog.')
+metrics.describe('cooker_catalog_index_words', 'gauge', 'Distinct words in the product-name index.')
+metrics.describe('cooker_catalog_version', 'gauge', 'Version of the loaded catalog, incremented by every reload.')
+metrics.describe('cooker_catalog_reloads_total', 'counter', 'Catalog reloads by outcome.')
+metrics.describe('cooker_catalog_reload_seconds', 'histogram', 'Time to build and swap in a catalog.')
+metrics.describe('cooker_catalog_reload_peak_rss_bytes', 'gauge', 'Peak resident memory during the last catalog reload.')
+metrics.describe('cooker_catalog_delta_rows_total', 'counter', 'Catalog delta rows by outcome.')
+metrics.describe('cooker_catalog_rows_rejected_total', 'counter', 'Malformed or oversized CSV rows skipped while loading the catalog.')
+metrics.describe('cooker_match_cache_entries', 'gauge', 'Ingredient rankings held in the match cache.')
+metrics.describe('cooker_match_cache_hits_total', 'counter', 'Match cache lookups that found a ranking.')
+metrics.describe('cooker_match_cache_misses_total', 'counter', 'Match cache lookups that had to score the catalog.')
+metrics.describe('cooker_chat_cache_entries', 'gauge', 'Chat answers held in the persistent chat cache.')
+metrics.describe('cooker_chat_cache_lookups_total', 'counter', 'Chat cache lookups by result.')
+metrics.describe('cooker_ollama_generations_running', 'gauge', 'Ollama generations holding a concurrency slot.')
+metrics.describe('cooker_ollama_queue_depth', 'gauge', 'Ollama generations waiting for a concurrency slot, by kind.')
+metrics.describe('cooker_ollama_queue_wait_seconds', 'histogram', 'Time an Ollama generation waited for a slot, by kind.')
+metrics.describe('cooker_ollama_rejections_total', 'counter', 'Ollama generations turned away, by kind and status code.')
+metrics.describe('cooker_ollama_coalesced_total', 'counter', 'Chat requests that joined an identical generation in flight.')
+metrics.describe('cooker_ollama_cancelled_total', 'counter', 'Ollama generations stopped or dequeued because every request following them left.')
+metrics.describe('cooker_barcode_provider_wins_total', 'counter', 'UPC lookups answered first by each provider.')
+
+# Stage timings and counts of the request being served, or None when it didn't ask for a profile
+request_profile = contextvars.ContextVar('request_profile', default=None)
+
+def new_request_profile():
+    return {'stages': defaultdict(float), 'candidates_scored': 0, 'catalog_products': None}
+
+@contextmanager
+def timed_stage(stage):
+    """Time a block into the stage histogram, and into the current request's profile if it has one."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        metrics.observe('cooker_stage_seconds', elapsed, stage=stage)
+        profile = request_profile.get()
+        if profile is not None:
+            profile['stages'][stage] += elapsed
+
+def record_candidates_scored(count, catalog):
+    metrics.inc('cooker_candidates_scored_total', count)
+    profile = request_profile.get()
+    if profile is not None:
+        profile['candidates_scored'] += count
+        profile['catalog_products'] = catalog.product_count()
+
+def format_server_timing(profile, total_seconds):
+    """Server-Timing header value: one entry per stage in milliseconds, then the catalog and candidate counts."""
+    entries = [f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in profile['stages'].items()]
+    entries.append(f"total;dur={total_seconds * 1000:.2f}")
+    entries.append(f'candidates_scored;desc="{profile["candidates_scored"]}"')
+    if profile['catalog_products'] is not None:
+        entries.append(f'catalog_products;desc="{profile["catalog_products"]}"')
+    return ', '.join(entries)
+
+def record_request(endpoint, status, elapsed, profile):
+    metrics.inc('cooker_requests_total', endpoint=endpoint, status=status)
+    metrics.observe('cooker_request_seconds', elapsed, endpoint=endpoint)
+    if profile is not None:
+        metrics.observe('cooker_request_candidates_scored', profile['candidates_scored'], buckets=CANDIDATE_BUCKETS, endpoint=endpoint)
+        logger.debug("%s %s in %.1f ms: %s", endpoint, status, elapsed * 1000, format_server_timing(profile, elapsed))
+
+@app.before_request
+def start_request_timer():
+    request.environ['cooker.started'] = time.perf_counter()
+    profile = new_request_profile() if request.headers.get(PROFILE_HEADER) else None
+    request.environ['cooker.profile'] = profile
+    request.environ['cooker.profile_token'] = request_profile.set(profile)
+
+@app.after_request
+def finish_request_timer(response):
+    started = request.environ.get('cooker.started')
+    if started is not None:
+        elapsed = time.perf_counter() - started
+        profile = request.environ.get('cooker.profile')
+        # The route pattern rather than the raw path keeps the endpoint label's cardinality bounded
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        record_request(endpoint, response.status_code, elapsed, profile)
+        if profile is not None:
+            response.headers['Server-Timing'] = format_server_timing(profile, elapsed)
+            response.headers['Access-Control-Expose-Headers'] = 'Server-Timing'
+    return response
+
+@app.teardown_request
+def reset_request_profile(exc=None):
+    token = request.environ.pop('cooker.profile_token', None)
+    if token is not None:
+        request_profile.reset(token)
+
+# Keys of a product, in the order its dict lists them
+# Entries per chunk of a copy-on-write column or posting list: a delta copies only the chunks it writes to
+CHUNK_SHIFT = 12
+CHUNK_SIZE = 1 << CHUNK_SHIFT
+CHUNK_MASK = CHUNK_SIZE - 1
+# Keys per bucket of a copy-on-write dict
+DICT_BUCKET_SIZE = 512
+
+class ChunkedList:
+    """A list or typed array stored in fixed-size chunks that its copies share.
+
+    copy() copies only the list of chunks, and writing to an item copies the one chunk holding it, so a catalog
+    version made by a delta shares every untouched chunk with the version before it. Hot loops index chunks
+    directly: item p is chunks[p >> CHUNK_SHIFT][p & CHUNK_MASK]."""
+
+    __slots__ = ('chunks', 'length', 'owned', 'empty')
+
+    def __init__(self, values=()):
+        self.chunks = [values[start:start + CHUNK_SIZE] for start in range(0, len(values), CHUNK_SIZE)]
+        self.length = len(values)
+        # Chunks this list made itself and may change in place; the others may be shared with a copy
+        self.owned = set(range(len(self.chunks)))
+        self.empty = values[:0]
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.chunks)
+
+    def __getitem__(self, position):
+        if position < 0:
+            position += self.length
+            if position < 0:
+                raise IndexError('ChunkedList index out of range')
+        return self.chunks[position >> CHUNK_SHIFT][position & CHUNK_MASK]
+
+    def __setitem__(self, position, value):
+        if not 0 <= position < self.length:
+            raise IndexError('ChunkedList assignment index out of range')
+        self._writable(position >> CHUNK_SHIFT)[position & CHUNK_MASK] = value
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return f"ChunkedList({list(self)!r})"
+
+    def append(self, value):
+        if self.length & CHUNK_MASK == 0:
+            self.chunks.append(self.empty[:])
+            self.owned.add(len(self.chunks) - 1)
+        self._writable(len(self.chunks) - 1).append(value)
+        self.length += 1
+
+    def copy(self):
+        """A list sharing every chunk with this one; whichever of the two writes to a chunk first copies it."""
+        copy = ChunkedList.__new__(ChunkedList)
+        copy.chunks = self.chunks[:]
+        copy.length = self.length
+        copy.owned = set()
+        copy.empty = self.empty
+        self.owned = set()
+        return copy
+
+    def _writable(self, chunk_number):
+        if chunk_number not in self.owned:
+            self.chunks[chunk_number] = self.chunks[chunk_number][:]
+            self.owned.add(chunk_number)
+        return self.chunks[chunk_number]
+
+class ChunkedDict:
+    """A dict split into buckets by key hash that its copies share, the mapping counterpart of ChunkedList.
+
+    Pickles as a plain dict, since string hashes differ between processes."""
+
+    __slots__ = ('buckets', 'mask', 'length', 'owned')
+
+    def __init__(self, items=()):
+        items = items if isinstance(items, dict) else dict(items)
+        bucket_count = 1
+        while bucket_count * DICT_BUCKET_SIZE < len(items):
+            bucket_count *= 2
+        self.mask = bucket_count - 1
+        self.buckets = [{} for _ in range(bucket_count)]
+        for key, value in items.items():
+            self.buckets[hash(key) & self.mask][key] = value
+        self.length = len(items)
+        self.owned = set(range(bucket_count))
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.buckets)
+
+    def __contains__(self, key):
+        return key in self.buckets[hash(key) & self.mask]
+
+    def __getitem__(self, key):
+        return self.buckets[hash(key) & self.mask][key]
+
+    def __setitem__(self, key, value):
+        bucket = self._writable(hash(key) & self.mask)
+        if key not in bucket:
+            self.length += 1
+        bucket[key] = value
+        # Doubling the buckets keeps the share a write copies bounded as the dict grows
+        if self.length > 2 * DICT_BUCKET_SIZE * len(self.buckets):
+            self.__init__(dict(self.items()))
+
+    def __eq__(self, other):
+        return dict(self.items()) == dict(other.items())
+
+    def __repr__(self):
+        return f"ChunkedDict({dict(self.items())!r})"
+
+    def __reduce__(self):
+        return ChunkedDict, (dict(self.items()),)
+
+    def get(self, key, default=None):
+        return self.buckets[hash(key) & self.mask].get(key, default)
+
+    def pop(self, key, default=None):
+        bucket_number = hash(key) & self.mask
+        if key not in self.buckets[bucket_number]:
+            return default
+        self.length -= 1
+        return self._writable(bucket_number).pop(key)
+
+    def keys(self):
+        return iter(self)
+
+    def items(self):
+        return itertools.chain.from_iterable(bucket.items() for bucket in self.buckets)
+
+    def copy(self):
+        """A dict sharing every bucket with this one; whichever of the two writes to a bucket first copies it."""
+        copy = ChunkedDict.__new__(ChunkedDict)
+        copy.buckets = self.buckets[:]
+        copy.mask = self.mask
+        copy.length = self.length
+        copy.owned = set()
+        self.owned = set()
+        return copy
+
+    def _writable(self, bucket_number):
+        if bucket_number not in self.owned:
+            self.buckets[bucket_number] = dict(self.buckets[bucket_number])
+            self.owned.add(bucket_number)
+        return self.buckets[bucket_number]
+
+class PostingList:
+    """The sorted positions of the products containing one index word, stored in sorted chunks.
+
+    Only words with more than CHUNK_SIZE products get one; shorter postings stay plain lists. Never changed
+    in place: with_position and without_position return a new list sharing every chunk but one."""
+
+    __slots__ = ('chunks', 'length')
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.length = sum(map(len, chunks))
+
+    @classmethod
+    def from_sorted(cls, positions):
+        return cls([positions[start:start + CHUNK_SIZE] for start in range(0, len(positions), CHUNK_SIZE)])
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.chunks)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.length
+        if 0 <= index < self.length:
+            for chunk in self.chunks:
+                if index < len(chunk):
+                    return chunk[index]
+                index -= len(chunk)
+        raise IndexError('PostingList index out of range')
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return f"PostingList({list(self)!r})"
+
+    def with_position(self, position):
+        chunk_number = min(bisect_left(self.chunks, position, key=lambda chunk: chunk[-1]), len(self.chunks) - 1)
+        chunk = self.chunks[chunk_number][:]
+        insort(chunk, position)
+        # Chunks split in two once they double, so none grows without bound
+        replacement = [chunk[:CHUNK_SIZE], chunk[CHUNK_SIZE:]] if len(chunk) >= 2 * CHUNK_SIZE else [chunk]
+        return PostingList(self.chunks[:chunk_number] + replacement + self.chunks[chunk_number + 1:])
+
+    def without_position(self, position):
+        chunk_number = bisect_left(self.chunks, position, key=lambda chunk: chunk[-1])
+        if chunk_number == len(self.chunks):
+            return self
+        chunk = self.chunks[chunk_number]
+        i = bisect_left(chunk, position)
+        if chunk[i] != position:
+            return self
+        chunk = chunk[:i] + chunk[i + 1:]
+        return PostingList(self.chunks[:chunk_number] + ([chunk] if chunk else []) + self.chunks[chunk_number + 1:])
+
+def chunk_product_index(index):
+    """A product index as a ChunkedDict, with the postings of words in more than CHUNK_SIZE products as PostingLists."""
+    return ChunkedDict({word: PostingList.from_sorted(postings) if len(postings) > CHUNK_SIZE else postings
+                        for word, postings in index.items()})
+
+PRODUCT_FIELDS = (
+    'id', 'name', 'brand', 'category', 'subcategory', 'department', 'product_size',
+    'source', 'price', 'availability', 'promotion', 'product_url'
+)
+
+# Product fields with few distinct values, stored as integer codes into a list of those values
+CATEGORICAL_PRODUCT_FIELDS = ('brand', 'category', 'subcategory', 'department', 'product_size', 'source', 'availability', 'promotion')
+
+class ProductTable:
+    """The catalog's products stored column by column instead of as one dict each.
+
+    Repetitive fields are dictionary-encoded, prices are floats in a typed array and the remaining text is kept
+    in plain lists. Indexing builds a product dict on demand, so only the products a response returns are ever
+    materialized. columns holds builtin types only, which keeps the catalog snapshot independent of this class,
+    until chunk_columns turns them into ChunkedLists for a Catalog."""
+
+    def __init__(self, columns=None):
+        if columns is None:
+            columns = {'id': [], 'name': [], 'product_url': [], 'price': array('d')}
+            for field in CATEGORICAL_PRODUCT_FIELDS:
+                columns[field] = array('I')
+                columns[field + '_values'] = []
+        self.columns = columns
+        self._codes = {field: {value: code for code, value in enumerate(columns[field + '_values'])}
+                       for field in CATEGORICAL_PRODUCT_FIELDS}
+        self._decoders = [(field, columns[field], columns.get(field + '_values')) for field in PRODUCT_FIELDS]
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    def __getitem__(self, position):
+        product = {}
+        for field, column, values in self._decoders:
+            if values is not None:
+                product[field] = values[column[position]]
+            elif field == 'price':
+                price = column[position]
+                product[field] = 'Price unavailable' if price != price else f"${price:.2f}"
+            else:
+                product[field] = column[position]
+        return product
+
+    def __iter__(self):
+        return (self[position] for position in range(len(self)))
+
+    def __setitem__(self, position, product):
+        for field, value in self._encode(product):
+            column = self.columns[field]
+            stored = column[position]
+            # Only changed fields are written, so a delta copies no chunk of a column it leaves alone; NaN never equals itself
+            if stored != value and (stored == stored or value == value):
+                column[position] = value
+
+    def append(self, product):
+        for field, value in self._encode(product):
+            self.columns[field].append(value)
+
+    def copy(self):
+        """A table that changing leaves this one as it was, sharing every chunk of its columns until it writes to one.
+
+        The lists of categorical values and their codes are shared as they are: both only ever grow, in step."""
+        table = ProductTable.__new__(ProductTable)
+        table.columns = {name: column.copy() if isinstance(column, ChunkedList) else column for name, column in self.columns.items()}
+        table._codes = self._codes
+        table._decoders = [(field, table.columns[field], table.columns.get(field + '_values')) for field in PRODUCT_FIELDS]
+        return table
+
+    def chunk_columns(self):
+        """Store every column except the lists of categorical values as a ChunkedList, so copies share them."""
+        for name, column in self.columns.items():
+            if not name.endswith('_values') and not isinstance(column, ChunkedList):
+                self.columns[name] = ChunkedList(column)
+        self._decoders = [(field, self.columns[field], self.columns.get(field + '_values')) for field in PRODUCT_FIELDS]
+        return self
+
+    def _encode(self, product):
+        """(column, stored value) pairs for a product dict."""
+        for field in PRODUCT_FIELDS:
+            value = product.get(field)
+            if field in self._codes:
+                codes = self._codes[field]
+                code = codes.get(value)
+                if code is None:
+                    code = codes[value] = len(codes)
+                    self.columns[field + '_values'].append(value)
+                yield field, code
+            elif field == 'price':
+                # parse_product_row formats every price as "$<amount>" or "Price unavailable"
+                yield field, float(value[1:]) if value and value.startswith('$') else float('nan')
+            else:
+                yield field, value or ''
+
+class Catalog:
+    """One loaded version of the grocery catalog and everything derived from it.
+
+    Reloads build a new Catalog off to the side and swap it in with a single assignment. A request
+    reads current_catalog once and passes that object along, so it never mixes two versions."""
+
+    def __init__(self, grocery_data=None, product_features=None, product_index=None, version=0, source_stat=None):
+        # Columns and the index are stored copy-on-write, so a delta's copy shares all it doesn't change
+        self.grocery_data = (grocery_data or ProductTable()).chunk_columns()
+        # Match features precomputed at load time, stored column-wise and aligned with grocery_data
+        self.product_features = {column: values if isinstance(values, ChunkedList) else ChunkedList(values)
+                                 for column, values in (product_features or {}).items()}
+        # Inverted index from normalized product-name words to positions in grocery_data
+        self.product_index = product_index if isinstance(product_index, ChunkedDict) else chunk_product_index(product_index or {})
+        # NumPy arrays derived from product_features for the vectorized engine, built on first use
+        self.numpy_features = {}
+        self.version = version
+        # (size, mtime_ns) of the CSV the catalog was built from, compared by the file watcher
+        self.source_stat = source_stat
+        # Positions removed by deltas, each mapped to True; they stay in grocery_data but leave the index
+        self.deleted_positions = ChunkedDict()
+        # SKU -> positions of its live products, built by the first delta
+        self.sku_positions = None
+        # (version a delta was applied to, positions whose features it changed or deleted, their old and new words);
+        # None for a catalog that was loaded
+        self.changes = None
+        # Rows read, rejected and parse throughput of a CSV load; empty when loaded from the snapshot
+        self.load_stats = {}
+
+    def product_count(self):
+        return len(self.grocery_data) - len(self.deleted_positions)
+
+# The catalog new requests use; replaced as a whole by load_grocery_data
+current_catalog = Catalog()
+catalog_versions = itertools.count(1)
+
+# One reload at a time; the last reload's outcome is kept for /api/admin/catalog
+catalog_reload_lock = threading.Lock()
+catalog_reload_status = {}
+
+# Ranked (position, score) lists per (catalog version, normalized ingredient), reused across requests
+match_cache = LRUCache(MATCH_CACHE_SIZE)
+
+# Single-process pools of the sharded engine, one per shard, started once and kept across reloads
+match_shard_pools = []
+# Catalog version the shard workers hold; each new version is sent to them instead of starting new workers
+match_shard_version = None
+match_shard_pools_lock = threading.RLock()
+
+# Catalog shard scored by a sharded-engine worker process, renumbered from 0; None in the server itself
+match_shard = None
+
+# Categories of processed/prepared foods to avoid for basic ingredients
+PROCESSED_KEYWORDS = {
+    'chips', 'crackers', 'cookies', 'candy', 'cake', 'pie', 'bread', 'pasta', 'noodles',
+    'soup', 'sauce', 'dressing', 'marinade', 'seasoning', 'mix', 'powder', 'extract',
+    'frozen', 'canned', 'jarred', 'pickled', 'smoked', 'dried', 'instant', 'prepared',
+    'cooked', 'baked', 'fried', 'roasted', 'grilled', 'bar', 'drink', 'beverage',
+    'cereal', 'granola', 'yogurt', 'ice', 'cream', 'snack', 'treat', 'dessert', 
+    'muffin', 'donut', 'cookie', 'cracker', 'chip'
+}
+
+# Basic ingredient categories that should match raw/simple products
+BASIC_INGREDIENTS = {
+    'salt', 'pepper', 'sugar', 'flour', 'oil', 'vinegar', 'water', 'milk', 'eggs',
+    'onion', 'garlic', 'tomato', 'potato', 'carrot', 'celery', 'lemon', 'lime',
+    'parsley', 'basil', 'oregano', 'thyme', 'rosemary', 'paprika', 'cumin', 'cinnamon',
+    'vanilla', 'honey', 'butter', 'cheese', 'rice', 'chicken', 'beef', 'pork', 'fish', 
+    'salmon', 'tuna', 'shrimp', 'beans', 'lentils', 'saffron', 'ginger'
+}
+
+# Allowed exceptions for basic ingredients (e.g., "salt" can match "sea salt" but not "salt chips")
+INGREDIENT_EXCEPTIONS = {
+    'salt': ['sea salt', 'kosher salt', 'table salt', 'rock salt', 'himalayan salt', 'iodized salt'],
+    'pepper': ['black pepper', 'white pepper', 'ground pepper', 'peppercorns', 'cracked pepper'],
+    'sugar': ['white sugar', 'brown sugar', 'raw sugar', 'cane sugar', 'granulated sugar'],
+    'oil': ['olive oil', 'vegetable oil', 'coconut oil', 'canola oil', 'sunflower oil'],
+    'vinegar': ['white vinegar', 'apple cider vinegar', 'balsamic vinegar', 'rice vinegar'],
+    'flour': ['all purpose flour', 'wheat flour', 'bread flour', 'cake flour', 'whole wheat flour']
+}
+
+# Well-known, trusted brands for basic ingredients
+TRUSTED_BRANDS = {
+    'great value', 'marketside', 'equate', 'morton', 'domino', 'crisco',
+    'heinz', 'hellmann', 'best foods', 'mccormick', 'king arthur',
+    'land o lakes', 'philadelphia', 'kraft', 'hunts'
+}
+
+# Overly processed alternatives
+ULTRA_PROCESSED_KEYWORDS = {
+    'instant', 'microwaveable', 'ready to eat', 'pre-cooked', 'just add water',
+    'artificial', 'imitation', 'substitute', 'replacement', 'alternative'
+}
+
+# Columns of product_features, in the order compute_product_features returns them
+PRODUCT_FEATURE_COLUMNS = (
+    'name_lower', 'words', 'loose_words', 'trusted_brand', 'processed', 'ultra_processed',
+    'signature', 'similarity_name', 'similarity_brand'
+)
 
 def load_grocery_data():
-    """Load grocery data from WMT CSV file only, with robust logging."""
-    global grocery_data
-    grocery_data = []
-    
-    csv_file_path = 'WMT_Grocery_202209.csv'
-    print(f"--- Attempting to load grocery data from: {os.path.abspath(csv_file_path)} ---")
+    """Build the catalog from the CSV off to the side, then swap it in while requests keep being served.
 
-    if not os.path.exists(csv_file_path):
-        print(f"--- FATAL ERROR: CSV file not found at '{os.path.abspath(csv_file_path)}'")
-        return
+    Logs how long the reload took and the peak memory of the process while both versions were alive.
+    Returns True when a new catalog was swapped in; if the CSV can't be loaded the current one stays."""
+    with catalog_reload_lock:
+        started = time.perf_counter()
+        with track_peak_rss() as memory:
+            catalog = build_catalog(CSV_FILE_PATH)
+            # Both versions are alive here: the old one still serves while the new one is complete
+            sample_rss(memory)
+            if catalog is not None:
+                swap_catalog(catalog)
+        elapsed = time.perf_counter() - started
+
+        status = 'ok' if catalog is not None else 'failed'
+        metrics.inc('cooker_catalog_reloads_total', status=status)
+        metrics.observe('cooker_catalog_reload_seconds', elapsed)
+        catalog_reload_status.clear()
+        catalog_reload_status.update(catalog.load_stats if catalog is not None else {})
+        catalog_reload_status.update({
+            'status': status,
+            'version': current_catalog.version,
+            'seconds': round(elapsed, 3),
+            'finished_at': time.time(),
+            'rss_before_bytes': memory['before'],
+            'rss_peak_bytes': memory['peak'],
+            'rss_after_bytes': memory['after']
+        })
+        logger.info("Catalog reload %s in %.2fs (version %s, %s products); memory before %s, peak %s, after %s",
+                    status, elapsed, current_catalog.version, current_catalog.product_count(),
+                    format_bytes(memory['before']), format_bytes(memory['peak']), format_bytes(memory['after']))
+        return catalog is not None
+
+def build_catalog(csv_file_path):
+    """Load grocery data from WMT CSV file only, with robust logging, into a new Catalog. Returns None on failure.
+
+    A compiled snapshot of the parsed catalog, its match features and its index is reused
+    when the CSV is unchanged, and written after every full parse."""
+    logger.info("Attempting to load grocery data from: %s", os.path.abspath(csv_file_path))
+
+    try:
+        # Taken before reading, so a change made while loading still looks new to the file watcher
+        csv_stat = os.stat(csv_file_path)
+    except OSError:
+        logger.error("CSV file not found at '%s'", os.path.abspath(csv_file_path))
+        return None
+    source_stat = (csv_stat.st_size, csv_stat.st_mtime_ns)
+
+    snapshot = load_catalog_snapshot(csv_file_path)
+    if snapshot:
+        grocery_data, product_features, product_index = snapshot
+        grocery_data = ProductTable(grocery_data)
+        logger.info("Loaded %s products from snapshot %s", len(grocery_data), CATALOG_SNAPSHOT_PATH)
+        return Catalog(grocery_data, product_features, product_index, next(catalog_versions), source_stat)
+
+    # Oversized fields are rejected with their row instead of being read into memory whole
+    csv.field_size_limit(CSV_FIELD_SIZE_LIMIT)
+
+    grocery_data = ProductTable()
+    product_features = {column: [] for column in PRODUCT_FEATURE_COLUMNS}
+    stats = {'rejected': 0}
+    try:
+        started = time.perf_counter()
+        with open(csv_file_path, 'r', encoding='utf-8') as file:
+            logger.debug("File opened successfully. Reading headers...")
+            csv_reader = csv.reader(bounded_lines(file, CSV_LINE_SIZE_LIMIT, stats))
+            headers = next(csv_reader, None)
+            logger.debug("CSV Headers detected: %s", headers)
+            if not headers or 'PRODUCT_NAME' not in headers:
+                raise ValueError("no PRODUCT_NAME column in the CSV header")
+
+            # Only a few chunks of raw rows exist at a time; products go straight into the columnar table
+            for products, feature_rows, rejected in parse_csv_chunks(headers, read_csv_chunks(csv_reader, stats)):
+                for product in products:
+                    grocery_data.append(product)
+                for column, values in zip(PRODUCT_FEATURE_COLUMNS, zip(*feature_rows)):
+                    product_features[column].extend(values)
+                stats['rejected'] += rejected
+
+        elapsed = time.perf_counter() - started
+        rows_per_second = len(grocery_data) / elapsed if elapsed else 0.0
+        metrics.inc('cooker_catalog_rows_rejected_total', stats['rejected'])
+        logger.info("Successfully loaded %s products from %s in %.1fs (%.0f rows/s, %s rows rejected)",
+                    len(grocery_data), csv_file_path, elapsed, rows_per_second, stats['rejected'])
+
+        product_index = build_product_index(product_features['words'])
+        logger.info("Indexed %s distinct product-name words", len(product_index))
 
-    # Increase CSV field size limit for potentially large fields
-    max_int = sys.maxsize
+        save_catalog_snapshot(csv_file_path, grocery_data.columns, product_features, product_index)
+
+    except Exception as e:
+        logger.error("Could not load grocery data: %s", e)
+        return None
+
+    catalog = Catalog(grocery_data, product_features, product_index, next(catalog_versions), source_stat)
+    catalog.load_stats = {'rows': len(grocery_data), 'rows_rejected': stats['rejected'], 'rows_per_second': round(rows_per_second)}
+    return catalog
+
+def bounded_lines(file, max_length, stats):
+    """Lines of a text file, skipping (and counting as rejected) any longer than max_length without ever reading one whole."""
+    while True:
+        line = file.readline(max_length + 1)
+        if not line:
+            return
+        if len(line) > max_length:
+            stats['rejected'] += 1
+            logger.warning("Skipping a CSV line longer than %s characters", max_length)
+            while line and not line.endswith('\n'):
+                line = file.readline(max_length + 1)
+            continue
+        yield line
+
+def read_csv_chunks(csv_reader, stats):
+    """Group data rows into lists of CSV_CHUNK_ROWS, skipping blank lines and counting rows the csv module rejects."""
+    chunk = []
     while True:
         try:
-            csv.field_size_limit(max_int)
+            row = next(csv_reader)
+        except StopIteration:
             break
-        except OverflowError:
-            max_int = int(max_int/10)
+        except csv.Error as e:
+            stats['rejected'] += 1
+            logger.warning("Skipping CSV row near line %s: %s", csv_reader.line_num, e)
+            continue
+        if not row:
+            continue
+        chunk.append(row)
+        if len(chunk) >= CSV_CHUNK_ROWS:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def parse_csv_chunk(headers, rows):
+    """Turn raw CSV rows into products and their match features, in-process or in a parse worker.
+
+    Rows whose field count differs from the header's are rejected. Returns (products, feature_rows, rejected)."""
+    products = []
+    feature_rows = []
+    rejected = 0
+    for values in rows:
+        if len(values) != len(headers):
+            rejected += 1
+            continue
+        product = parse_product_row(dict(zip(headers, values)))
+        products.append(product)
+        feature_rows.append(compute_product_features(product))
+    return products, feature_rows, rejected
+
+def parse_csv_worker(headers, tasks, results):
+    """Parse-worker process: parse (chunk number, rows) tasks until a None arrives."""
+    for chunk_number, rows in iter(tasks.get, None):
+        try:
+            results.put((chunk_number, parse_csv_chunk(headers, rows)))
+        except Exception as e:
+            results.put((chunk_number, e))
+
+def parse_csv_chunks(headers, chunks):
+    """parse_csv_chunk over chunks, results in file order, spread over CSV_PARSE_WORKERS processes when set above 1.
+
+    At most two chunks per worker are in flight, so memory stays bounded however large the file is."""
+    if CSV_PARSE_WORKERS <= 1:
+        for chunk in chunks:
+            yield parse_csv_chunk(headers, chunk)
+        return
+
+    # Workers are spawned rather than forked: reloads run on the watcher or an admin request thread, and a fork
+    # could copy a lock another server thread holds. Spawned workers import this module without loading the catalog.
+    context = multiprocessing.get_context('spawn')
+    tasks = context.Queue()
+    results = context.Queue()
+    workers = [context.Process(target=parse_csv_worker, args=(headers, tasks, results), daemon=True)
+               for _ in range(CSV_PARSE_WORKERS)]
+    for worker in workers:
+        worker.start()
+
+    parsed = {}
+
+    def collect(chunk_number):
+        while chunk_number not in parsed:
+            try:
+                finished_number, result = results.get(timeout=1)
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in workers):
+                    raise RuntimeError("a CSV parse worker exited unexpectedly")
+                continue
+            if isinstance(result, Exception):
+                raise result
+            parsed[finished_number] = result
+        return parsed.pop(chunk_number)
 
     try:
-        with open(csv_file_path, 'r', encoding='utf-8') as file:
-            print("--- File opened successfully. Reading headers... ---")
-            csv_reader = csv.DictReader(file)
-            headers = csv_reader.fieldnames
-            print(f"--- CSV Headers detected: {headers} ---")
-
-            for row in csv_reader:
-                current_price = row.get('PRICE_CURRENT', '').strip()
-                retail_price = row.get('PRICE_RETAIL', '').strip()
-                price = current_price if current_price else retail_price
-                
-                if price and price.lower() not in ['nan', 'none', '']:
-                    try:
-                        price_value = float(price.replace('$', '').replace(',', ''))
-                        formatted_price = f"${price_value:.2f}"
-                    except (ValueError, AttributeError):
-                        formatted_price = "Price unavailable"
-                else:
-                    formatted_price = "Price unavailable"
-                
-                promotion = row.get('PROMOTION', '').strip()
-                availability = 'On Sale' if promotion and promotion.lower() not in ['none', 'nan', ''] else 'In Stock'
-                
-                grocery_data.append({
-                    'id': row.get('SKU', ''), 'name': row.get('PRODUCT_NAME', ''),
-                    'brand': row.get('BRAND', ''), 'category': row.get('CATEGORY', ''),
-                    'subcategory': row.get('SUBCATEGORY', ''), 'department': row.get('DEPARTMENT', ''),
-                    'product_size': row.get('PRODUCT_SIZE', ''), 'source': 'walmart',
-                    'price': formatted_price, 'availability': availability,
-                    'promotion': promotion if promotion and promotion.lower() not in ['none', 'nan', ''] else None,
-                    'product_url': row.get('PRODUCT_URL', '')
-                })
-        print(f"--- Successfully loaded {len(grocery_data)} products from {csv_file_path} ---")
+        submitted = collected = 0
+        for chunk in chunks:
+            tasks.put((submitted, chunk))
+            submitted += 1
+            if submitted - collected >= 2 * CSV_PARSE_WORKERS:
+                yield collect(collected)
+                collected += 1
+        while collected < submitted:
+            yield collect(collected)
+            collected += 1
+    finally:
+        for worker in workers:
+            tasks.put(None)
+        for worker in workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+
+def swap_catalog(catalog, changed_words=None):
+    """Make catalog the one new requests use. The shard workers receive it with the first sharded query that uses it.
+
+    Cached rankings are dropped, except when a delta made catalog from the current one: changed_words then holds
+    the old and new words of every product it changed, and the rankings of ingredients sharing none of them carry
+    over to the new version, since none of their candidates changed."""
+    global current_catalog
+    with match_shard_pools_lock:
+        previous, current_catalog = current_catalog, catalog
+    if changed_words is None:
+        match_cache.clear()
+    else:
+        match_cache.rekey(lambda key: (catalog.version, key[1])
+                          if key[0] == previous.version and changed_words.isdisjoint(key[1].split()) else None)
+
+def watch_catalog_file(interval):
+    """Reload the catalog whenever the CSV changes, once its size and mtime have held still for one interval.
+
+    A CSV that fails to load is not retried until it changes again."""
+    previous_stat = None
+    failed_stat = None
+    while True:
+        time.sleep(interval)
+        try:
+            csv_stat = os.stat(CSV_FILE_PATH)
+            stat = (csv_stat.st_size, csv_stat.st_mtime_ns)
+        except OSError:
+            stat = None
+        # A file still being written changes between polls; wait until it settles
+        if stat is not None and stat == previous_stat and stat != current_catalog.source_stat and stat != failed_stat:
+            logger.info("%s changed, reloading the catalog", CSV_FILE_PATH)
+            try:
+                loaded = load_grocery_data()
+            except Exception as e:
+                logger.error("Catalog reload failed: %s", e)
+                loaded = False
+            if not loaded:
+                logger.warning("Keeping the current catalog until %s changes again", CSV_FILE_PATH)
+            failed_stat = None if loaded else stat
+        previous_stat = stat
+
+def start_catalog_watcher():
+    """Start the CSV watcher thread if CATALOG_WATCH_INTERVAL is set."""
+    if CATALOG_WATCH_INTERVAL <= 0:
+        return None
+    watcher = threading.Thread(target=watch_catalog_file, args=(CATALOG_WATCH_INTERVAL,), name='catalog-watcher', daemon=True)
+    watcher.start()
+    logger.info("Watching %s for changes every %ss", CSV_FILE_PATH, CATALOG_WATCH_INTERVAL)
+    return watcher
+
+def current_rss_bytes():
+    """Resident memory of this process in bytes. Without /proc, the high-water mark so far; None if neither is available."""
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+def sample_rss(memory):
+    rss = current_rss_bytes()
+    if rss is not None and (memory['peak'] is None or rss > memory['peak']):
+        memory['peak'] = rss
+
+@contextmanager
+def track_peak_rss(interval=0.05):
+    """Sample the process's resident memory in a background thread while the block runs.
+
+    Yields a dict holding the RSS in bytes before the block, its peak during it and after it. Long C calls
+    such as unpickling hold the GIL and pause the sampler, so the block can add samples of its own."""
+    memory = {'before': current_rss_bytes(), 'peak': None, 'after': None}
+    sample_rss(memory)
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            sample_rss(memory)
+
+    sampler = threading.Thread(target=sample, name='rss-sampler', daemon=True)
+    sampler.start()
+    try:
+        yield memory
+    finally:
+        done.set()
+        sampler.join()
+        sample_rss(memory)
+        memory['after'] = current_rss_bytes()
+
+def format_bytes(size):
+    return 'n/a' if size is None else f"{size / (1 << 20):.1f} MiB"
+
+def parse_product_row(row):
+    """Turn one row of the WMT CSV into a product."""
+    current_price = row.get('PRICE_CURRENT', '').strip()
+    retail_price = row.get('PRICE_RETAIL', '').strip()
+    price = current_price if current_price else retail_price
+    
+    if price and price.lower() not in ['nan', 'none', '']:
+        try:
+            price_value = float(price.replace('$', '').replace(',', ''))
+            formatted_price = f"${price_value:.2f}"
+        except (ValueError, AttributeError):
+            formatted_price = "Price unavailable"
+    else:
+        formatted_price = "Price unavailable"
+    
+    promotion = row.get('PROMOTION', '').strip()
+    availability = 'On Sale' if promotion and promotion.lower() not in ['none', 'nan', ''] else 'In Stock'
+    
+    return {
+        'id': row.get('SKU', ''), 'name': row.get('PRODUCT_NAME', ''),
+        'brand': row.get('BRAND', ''), 'category': row.get('CATEGORY', ''),
+        'subcategory': row.get('SUBCATEGORY', ''), 'department': row.get('DEPARTMENT', ''),
+        'product_size': row.get('PRODUCT_SIZE', ''), 'source': 'walmart',
+        'price': formatted_price, 'availability': availability,
+        'promotion': promotion if promotion and promotion.lower() not in ['none', 'nan', ''] else None,
+        'product_url': row.get('PRODUCT_URL', '')
+    }
+
+def file_sha256(path):
+    """Hash a file's contents in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def load_catalog_snapshot(csv_file_path):
+    """Return (product columns, product_features, product_index) from the snapshot if it matches the CSV, else None."""
+    if not os.path.exists(CATALOG_SNAPSHOT_PATH):
+        return None
+
+    try:
+        csv_stat = os.stat(csv_file_path)
+        with open(CATALOG_SNAPSHOT_PATH, 'rb') as file:
+            # The small header is pickled separately so a stale snapshot is rejected without reading the payload
+            header = pickle.load(file)
+            if header.get('version') != CATALOG_SNAPSHOT_VERSION or header.get('feature_columns') != PRODUCT_FEATURE_COLUMNS:
+                logger.info("Catalog snapshot format is outdated, rebuilding")
+                return None
+
+            if (header.get('csv_size'), header.get('csv_mtime_ns')) != (csv_stat.st_size, csv_stat.st_mtime_ns):
+                # The file was touched or replaced; only its contents decide whether the snapshot is stale
+                if header.get('csv_sha256') != file_sha256(csv_file_path):
+                    logger.info("CSV changed since the catalog snapshot was built, rebuilding")
+                    return None
+
+            # Skip cyclic GC passes while hundreds of thousands of containers are allocated
+            gc.disable()
+            try:
+                payload = pickle.load(file)
+            finally:
+                gc.enable()
+
+        return payload['grocery_data'], payload['product_features'], payload['product_index']
 
     except Exception as e:
-        print(f"--- FATAL ERROR loading grocery data: {e} ---")
-        grocery_data = []
+        logger.warning("Ignoring unreadable catalog snapshot: %s", e)
+        return None
+
+def save_catalog_snapshot(csv_file_path, products, features, index):
+    """Write the parsed catalog, its features and its index next to the CSV for the next start."""
+    temp_path = f"{CATALOG_SNAPSHOT_PATH}.tmp"
+    try:
+        csv_stat = os.stat(csv_file_path)
+        header = {
+            'version': CATALOG_SNAPSHOT_VERSION,
+            'feature_columns': PRODUCT_FEATURE_COLUMNS,
+            'csv_size': csv_stat.st_size,
+            'csv_mtime_ns': csv_stat.st_mtime_ns,
+            'csv_sha256': file_sha256(csv_file_path)
+        }
+        with open(temp_path, 'wb') as file:
+            pickle.dump(header, file, protocol=pickle.HIGHEST_PROTOCOL)
+            pickle.dump({
+                'grocery_data': products,
+                'product_features': features,
+                'product_index': index
+            }, file, protocol=pickle.HIGHEST_PROTOCOL)
+        # Atomic rename so a concurrently starting worker never reads a half-written snapshot
+        os.replace(temp_path, CATALOG_SNAPSHOT_PATH)
+        logger.info("Wrote catalog snapshot to %s", CATALOG_SNAPSHOT_PATH)
+
+    except Exception as e:
+        logger.warning("Could not write catalog snapshot: %s", e)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def compute_product_features(product):
+    """Derive the normalized values the matcher needs from a single product, in PRODUCT_FEATURE_COLUMNS order."""
+    name_lower = product['name'].lower()
+    product_name_clean = re.sub(r'[^\w\s]', '', name_lower)
+    words = frozenset(product_name_clean.split())
+    # Words that only appear glued to punctuation (e.g. "salt,") don't count as exact word matches
+    loose_words = words.difference(name_lower.split()) or None
+    brand_lower = product.get('brand', '').lower()
+    return (
+        name_lower,
+        words,
+        loose_words,
+        bool(brand_lower) and any(brand in brand_lower for brand in TRUSTED_BRANDS),
+        any(proc_word in name_lower for proc_word in PROCESSED_KEYWORDS),
+        any(keyword in name_lower for keyword in ULTRA_PROCESSED_KEYWORDS),
+        create_product_signature(product),
+        normalize_similarity_name(product.get('name', '')),
+        brand_lower.strip()
+    )
+
+def build_product_features(products):
+    """Precompute match features for every product, returned as one list per column."""
+    return product_feature_columns([compute_product_features(product) for product in products])
+
+def product_feature_columns(rows):
+    """Turn compute_product_features rows into one list per column."""
+    columns = list(zip(*rows)) if rows else [()] * len(PRODUCT_FEATURE_COLUMNS)
+    return {column: list(values) for column, values in zip(PRODUCT_FEATURE_COLUMNS, columns)}
+
+def build_product_index(words_column):
+    """Build an inverted index mapping each normalized product-name word to the positions of the products containing it."""
+    index = defaultdict(list)
+    for position, words in enumerate(words_column):
+        for word in words:
+            index[word].append(position)
+    return dict(index)
+
+# WMT CSV column each product field is read from; price, availability and promotion are derived in parse_product_row
+PRODUCT_CSV_COLUMNS = {
+    'id': 'SKU', 'name': 'PRODUCT_NAME', 'brand': 'BRAND', 'category': 'CATEGORY',
+    'subcategory': 'SUBCATEGORY', 'department': 'DEPARTMENT', 'product_size': 'PRODUCT_SIZE',
+    'product_url': 'PRODUCT_URL'
+}
+
+def read_catalog_delta(file, delta_format):
+    """Parse a delta of 'csv' or 'jsonl' rows with WMT CSV columns into (op, row) pairs.
+
+    op comes from an OP column or key ('upsert' or 'delete', upsert when absent). Raises ValueError on malformed input."""
+    if delta_format == 'csv':
+        rows = csv.DictReader(file)
+    else:
+        rows = (json.loads(line) for line in file if line.strip())
+
+    changes = []
+    for line_number, row in enumerate(rows, 1):
+        if not isinstance(row, dict):
+            raise ValueError(f"row {line_number} is not an object")
+        row = {str(column): '' if value is None else str(value) for column, value in row.items()}
+        op = row.pop('OP', '') or row.pop('op', '') or 'upsert'
+        changes.append((op.strip().lower(), row))
+    return changes
+
+def apply_catalog_delta(changes):
+    """Apply (op, row) upserts and deletes by SKU to a copy of the current catalog, then swap the copy in as one new version.
+
+    Upsert rows may be partial: a known SKU keeps the fields whose columns the row leaves out. Requests running
+    meanwhile keep reading the version they started with and never see part of a delta. The copy shares everything
+    the delta leaves alone with that version, so a delta takes time in proportion to its rows, not to the catalog.
+    Returns the count of each outcome plus the first rejected rows."""
+    with catalog_reload_lock:
+        started = time.perf_counter()
+        previous = current_catalog
+        catalog = copy_catalog(previous)
+        if catalog.sku_positions is None:
+            catalog.sku_positions = index_skus(catalog)
+        if not catalog.product_features:
+            catalog.product_features = {column: ChunkedList([]) for column in PRODUCT_FEATURE_COLUMNS}
+
+        counts = {'inserted': 0, 'updated': 0, 'deleted': 0, 'rejected': 0}
+        rejected = []
+        for row_number, (op, row) in enumerate(changes, 1):
+            sku = row.get('SKU', '').strip()
+            if not sku:
+                reason = 'missing SKU'
+            elif op == 'delete':
+                positions = catalog.sku_positions.pop(sku, None)
+                for position in positions or ():
+                    remove_catalog_product(catalog, position)
+                reason = None if positions else 'unknown SKU'
+                outcome = 'deleted'
+            elif op == 'upsert':
+                row['SKU'] = sku
+                outcome = upsert_catalog_product(catalog, sku, row)
+                reason = None if outcome else 'new SKU without PRODUCT_NAME'
+            else:
+                reason = f"unknown op '{op}'"
+
+            if reason:
+                outcome = 'rejected'
+                if len(rejected) < 20:
+                    rejected.append({'row': row_number, 'sku': sku, 'reason': reason})
+            counts[outcome] += 1
+            metrics.inc('cooker_catalog_delta_rows_total', outcome=outcome)
+
+        if counts['inserted'] or counts['updated'] or counts['deleted']:
+            catalog.version = next(catalog_versions)
+            changed_positions, changed_words = catalog.changes[1], catalog.changes[2]
+            catalog.numpy_features = patch_numpy_features(previous.numpy_features, changed_positions, catalog.product_count())
+            swap_catalog(catalog, changed_words)
+            if match_shard_pools:
+                # Shard workers holding the previous version take just this delta's changes now, instead of
+                # the whole catalog once two deltas have gone by
+                try:
+                    get_match_shards(catalog)
+                except BrokenProcessPool as e:
+                    logger.warning("Matching shard worker died (%s) while receiving a delta", e)
+                    stop_match_shards()
+        else:
+            catalog = previous
+
+        elapsed = time.perf_counter() - started
+        logger.info("Applied catalog delta in %.1f ms (version %s): %s", elapsed * 1000, catalog.version, counts)
+        return dict(counts, version=catalog.version, products=catalog.product_count(), seconds=round(elapsed, 4), rejected_rows=rejected)
+
+def copy_catalog(catalog):
+    """A copy of catalog for a delta to change while requests keep reading the original.
+
+    Columns, the index, the deleted positions and the SKU map are copy-on-write: the copy shares every chunk,
+    bucket and posting list with the original until it writes to one, so copying costs only their chunk lists."""
+    copy = Catalog(grocery_data=catalog.grocery_data.copy(),
+                   product_features={column: values.copy() for column, values in catalog.product_features.items()},
+                   product_index=catalog.product_index.copy(), version=catalog.version, source_stat=catalog.source_stat)
+    copy.deleted_positions = catalog.deleted_positions.copy()
+    copy.sku_positions = catalog.sku_positions.copy() if catalog.sku_positions is not None else None
+    copy.load_stats = catalog.load_stats
+    copy.changes = (catalog.version, set(), set())
+    return copy
 
-def find_matching_products(ingredient, used_product_ids=None, top_n=3):
-    """Find matching products for an ingredient using a robust scoring model that prevents false matches."""
+def index_skus(catalog):
+    """Map each SKU to a tuple of the positions of its live products.
+
+    Tuples rather than lists: the garbage collector stops tracking tuples of ints, and collections passing over
+    hundreds of thousands of new lists made this several times slower on a large catalog."""
+    deleted_positions = catalog.deleted_positions
+    sku_positions = {}
+    for position, sku in enumerate(catalog.grocery_data.columns['id']):
+        if sku and not (deleted_positions and position in deleted_positions):
+            sku_positions[sku] = sku_positions.get(sku, ()) + (position,)
+    return ChunkedDict(sku_positions)
+
+def product_to_row(product):
+    """The WMT CSV row a product parses back from, so a partial delta row can be laid over it."""
+    row = {column: product.get(field, '') for field, column in PRODUCT_CSV_COLUMNS.items()}
+    row['PRICE_CURRENT'] = product.get('price', '')
+    row['PROMOTION'] = product.get('promotion') or ''
+    return row
+
+def upsert_catalog_product(catalog, sku, row):
+    """Replace or add the product for a SKU; returns 'updated', 'inserted', or None for a new SKU without a name."""
+    positions = catalog.sku_positions.get(sku)
+    if positions:
+        position = positions[0]
+        for duplicate in positions[1:]:
+            remove_catalog_product(catalog, duplicate)
+        base = product_to_row(catalog.grocery_data[position])
+        if 'PRICE_CURRENT' in row or 'PRICE_RETAIL' in row:
+            del base['PRICE_CURRENT']
+        set_catalog_product(catalog, position, parse_product_row({**base, **row}))
+        catalog.sku_positions[sku] = (position,)
+        return 'updated'
+
+    if not row.get('PRODUCT_NAME', '').strip():
+        return None
+    position = len(catalog.grocery_data)
+    set_catalog_product(catalog, position, parse_product_row(row))
+    catalog.sku_positions[sku] = (position,)
+    return 'inserted'
+
+def set_catalog_product(catalog, position, product):
+    """Store a product at position, or append it when position is the end, keeping its features and postings in step."""
+    if position == len(catalog.grocery_data):
+        catalog.grocery_data.append(product)
+    else:
+        catalog.grocery_data[position] = product
+    set_product_features(catalog, position, dict(zip(PRODUCT_FEATURE_COLUMNS, compute_product_features(product))))
+
+def set_product_features(catalog, position, values):
+    """Store the feature values of the product at position, or append them when position is the end, and move its postings to match.
+
+    values maps each product_features column to its value. Columns whose value is unchanged aren't written, so a
+    delta that only changes a price leaves the feature columns and the index as they were."""
+    features = catalog.product_features
+    if position == len(features['words']):
+        old_words = frozenset()
+        for column, value in values.items():
+            features[column].append(value)
+    else:
+        old_words = features['words'][position]
+        changed = [(column, value) for column, value in values.items() if features[column][position] != value]
+        if not changed:
+            return
+        for column, value in changed:
+            features[column][position] = value
+
+    # The index changes last, so a position is only found once its product and features are in place
+    new_words = features['words'][position]
+    for word in old_words - new_words:
+        remove_posting(catalog.product_index, word, position)
+    for word in new_words - old_words:
+        add_posting(catalog.product_index, word, position)
+    record_catalog_change(catalog, position, old_words | new_words)
+
+def remove_catalog_product(catalog, position):
+    """Take a product out of the index; its row stays behind so the positions of the other products don't move."""
+    words = catalog.product_features['words'][position]
+    for word in words:
+        remove_posting(catalog.product_index, word, position)
+    catalog.deleted_positions[position] = True
+    record_catalog_change(catalog, position, words)
+
+def record_catalog_change(catalog, position, words):
+    """Note, for a catalog a delta is changing, a position whose features changed and the words it had or has."""
+    if catalog.changes is not None:
+        catalog.changes[1].add(position)
+        catalog.changes[2].update(words)
+
+def add_posting(index, word, position):
+    # A new posting list rather than an in-place change: copy_catalog shares them with the previous version
+    postings = index.get(word)
+    if isinstance(postings, PostingList):
+        index[word] = postings.with_position(position)
+        return
+    postings = list(postings or ())
+    insort(postings, position)
+    index[word] = PostingList.from_sorted(postings) if len(postings) > CHUNK_SIZE else postings
+
+def remove_posting(index, word, position):
+    postings = index.get(word)
+    if postings is None:
+        return
+    if isinstance(postings, PostingList):
+        postings = postings.without_position(position)
+    else:
+        i = bisect_left(postings, position)
+        if i < len(postings) and postings[i] == position:
+            postings = postings[:i] + postings[i + 1:]
+    if postings:
+        index[word] = postings
+    else:
+        index.pop(word, None)
+
+def min_words_found(ingredient_word_count):
+    """Smallest number of matching words that gives a multi-word ingredient the required 70% coverage (Score 7)."""
+    return next(count for count in range(1, ingredient_word_count + 1)
+                if count / ingredient_word_count >= 0.7)
+
+def find_candidate_positions(ingredient_words, catalog):
+    """Return, in catalog order, the positions of products that share enough words with the ingredient to pass the scorer's word filters."""
+    if not ingredient_words:
+        return []
+
+    if len(ingredient_words) == 1:
+        return catalog.product_index.get(next(iter(ingredient_words)), [])
+
+    required_words = min_words_found(len(ingredient_words))
+    word_counts = defaultdict(int)
+    for word in ingredient_words:
+        for position in catalog.product_index.get(word, []):
+            word_counts[position] += 1
+    return sorted(position for position, count in word_counts.items() if count >= required_words)
+
+def describe_ingredient(ingredient_clean, ingredient_words):
+    """Properties of the ingredient itself that the scorers reuse for every product."""
+    is_basic_ingredient = any(basic_word in ingredient_clean for basic_word in BASIC_INGREDIENTS)
+    main_ingredient = list(ingredient_words)[0] if len(ingredient_words) == 1 else ingredient_clean
+    exceptions = INGREDIENT_EXCEPTIONS.get(main_ingredient, [])
+    allows_ultra_processed = any(proc in ingredient_clean for proc in ['instant', 'ready', 'quick'])
+    return is_basic_ingredient, main_ingredient, exceptions, allows_ultra_processed
+
+def find_matching_products(ingredient, used_product_ids=None, top_n=3, engine=None):
+    """Find matching products for an ingredient using a robust scoring model that prevents false matches.
+
+    engine selects the scorer ('python', 'numpy' or 'sharded') and defaults to MATCH_ENGINE; all rank products identically."""
+    catalog = current_catalog
+    grocery_data = catalog.grocery_data
     if not grocery_data:
         return []
+    product_ids = grocery_data.columns['id']
     
     if used_product_ids is None:
         used_product_ids = set()
 
     ingredient_clean = re.sub(r'[^\w\s]', '', ingredient.lower().strip())
     ingredient_words = set(ingredient_clean.split())
+    product_scores = score_queries([(ingredient_clean, ingredient_words)], engine, catalog)[0]
+
+    # Skip products already used to prevent exact duplicates
+    product_scores = ((position, score) for position, score in product_scores
+                      if product_ids[position] not in used_product_ids)
+
+    # Additional deduplication within this ingredient's results
+    with timed_stage('dedupe'):
+        return [grocery_data[position] for position in select_distinct_products(product_scores, top_n, catalog)]
+
+def find_matching_products_batch(ingredients, top_n=3, engine=None):
+    """Match a whole ingredient list at once, returning one product list per ingredient.
+
+    Every distinct ingredient is scored in a single pass over the candidates; the shopping list's
+    cross-ingredient rules (no product or product signature used twice) are then applied in list order."""
+    return ShoppingListMatcher(top_n, engine).match(ingredients)
+
+class ShoppingListMatcher:
+    """Matches a shopping list's ingredients in order, in one call or in pieces as they become known.
+
+    Products and product signatures used for one ingredient stay used for the later ones, so matching a list
+    in pieces picks the same products as matching it at once. The catalog is the one current at creation."""
+
+    def __init__(self, top_n=3, engine=None):
+        self.catalog = current_catalog
+        self.top_n = top_n
+        self.engine = engine
+        self.used_product_ids = set()  # Track used products to prevent exact duplicates
+        self.used_product_signatures = set()  # Track similar products to prevent near-duplicates
+
+    def match(self, ingredients):
+        """Match the next ingredients of the list, returning one product list per ingredient."""
+        catalog = self.catalog
+        grocery_data = catalog.grocery_data
+        if not grocery_data:
+            return [[] for _ in ingredients]
+        product_ids = grocery_data.columns['id']
+
+        # Repeated ingredients share one query
+        query_numbers = {}
+        queries = []
+        for ingredient in ingredients:
+            ingredient_clean = re.sub(r'[^\w\s]', '', ingredient.lower().strip())
+            if ingredient_clean not in query_numbers:
+                query_numbers[ingredient_clean] = len(queries)
+                queries.append((ingredient_clean, set(ingredient_clean.split())))
+        ranked_products = score_queries(queries, self.engine, catalog)
+
+        signatures = catalog.product_features['signature']
+        used_product_ids = self.used_product_ids
+        used_product_signatures = self.used_product_signatures
+        matches = []
+
+        with timed_stage('dedupe'):
+            for ingredient in ingredients:
+                product_scores = ranked_products[query_numbers[re.sub(r'[^\w\s]', '', ingredient.lower().strip())]]
+                product_scores = ((position, score) for position, score in product_scores
+                                  if product_ids[position] not in used_product_ids)
+
+                filtered_positions = []
+                for position in select_distinct_products(product_scores, self.top_n, catalog):
+                    if signatures[position] not in used_product_signatures:
+                        filtered_positions.append(position)
+                        used_product_signatures.add(signatures[position])
+                        if product_ids[position]:
+                            used_product_ids.add(product_ids[position])
+
+                matches.append([grocery_data[position] for position in filtered_positions])
+
+        return matches
+
+def score_queries(queries, engine=None, catalog=None):
+    """Rank products for a list of (ingredient_clean, ingredient_words) queries with the selected engine.
+
+    Rankings come from match_cache when possible. They don't depend on top_n or on the products a request
+    has already used, so callers apply those afterwards and must not modify the returned lists."""
+    catalog = catalog or current_catalog
+    # Read once: a delta applied while scoring bumps the version, and these rankings must not be cached under the new one
+    version = catalog.version
+    rankings = [match_cache.get((version, ingredient_clean)) for ingredient_clean, ingredient_words in queries]
+    missing = [query_number for query_number, ranked in enumerate(rankings) if ranked is None]
+    if not missing:
+        return rankings
+
+    missing_queries = [queries[query_number] for query_number in missing]
+    engine = engine or MATCH_ENGINE
+    with timed_stage('score_candidates'):
+        if engine == 'numpy' and np is not None:
+            scored = [score_products_numpy(ingredient_clean, ingredient_words, catalog) for ingredient_clean, ingredient_words in missing_queries]
+        elif engine == 'sharded':
+            scored = score_products_sharded(missing_queries, catalog)
+        else:
+            scored = score_products(missing_queries, catalog=catalog)
+
+    for query_number, ranked in zip(missing, scored):
+        rankings[query_number] = ranked
+        match_cache.put((version, queries[query_number][0]), ranked)
+    return rankings
+
+def score_products(queries, catalog=None):
+    """Score the candidate products of one or more (ingredient_clean, ingredient_words) queries in a single pass over the catalog.
+
+    Returns, per query, the (position, score) pairs above the threshold, best first."""
+    catalog = catalog or current_catalog
+    profiles = [(ingredient_clean, ingredient_words, len(ingredient_words)) + describe_ingredient(ingredient_clean, ingredient_words)
+                for ingredient_clean, ingredient_words in queries]
+
+    # Only products sharing a word with an ingredient can pass the word filters below
+    if len(queries) == 1:
+        only_query = [0]
+        positions = find_candidate_positions(queries[0][1], catalog)
+        record_candidates_scored(len(positions), catalog)
+        candidates = ((position, only_query) for position in positions)
+    else:
+        candidate_queries = defaultdict(list)
+        for query_number, (ingredient_clean, ingredient_words) in enumerate(queries):
+            positions = find_candidate_positions(ingredient_words, catalog)
+            record_candidates_scored(len(positions), catalog)
+            for position in positions:
+                candidate_queries[position].append(query_number)
+        # Visiting products in catalog order keeps ties in the same order as a per-ingredient scan
+        candidates = sorted(candidate_queries.items())
+
+    return score_candidates(profiles, candidates, catalog)
+
+def score_candidates(profiles, candidates, catalog):
+    """Score (position, query numbers) candidates, in catalog order, for the queries described by profiles.
+
+    Returns, per query, the (position, score) pairs above the threshold, best first."""
+    # The loop reads feature columns chunk by chunk rather than through ChunkedList indexing
+    product_features = catalog.product_features
+    names_lower = product_features['name_lower'].chunks
+    words_column = product_features['words'].chunks
+    loose_words_column = product_features['loose_words'].chunks
+    trusted_brand_column = product_features['trusted_brand'].chunks
+    processed_column = product_features['processed'].chunks
+    ultra_processed_column = product_features['ultra_processed'].chunks
     
-    # Define categories of processed/prepared foods to avoid for basic ingredients
-    processed_keywords = {
-        'chips', 'crackers', 'cookies', 'candy', 'cake', 'pie', 'bread', 'pasta', 'noodles',
-        'soup', 'sauce', 'dressing', 'marinade', 'seasoning', 'mix', 'powder', 'extract',
-        'frozen', 'canned', 'jarred', 'pickled', 'smoked', 'dried', 'instant', 'prepared',
-        'cooked', 'baked', 'fried', 'roasted', 'grilled', 'bar', 'drink', 'beverage',
-        'cereal', 'granola', 'yogurt', 'ice', 'cream', 'snack', 'treat', 'dessert', 
-        'muffin', 'donut', 'cookie', 'cracker', 'chip'
-    }
-    
-    # Basic ingredient categories that should match raw/simple products
-    basic_ingredients = {
-        'salt', 'pepper', 'sugar', 'flour', 'oil', 'vinegar', 'water', 'milk', 'eggs',
-        'onion', 'garlic', 'tomato', 'potato', 'carrot', 'celery', 'lemon', 'lime',
-        'parsley', 'basil', 'oregano', 'thyme', 'rosemary', 'paprika', 'cumin', 'cinnamon',
-        'vanilla', 'honey', 'butter', 'cheese', 'rice', 'chicken', 'beef', 'pork', 'fish', 
-        'salmon', 'tuna', 'shrimp', 'beans', 'lentils', 'saffron', 'ginger'
-    }
-    
-    product_scores = []
+    product_scores = [[] for _ in profiles]
     
-    for product in grocery_data:
-        # Skip if product already used to prevent exact duplicates
-        if product.get('id') in used_product_ids:
-            continue
-            
-        product_name_lower = product['name'].lower()
-        product_name_clean = re.sub(r'[^\w\s]', '', product_name_lower)
-        product_words = set(product_name_clean.split())
-
-        # Score 1: Jaccard similarity of word sets
-        intersection = len(ingredient_words.intersection(product_words))
-        union = len(ingredient_words.union(product_words))
-        jaccard_score = intersection / union if union != 0 else 0
-
-        # Score 2: How many ingredient words are in the product name?
-        words_found = sum(1 for word in ingredient_words if word in product_words)
-        coverage_score = words_found / len(ingredient_words) if ingredient_words else 0
+    for position, query_numbers in candidates:
+        chunk_number, offset = position >> CHUNK_SHIFT, position & CHUNK_MASK
+        product_name_lower = names_lower[chunk_number][offset]
+        product_words = words_column[chunk_number][offset]
+        product_word_count = len(product_words)
+
+        for query_number in query_numbers:
+            ingredient_clean, ingredient_words, ingredient_word_count, is_basic_ingredient, main_ingredient, exceptions, allows_ultra_processed = profiles[query_number]
+
+            # Score 1: Jaccard similarity of word sets
+            intersection = len(ingredient_words.intersection(product_words))
+            union = ingredient_word_count + product_word_count - intersection
+            jaccard_score = intersection / union if union != 0 else 0
+
+            # Score 2: How many ingredient words are in the product name?
+            words_found = intersection
+            coverage_score = words_found / ingredient_word_count if ingredient_words else 0
         
-        # Score 3: Penalty for extra words in the product name
-        length_diff = len(product_words) - len(ingredient_words)
-        penalty = 1 - (length_diff / len(product_words)) if len(product_words) > len(ingredient_words) else 1
-        penalty_score = max(0, penalty)
+            # Score 3: Penalty for extra words in the product name
+            length_diff = product_word_count - ingredient_word_count
+            penalty = 1 - (length_diff / product_word_count) if product_word_count > ingredient_word_count else 1
+            penalty_score = max(0, penalty)
 
-        # Score 4: Bonus if the ingredient is the start of the product name
-        prefix_bonus = 1.3 if product_name_lower.startswith(ingredient_clean) else 1.0
+            # Score 4: Bonus if the ingredient is the start of the product name
+            prefix_bonus = 1.3 if product_name_lower.startswith(ingredient_clean) else 1.0
         
-        # Score 5: ROBUST FILTERING - Prevent false matches for basic ingredients
-        is_basic_ingredient = any(basic_word in ingredient_clean for basic_word in basic_ingredients)
-        has_processed_words = any(proc_word in product_name_lower for proc_word in processed_keywords)
+            # Score 5: ROBUST FILTERING - Prevent false matches for basic ingredients
+            # Heavy penalty for basic ingredients matching processed foods
+            if is_basic_ingredient and processed_column[chunk_number][offset]:
+                # Allow some exceptions (e.g., "salt" can match "sea salt" but not "salt chips")
+                if not any(exception in product_name_lower for exception in exceptions):
+                    continue  # Skip this product for this ingredient
+
+            # Score 6: Exact word match requirement for single-word ingredients
+            if ingredient_word_count == 1:
+                # Must be an exact word match, not just a substring
+                loose_words = loose_words_column[chunk_number][offset]
+                if loose_words is not None and main_ingredient in loose_words:
+                    continue
         
-        # Heavy penalty for basic ingredients matching processed foods
-        if is_basic_ingredient and has_processed_words:
-            # Allow some exceptions (e.g., "salt" can match "sea salt" but not "salt chips")
-            ingredient_exceptions = {
-                'salt': ['sea salt', 'kosher salt', 'table salt', 'rock salt', 'himalayan salt', 'iodized salt'],
-                'pepper': ['black pepper', 'white pepper', 'ground pepper', 'peppercorns', 'cracked pepper'],
-                'sugar': ['white sugar', 'brown sugar', 'raw sugar', 'cane sugar', 'granulated sugar'],
-                'oil': ['olive oil', 'vegetable oil', 'coconut oil', 'canola oil', 'sunflower oil'],
-                'vinegar': ['white vinegar', 'apple cider vinegar', 'balsamic vinegar', 'rice vinegar'],
-                'flour': ['all purpose flour', 'wheat flour', 'bread flour', 'cake flour', 'whole wheat flour']
-            }
-            
-            is_valid_exception = False
-            main_ingredient = list(ingredient_words)[0] if len(ingredient_words) == 1 else ingredient_clean
-            
-            if main_ingredient in ingredient_exceptions:
-                for exception in ingredient_exceptions[main_ingredient]:
-                    if exception in product_name_lower:
-                        is_valid_exception = True
-                        break
+            # Score 7: Advanced filtering for multi-word ingredients
+            if ingredient_word_count > 1:
+                # For multi-word ingredients, ensure at least 70% of words match
+                word_match_ratio = words_found / ingredient_word_count
+                if word_match_ratio < 0.7:
+                    continue
+                
+            # Score 8: Prioritize simpler products over complex ones
+            simplicity_bonus = 1.0
+            if product_word_count <= 3:  # Simple products get bonus
+                simplicity_bonus = 1.3
+            elif product_word_count <= 5:  # Medium complexity
+                simplicity_bonus = 1.1
+            elif product_word_count > 8:  # Very complex products get penalty
+                simplicity_bonus = 0.6
+
+            # Score 9: Brand consistency bonus for well-known, trusted brands
+            brand_bonus = 1.15 if trusted_brand_column[chunk_number][offset] else 1.0
+
+            # Score 10: Prevent overly processed alternatives
+            ultra_processed_penalty = 1.0
+            if ultra_processed_column[chunk_number][offset]:
+                # Only allow if the ingredient itself suggests processed food
+                if not allows_ultra_processed:
+                    ultra_processed_penalty = 0.3  # Heavy penalty
+
+            # Combine scores with enhanced weighting
+            final_score = ((jaccard_score * 0.25) + (coverage_score * 0.55) + (penalty_score * 0.2)) * prefix_bonus * simplicity_bonus * brand_bonus * ultra_processed_penalty
+
+            # Higher threshold for better quality matches with stricter filtering
+            if final_score > 0.5:
+                product_scores[query_number].append((position, final_score))
             
-            if not is_valid_exception:
-                continue  # Skip this product entirely
+    for query_scores in product_scores:
+        query_scores.sort(key=lambda x: x[1], reverse=True)
+    return product_scores
+
+# product_features columns score_products reads, the only ones sent to the shard workers
+SHARD_FEATURE_COLUMNS = ('name_lower', 'words', 'loose_words', 'trusted_brand', 'processed', 'ultra_processed')
+
+def split_catalog(catalog, shard_count):
+    """Split catalog into shard_count catalogs for the shard workers, each renumbered from 0.
+
+    Shards interleave: position p is local position p // shard_count of shard p % shard_count, so each gets a share of every category."""
+    shard_features = [{column: list(itertools.islice(catalog.product_features[column], shard_number, None, shard_count))
+                       for column in SHARD_FEATURE_COLUMNS}
+                      for shard_number in range(shard_count)]
+    shard_indexes = [{} for _ in range(shard_count)]
+    for word, postings in catalog.product_index.items():
+        shard_postings = [[] for _ in range(shard_count)]
+        for position in postings:
+            shard_postings[position % shard_count].append(position // shard_count)
+        for index, local_postings in zip(shard_indexes, shard_postings):
+            if local_postings:
+                index[word] = local_postings
+    return [Catalog(product_features=features, product_index=index, version=catalog.version)
+            for features, index in zip(shard_features, shard_indexes)]
+
+def split_catalog_changes(catalog, shard_count):
+    """The (local position, shard feature values, deleted) changes a delta made to catalog, for each shard."""
+    shard_changes = [[] for _ in range(shard_count)]
+    for position in sorted(catalog.changes[1]):
+        values = {column: catalog.product_features[column][position] for column in SHARD_FEATURE_COLUMNS}
+        shard_changes[position % shard_count].append((position // shard_count, values, position in catalog.deleted_positions))
+    return shard_changes
+
+def set_match_shard(shard):
+    """Runs in a worker process: keep the catalog shard it scores until the server sends the next version."""
+    global match_shard
+    match_shard = shard
+
+def score_match_shard(version, queries):
+    """Runs in a worker process: score queries against that worker's shard of the catalog.
+
+    Returns the rankings, in shard-local positions, and the number of candidates scored, which the server adds
+    to its own metrics; None when the worker holds another catalog version than the request."""
+    if match_shard is None or match_shard.version != version:
+        return None
+    profile = new_request_profile()
+    request_profile.set(profile)
+    return score_products(queries, catalog=match_shard), profile['candidates_scored']
+
+def update_match_shard(version, new_version, changes):
+    """Runs in a worker process: apply a delta's changes, from split_catalog_changes, to the shard in place.
+
+    Returns False, changing nothing, when the worker holds another version than the one the delta was applied to."""
+    if match_shard is None or match_shard.version != version:
+        return False
+    # Positions only ever grow by appending, so the changes come in position order and a new one is always the next
+    for position, values, deleted in changes:
+        set_product_features(match_shard, position, values)
+        if deleted:
+            remove_catalog_product(match_shard, position)
+    match_shard.version = new_version
+    return True
+
+def start_match_shards():
+    """Start one long-lived worker per shard, unless they are running already.
+
+    Workers are spawned rather than forked: a fork of the threaded server could copy a lock another thread holds."""
+    with match_shard_pools_lock:
+        if not match_shard_pools:
+            context = multiprocessing.get_context('spawn')
+            pools = [ProcessPoolExecutor(max_workers=1, mp_context=context) for _ in range(max(1, MATCH_SHARDS))]
+            # Start the workers now rather than on the first query
+            for future in [pool.submit(os.getpid) for pool in pools]:
+                future.result()
+            match_shard_pools.extend(pools)
+            logger.info("Started %s matching shard workers", len(pools))
+        return list(match_shard_pools)
+
+def get_match_shards(catalog):
+    """The shard worker pools, holding catalog; sends it to them first when they hold another version, as just
+    a delta's changes when they hold the version the delta was applied to.
+
+    Returns an empty list once a reload has replaced catalog."""
+    global match_shard_version
+    with match_shard_pools_lock:
+        if catalog is not current_catalog:
+            return []
+        pools = start_match_shards()
+        if match_shard_version != catalog.version:
+            updated = False
+            if catalog.changes is not None and catalog.changes[0] == match_shard_version:
+                # The workers hold the version this delta was applied to: send just the products it changed
+                shard_changes = split_catalog_changes(catalog, len(pools))
+                futures = [pool.submit(update_match_shard, match_shard_version, catalog.version, changes)
+                           for pool, changes in zip(pools, shard_changes)]
+                updated = all([future.result() for future in futures])
+            if not updated:
+                shards = split_catalog(catalog, len(pools))
+                for future in [pool.submit(set_match_shard, shard) for pool, shard in zip(pools, shards)]:
+                    future.result()
+                logger.info("Sent catalog version %s to %s matching shard workers", catalog.version, len(pools))
+            match_shard_version = catalog.version
+        return pools
+
+def stop_match_shards(cancel_futures=True):
+    """Shut down the shard workers; the next sharded query starts new ones."""
+    global match_shard_version
+    with match_shard_pools_lock:
+        for pool in match_shard_pools:
+            pool.shutdown(wait=False, cancel_futures=cancel_futures)
+        match_shard_pools.clear()
+        match_shard_version = None
+
+def score_products_sharded(queries, catalog=None):
+    """score_products split across the shard worker processes, with the per-shard rankings merged back into one.
+
+    Each shard ranks its own products best first with ties in catalog order, so merging on (score, position)
+    gives exactly the ranking of a single pass over the whole catalog."""
+    catalog = catalog or current_catalog
+    try:
+        pools = get_match_shards(catalog)
+        if not pools:
+            # The catalog was reloaded since this request started
+            return score_products(queries, catalog=catalog)
+        futures = [pool.submit(score_match_shard, catalog.version, queries) for pool in pools]
+        shard_rankings = []
+        for shard_number, future in enumerate(futures):
+            result = future.result()
+            if result is None:
+                # A delta or reload reached the workers since this request started
+                return score_products(queries, catalog=catalog)
+            ranked, candidates_scored = result
+            shard_rankings.append([[(local_position * len(pools) + shard_number, score) for local_position, score in query_ranked]
+                                   for query_ranked in ranked])
+            record_candidates_scored(candidates_scored, catalog)
+    except BrokenProcessPool as e:
+        logger.warning("Matching shard worker died (%s), scoring in-process", e)
+        stop_match_shards()
+        return score_products(queries, catalog=catalog)
+    except RuntimeError:
+        # stop_match_shards shut these workers down between get_match_shards and submit
+        return score_products(queries, catalog=catalog)
+
+    return [list(heapq.merge(*(ranked[query_number] for ranked in shard_rankings), key=lambda item: (-item[1], item[0])))
+            for query_number in range(len(queries))]
+
+def get_numpy_features(catalog):
+    """Return the NumPy views of a catalog, building them on first use."""
+    if not catalog.numpy_features:
+        catalog.numpy_features = build_numpy_features(catalog.product_features)
+    return catalog.numpy_features
+
+def patch_numpy_features(features, positions, product_count):
+    """The NumPy views of a catalog a delta changed at positions, reusing those of the version it was applied to.
+
+    The arrays are shared rather than written: requests on that version may still be reading them. Instead the
+    positions go into 'patched', whose products score_products_numpy scores from the feature columns. Once they
+    pass a sixteenth of the catalog the views are dropped, to be rebuilt on next use."""
+    if not features or not positions:
+        return features
+    patched = np.union1d(features['patched'], np.fromiter(positions, dtype=np.int64, count=len(positions)))
+    if len(patched) > product_count // 16:
+        return {}
+    return dict(features, patched=patched)
+
+def build_numpy_features(product_features):
+    """Build typed arrays of per-product features plus the lookup structures the vectorized scorer needs."""
+    names_lower = list(product_features['name_lower'])
+    product_count = len(names_lower)
+
+    # Names in sorted order turn the prefix bonus into two binary searches
+    name_order = sorted(range(product_count), key=names_lower.__getitem__)
+
+    # Positions where a word only appears glued to punctuation, for the exact-word rule (Score 6)
+    loose_index = defaultdict(list)
+    for position, loose_words in enumerate(product_features['loose_words']):
+        if loose_words is not None:
+            for word in loose_words:
+                loose_index[word].append(position)
+
+    return {
+        'word_count': np.fromiter(map(len, product_features['words']), dtype=np.int64, count=product_count),
+        'trusted_brand': np.fromiter(product_features['trusted_brand'], dtype=bool, count=product_count),
+        'processed': np.fromiter(product_features['processed'], dtype=bool, count=product_count),
+        'ultra_processed': np.fromiter(product_features['ultra_processed'], dtype=bool, count=product_count),
+        'sorted_names': [names_lower[position] for position in name_order],
+        'name_order': np.array(name_order, dtype=np.int64),
+        'loose_index': {word: np.array(positions, dtype=np.int64) for word, positions in loose_index.items()},
+        # Positions changed by deltas since these arrays were built; see patch_numpy_features
+        'patched': np.empty(0, dtype=np.int64),
+        'postings': {}
+    }
+
+def get_posting_array(features, word, catalog):
+    """Positions of the products containing a word as an int array, converted from product_index once per word.
+
+    The conversions are shared by the versions deltas make, and each is kept with the posting list it was
+    made from: a delta replaces the posting lists it changes, so a conversion is reused only while its list is."""
+    postings = catalog.product_index.get(word)
+    cached = features['postings'].get(word)
+    if cached is None or cached[0] is not postings:
+        cached = (postings, np.fromiter(postings or (), dtype=np.int64, count=len(postings or ())))
+        features['postings'][word] = cached
+    return cached[1]
 
+def get_prefix_positions(features, prefix):
+    """Positions of the products whose lowercased name starts with prefix."""
+    sorted_names = features['sorted_names']
+    start = bisect_left(sorted_names, prefix)
+    # Every name that starts with prefix sorts before prefix with its last character bumped by one
+    end = bisect_left(sorted_names, prefix[:-1] + chr(ord(prefix[-1]) + 1)) if ord(prefix[-1]) < sys.maxunicode else len(sorted_names)
+    return features['name_order'][start:end]
+
+def score_products_numpy(ingredient_clean, ingredient_words, catalog=None):
+    """Vectorized score_products for one ingredient: scores all its candidates at once with the same formula and ordering."""
+    if not ingredient_words:
+        return []
+
+    catalog = catalog or current_catalog
+    features = get_numpy_features(catalog)
+    ingredient_word_count = len(ingredient_words)
+    is_basic_ingredient, main_ingredient, exceptions, allows_ultra_processed = describe_ingredient(ingredient_clean, ingredient_words)
+
+    # Candidates and how many ingredient words each one contains (the sparse token-matrix product)
+    if ingredient_word_count == 1:
+        candidates = get_posting_array(features, main_ingredient, catalog)
+        words_found = np.ones(len(candidates), dtype=np.int64)
+    else:
+        postings = [get_posting_array(features, word, catalog) for word in ingredient_words]
+        candidates, words_found = np.unique(np.concatenate(postings), return_counts=True)
+    record_candidates_scored(len(candidates), catalog)
+
+    # Products changed by deltas since the arrays were built are scored from the feature columns instead
+    patched_candidates = []
+    if len(features['patched']):
+        patched = np.isin(candidates, features['patched'])
+        if patched.any():
+            patched_candidates = candidates[patched].tolist()
+            candidates, words_found = candidates[~patched], words_found[~patched]
+
+    if ingredient_word_count == 1:
         # Score 6: Exact word match requirement for single-word ingredients
-        if len(ingredient_words) == 1:
-            main_word = list(ingredient_words)[0]
-            # Must be an exact word match, not just a substring
-            if main_word not in product_name_lower.split():
-                continue
-        
-        # Score 7: Advanced filtering for multi-word ingredients
-        if len(ingredient_words) > 1:
-            # For multi-word ingredients, ensure at least 70% of words match
-            word_match_ratio = words_found / len(ingredient_words)
-            if word_match_ratio < 0.7:
-                continue
-                
-        # Score 8: Prioritize simpler products over complex ones
-        simplicity_bonus = 1.0
-        if len(product_words) <= 3:  # Simple products get bonus
-            simplicity_bonus = 1.3
-        elif len(product_words) <= 5:  # Medium complexity
-            simplicity_bonus = 1.1
-        elif len(product_words) > 8:  # Very complex products get penalty
-            simplicity_bonus = 0.6
-
-        # Score 9: Brand consistency bonus
-        brand_bonus = 1.0
-        product_brand = product.get('brand', '').lower()
-        if product_brand:
-            # Bonus for well-known, trusted brands for basic ingredients
-            trusted_brands = {
-                'great value', 'marketside', 'equate', 'morton', 'domino', 'crisco',
-                'heinz', 'hellmann', 'best foods', 'mccormick', 'king arthur',
-                'land o lakes', 'philadelphia', 'kraft', 'hunts'
-            }
-            if any(brand in product_brand for brand in trusted_brands):
-                brand_bonus = 1.15
-
-        # Score 10: Prevent overly processed alternatives
+        loose_positions = features['loose_index'].get(main_ingredient)
+        if loose_positions is not None:
+            keep = ~np.isin(candidates, loose_positions)
+            candidates, words_found = candidates[keep], words_found[keep]
+    else:
+        # Score 7: at least 70% of the words of a multi-word ingredient must match
+        keep = words_found >= min_words_found(ingredient_word_count)
+        candidates, words_found = candidates[keep], words_found[keep]
+
+    # Score 5: basic ingredients skip processed foods unless an exception applies
+    if is_basic_ingredient and len(candidates):
+        processed = features['processed'][candidates]
+        if processed.any():
+            keep = ~processed
+            names_lower = catalog.product_features['name_lower']
+            for i in np.flatnonzero(processed):
+                product_name_lower = names_lower[candidates[i]]
+                keep[i] = any(exception in product_name_lower for exception in exceptions)
+            candidates, words_found = candidates[keep], words_found[keep]
+
+    if not len(candidates) and not patched_candidates:
+        return []
+
+    word_count = features['word_count'][candidates]
+
+    # Scores 1-3: Jaccard similarity, coverage and extra-word penalty
+    jaccard_score = words_found / (ingredient_word_count + word_count - words_found)
+    coverage_score = words_found / ingredient_word_count
+    penalty_score = np.maximum(0, np.where(word_count > ingredient_word_count,
+                                           1 - ((word_count - ingredient_word_count) / word_count), 1.0))
+
+    # Scores 4, 8, 9 and 10: prefix, simplicity, brand and ultra-processed multipliers
+    prefix_bonus = np.where(np.isin(candidates, get_prefix_positions(features, ingredient_clean)), 1.3, 1.0)
+    simplicity_bonus = np.select([word_count <= 3, word_count <= 5, word_count > 8], [1.3, 1.1, 0.6], 1.0)
+    brand_bonus = np.where(features['trusted_brand'][candidates], 1.15, 1.0)
+    if allows_ultra_processed:
         ultra_processed_penalty = 1.0
-        ultra_processed_keywords = {
-            'instant', 'microwaveable', 'ready to eat', 'pre-cooked', 'just add water',
-            'artificial', 'imitation', 'substitute', 'replacement', 'alternative'
-        }
-        if any(keyword in product_name_lower for keyword in ultra_processed_keywords):
-            # Only allow if the ingredient itself suggests processed food
-            if not any(proc in ingredient_clean for proc in ['instant', 'ready', 'quick']):
-                ultra_processed_penalty = 0.3  # Heavy penalty
+    else:
+        ultra_processed_penalty = np.where(features['ultra_processed'][candidates], 0.3, 1.0)
 
-        # Combine scores with enhanced weighting
-        final_score = ((jaccard_score * 0.25) + (coverage_score * 0.55) + (penalty_score * 0.2)) * prefix_bonus * simplicity_bonus * brand_bonus * ultra_processed_penalty
+    final_score = ((jaccard_score * 0.25) + (coverage_score * 0.55) + (penalty_score * 0.2)) * prefix_bonus * simplicity_bonus * brand_bonus * ultra_processed_penalty
 
-        # Higher threshold for better quality matches with stricter filtering
-        if final_score > 0.5:
-            product_scores.append((product, final_score))
-            
-    product_scores.sort(key=lambda x: x[1], reverse=True)
-    
-    # Additional deduplication within this ingredient's results
-    final_products = []
+    above_threshold = final_score > 0.5
+    candidates, final_score = candidates[above_threshold], final_score[above_threshold]
+
+    # Stable sort keeps catalog order between equal scores, like list.sort in score_products
+    order = np.argsort(-final_score, kind='stable')
+    ranked = list(zip(candidates[order].tolist(), final_score[order].tolist()))
+    if patched_candidates:
+        profile = (ingredient_clean, ingredient_words, ingredient_word_count, is_basic_ingredient, main_ingredient, exceptions, allows_ultra_processed)
+        patched_ranked = score_candidates([profile], ((position, [0]) for position in patched_candidates), catalog)[0]
+        ranked = list(heapq.merge(ranked, patched_ranked, key=lambda item: (-item[1], item[0])))
+    return ranked
+
+def select_distinct_products(product_scores, top_n=3, catalog=None):
+    """Pick up to top_n positions from ranked (position, score) pairs, skipping near-duplicates of products already picked."""
+    product_features = (catalog or current_catalog).product_features
+    signatures = product_features['signature']
+    similarity_names = product_features['similarity_name']
+    similarity_brands = product_features['similarity_brand']
+    final_positions = []
     seen_signatures = set()
     
-    for product, score in product_scores:
-        signature = create_product_signature(product)
+    for position, score in product_scores:
+        signature = signatures[position]
         if signature not in seen_signatures:
-            final_products.append(product)
+            final_positions.append(position)
             seen_signatures.add(signature)
             
             # Also check for similarity with already selected products
             is_too_similar = False
-            for existing_product in final_products[:-1]:  # Don't compare with itself
-                if are_products_similar(product, existing_product, similarity_threshold=0.8):
+            for existing_position in final_positions[:-1]:  # Don't compare with itself
+                if are_names_similar(similarity_names[position], similarity_brands[position],
+                                     similarity_names[existing_position], similarity_brands[existing_position],
+                                     similarity_threshold=0.8):
                     is_too_similar = True
                     break
             
             if is_too_similar:
-                final_products.pop()  # Remove the similar product
+                final_positions.pop()  # Remove the similar product
                 seen_signatures.remove(signature)
         
-        if len(final_products) >= top_n:
+        if len(final_positions) >= top_n:
             break
     
-    return final_products
+    return final_positions
 
 def create_product_signature(product):
     """Create a unique signature for a product to detect near-duplicates using multiple similarity metrics."""
@@ -296,23 +2049,28 @@ def create_product_signature(product):
     
     return final_signature
 
+@lru_cache(maxsize=8192)
+def normalize_similarity_name(name):
+    """Lowercase a product name, turn punctuation into spaces and collapse whitespace for similarity checks."""
+    name = re.sub(r'[^\w\s]', ' ', name.lower())
+    return re.sub(r'\s+', ' ', name).strip()
+
 def are_products_similar(product1, product2, similarity_threshold=0.85):
     """Check if two products are likely the same using advanced similarity metrics."""
-    
-    # Get product names and clean them
-    name1 = re.sub(r'[^\w\s]', ' ', product1.get('name', '').lower())
-    name2 = re.sub(r'[^\w\s]', ' ', product2.get('name', '').lower())
-    name1 = re.sub(r'\s+', ' ', name1).strip()
-    name2 = re.sub(r'\s+', ' ', name2).strip()
+    return are_names_similar(
+        normalize_similarity_name(product1.get('name', '')), product1.get('brand', '').lower().strip(),
+        normalize_similarity_name(product2.get('name', '')), product2.get('brand', '').lower().strip(),
+        similarity_threshold=similarity_threshold
+    )
+
+def are_names_similar(name1, brand1, name2, brand2, similarity_threshold=0.85):
+    """Compare two normalized product names and lowercased brands; see are_products_similar."""
     
     # Exact name match
     if name1 == name2:
         return True
     
     # Brand and core name comparison
-    brand1 = product1.get('brand', '').lower().strip()
-    brand2 = product2.get('brand', '').lower().strip()
-    
     if brand1 and brand2 and brand1 == brand2:
         # Same brand, check name similarity
         words1 = set(name1.split())
@@ -327,35 +2085,76 @@ def are_products_similar(product1, product2, similarity_threshold=0.85):
                 return True
     
     # Levenshtein distance for very similar names
-    def levenshtein_distance(s1, s2):
-        if len(s1) < len(s2):
-            return levenshtein_distance(s2, s1)
-        if len(s2) == 0:
-            return len(s1)
-        
-        previous_row = list(range(len(s2) + 1))
-        for i, c1 in enumerate(s1):
-            current_row = [i + 1]
-            for j, c2 in enumerate(s2):
-                insertions = previous_row[j + 1] + 1
-                deletions = current_row[j] + 1
-                substitutions = previous_row[j] + (c1 != c2)
-                current_row.append(min(insertions, deletions, substitutions))
-            previous_row = current_row
-        
-        return previous_row[-1]
-    
-    # Calculate string similarity
     max_len = max(len(name1), len(name2))
     if max_len > 0:
-        distance = levenshtein_distance(name1, name2)
-        string_similarity = 1 - (distance / max_len)
-        
-        if string_similarity >= similarity_threshold:
+        # string_similarity = 1 - distance / max_len, so only distances up to this bound can pass
+        max_distance = max_similar_edit_distance(max_len, similarity_threshold)
+        if max_distance >= 0 and is_edit_distance_within(name1, name2, max_distance):
             return True
     
     return False
 
+@lru_cache(maxsize=None)
+def max_similar_edit_distance(max_len, similarity_threshold):
+    """Largest edit distance whose string similarity (1 - distance / max_len) still reaches the threshold, or -1 if none does."""
+    distance = -1
+    while distance < max_len and 1 - ((distance + 1) / max_len) >= similarity_threshold:
+        distance += 1
+    return distance
+
+def is_edit_distance_within(s1, s2, max_distance):
+    """Check whether the Levenshtein distance between two strings is at most max_distance.
+
+    Only the diagonal band of the distance matrix that can stay within max_distance is filled,
+    and the scan stops as soon as a whole row exceeds it."""
+    if len(s1) < len(s2):
+        s1, s2 = s2, s1
+    # The length difference alone is a lower bound on the distance
+    if len(s1) - len(s2) > max_distance:
+        return False
+    if not s2:
+        return True
+
+    # Cells are capped at max_distance + 1; anything above that can't lead back under the bound
+    out_of_reach = max_distance + 1
+    len2 = len(s2)
+    previous_row = [j if j <= max_distance else out_of_reach for j in range(len2 + 1)]
+    for i, c1 in enumerate(s1, 1):
+        current_row = [out_of_reach] * (len2 + 1)
+        if i <= max_distance:
+            current_row[0] = i
+        row_min = current_row[0]
+        for j in range(max(1, i - max_distance), min(len2, i + max_distance) + 1):
+            substitutions = previous_row[j - 1] + (c1 != s2[j - 1])
+            insertions = previous_row[j] + 1
+            deletions = current_row[j - 1] + 1
+            distance = min(insertions, deletions, substitutions, out_of_reach)
+            current_row[j] = distance
+            if distance < row_min:
+                row_min = distance
+        if row_min > max_distance:
+            return False
+        previous_row = current_row
+
+    return previous_row[len2] <= max_distance
+
+# Introductions Ollama puts before the list, stripped from the start of the answer in this order
+INGREDIENT_INTRO_PATTERNS = [
+    re.compile(r'\s*(?:Sure,?\s*)?(?:Here are the ingredients for|The ingredients for|Ingredients for|For|To make).*?(?::|are|include)', re.IGNORECASE),
+    re.compile(r'\s*(?:Sure,?\s*)?here are.*?:', re.IGNORECASE),
+    re.compile(r'\s*Sure,?\s*', re.IGNORECASE),
+    re.compile(r'\*+\s*')
+]
+
+# Lines that are more introduction ("Sure", "Here are...", "For a pizza you need") rather than ingredients
+INTRO_LINE_PATTERN = re.compile(r'sure$|(?:here are|the ingredients|for|to make)', re.IGNORECASE)
+
+# List markers ("1.", "-", "*", "•", "2)") and then a lettered marker ("a)") in front of an ingredient
+LIST_MARKER_PATTERN = re.compile(r'[\d\.\-\*•\)\]]*\s*(?:[a-z]\)\s*)?')
+
+# Leftovers that aren't ingredients: punctuation only, or intro words
+NOT_AN_INGREDIENT_PATTERN = re.compile(r'[^\w]*$|sure$|(?:ingredients|for|here|the|are|include)', re.IGNORECASE)
+
 def extract_ingredients_from_text(text):
     """Extract ingredient list from AI response, handling various formats."""
     # If the AI is asking a question, return it as a single item.
@@ -363,189 +2162,722 @@ def extract_ingredients_from_text(text):
         return [text.strip()]
 
     # Remove common introductory phrases that aren't ingredients
-    text = re.sub(r'^\s*(?:Sure,?\s*)?(?:Here are the ingredients for|The ingredients for|Ingredients for|For|To make).*?(?::|are|include)', '', text, flags=re.IGNORECASE).strip()
-    text = re.sub(r'^\s*(?:Sure,?\s*)?here are.*?:', '', text, flags=re.IGNORECASE).strip()
-    text = re.sub(r'^\s*Sure,?\s*', '', text, flags=re.IGNORECASE).strip()  # Remove standalone "Sure"
-    text = re.sub(r'^\*+\s*', '', text).strip()
-    
-    # Split by both commas and newlines
-    lines = text.strip().split('\n')
-    all_ingredients = []
-    
-    for line in lines:
+    text = text.strip()
+    for pattern in INGREDIENT_INTRO_PATTERNS:
+        match = pattern.match(text)
+        if match:
+            text = text[match.end():].strip()
+
+    # One pass over the lines: each is split by commas, and each part loses its list marker and becomes
+    # one ingredient, or one per "/" alternative (e.g. "tomato sauce/pizza sauce")
+    final_ingredients = []
+    for line in text.split('\n'):
         line = line.strip()
         # Skip empty lines, "Sure" responses, or introductory text
-        if (not line or 
-            re.match(r'^(?:sure|here are|the ingredients|for|to make)$', line, re.IGNORECASE) or
-            re.match(r'^(?:here are|the ingredients|for|to make)', line, re.IGNORECASE)):
+        if not line or INTRO_LINE_PATTERN.match(line):
             continue
-            
-        # Split by comma and clean up each potential ingredient
-        if ',' in line:
-            ingredients = [ing.strip() for ing in line.split(',') if ing.strip()]
-        else:
-            # If no comma, treat the whole line as one ingredient
-            ingredients = [line] if line else []
-            
-        all_ingredients.extend(ingredients)
-    
-    final_ingredients = []
-    for ingredient in all_ingredients:
-        # Remove any lingering list markers, numbers, or formatting
-        cleaned_ingredient = re.sub(r'^[\d\.\-\*•\)\]]+\s*', '', ingredient).strip()
-        cleaned_ingredient = re.sub(r'^[a-z]\)\s*', '', cleaned_ingredient).strip()  # Remove "a)" style
-        
-        # Handle "/" separators within ingredients (e.g., "tomato sauce/pizza sauce")
-        if '/' in cleaned_ingredient:
-            # Split by "/" and add each alternative as a separate ingredient
-            alternatives = [alt.strip() for alt in cleaned_ingredient.split('/') if alt.strip()]
-            final_ingredients.extend(alternatives)
-        else:
-            # Skip if it's too short, contains only punctuation, looks like intro text, or is just "Sure"
-            if (cleaned_ingredient and len(cleaned_ingredient) > 2 and 
-                not re.match(r'^[^\w]*$', cleaned_ingredient) and
-                not re.match(r'^(?:sure|ingredients|for|here|the|are|include)$', cleaned_ingredient, re.IGNORECASE) and
-                not re.match(r'^(?:ingredients|for|here|the|are|include)', cleaned_ingredient, re.IGNORECASE)):
+
+        for ingredient in line.split(',') if ',' in line else (line,):
+            ingredient = ingredient.strip()
+            if not ingredient:
+                continue
+            cleaned_ingredient = ingredient[LIST_MARKER_PATTERN.match(ingredient).end():]
+
+            if '/' in cleaned_ingredient:
+                final_ingredients.extend(alt.strip() for alt in cleaned_ingredient.split('/') if alt.strip())
+            # Skip if it's too short, contains only punctuation, or looks like intro text
+            elif len(cleaned_ingredient) > 2 and not NOT_AN_INGREDIENT_PATTERN.match(cleaned_ingredient):
                 final_ingredients.append(cleaned_ingredient)
-            
+
     return final_ingredients
 
-def extract_dish_name_from_prompt(prompt):
-    """Extracts the dish name from a user prompt if it's a recipe-related question."""
-    prompt_lower = prompt.lower().strip()
+def extract_complete_ingredients(text):
+    """Ingredients of a partial Ollama answer up to its last comma or newline, as the whole answer should parse them.
+
+    None while that can still change: the answer may yet be a short question, or an intro phrase may still be
+    waiting for its ':', 'are' or 'include' on an unfinished line."""
+    end = max(text.rfind(','), text.rfind('\n'))
+    if end < 0:
+        return None
+    text = text[:end + 1]
+    if '?' in text and len(text.split()) < 20:
+        return None
+
+    rest = text.lstrip()
+    for pattern in INGREDIENT_INTRO_PATTERNS:
+        match = pattern.match(rest)
+        if match:
+            rest = rest[match.end():].lstrip()
+        elif pattern.match(rest + ':'):
+            return None
+    return extract_ingredients_from_text(text)
+
+# "how to make paella", "what is a good lasagna recipe": the words after the question lead-in name the dish
+DISH_QUESTION_PATTERN = re.compile(r'(?:what|which|how to|how to make|how to cook|what is|what are|how to prepare|how to prepare a|how to prepare a )([a-zA-Z\s]+)(?: recipe| dish| meal| food| dish| meal| food)?')
+
+def extract_dish_name_from_prompt(prompt):
+    """Extracts the dish name from a user prompt if it's a recipe-related question."""
+    prompt_lower = prompt.lower().strip()
+    
+    # If the prompt is just a dish name (1-4 words), use it directly
+    words = prompt_lower.split()
+    if len(words) <= 4 and not any(word in prompt_lower for word in ['how', 'what', 'recipe', 'ingredients', 'make', 'cook']):
+        return prompt_lower.title()
+    
+    # Check for common recipe-related phrases
+    if 'recipe' in prompt_lower or 'cook' in prompt_lower or 'make' in prompt_lower:
+        dish_match = DISH_QUESTION_PATTERN.search(prompt_lower)
+        if dish_match:
+            return dish_match.group(1).strip().title()
+    
+    # Fallback: if it's a short prompt (likely a dish name), use it
+    if len(prompt_lower) <= 50 and not any(word in prompt_lower for word in ['how', 'what', 'recipe', 'ingredients', 'make', 'cook', 'weather', 'time', 'date']):
+        return prompt_lower.title()
+            
+    return None
+
+def build_system_prompt(mode, scanned_ingredients):
+    """Pick the system prompt for the chat mode: a recipe built around scanned ingredients, or a bare ingredient list."""
+    if mode == 'recipe' and scanned_ingredients:
+        # Recipe mode with scanned ingredients
+        ingredients_list = ', '.join(scanned_ingredients)
+        return f"""You are a professional chef and recipe creator. The user has scanned these ingredients using their phone: {ingredients_list}
+
+Your task is to create recipes using PRIMARILY the scanned ingredients they have. Always prioritize using their scanned ingredients as the main components.
+
+Guidelines:
+- Create complete, detailed recipes that prominently feature their scanned ingredients
+- Include cooking instructions, prep time, and serving size
+- You may suggest 1-2 common pantry items (salt, pepper, oil, etc.) if needed to complete the recipe
+- If they ask for a specific dish, adapt it to use their scanned ingredients creatively
+- Be encouraging and explain how their scanned ingredients work well together
+- Format your response clearly with ingredients list and step-by-step instructions
+always give a full recipe even though not all ingredients are used, just make sure to use the scanned ingredients as much as possible
+Respond naturally and conversationally, but focus on practical, cookable recipes."""
+
+    # Normal mode - strict ingredient list only
+    return """You are a cooking ingredient generator. Your ONLY task is to output a comma-separated list of ingredients for the requested dish.
+
+CRITICAL RULES:
+1. Output ONLY ingredients, nothing else
+2. No introductory text, no explanations, no questions
+3. No "Here are the ingredients:", no "You'll need:", no prefixes
+4. No cooking instructions, no measurements, no descriptions
+5. Format: ingredient1, ingredient2, ingredient3   no parentheses, just pure ingredients, output all the necessary ingredients, no more, no less
+6. Use "/" instead of "or" when listing alternatives (e.g., "tomato sauce/pizza sauce", "basil/oregano")
+7.  really try to figure it out because some dishes are traditional and you might know them, and if you can't, output: "Unknown dish"
+NEVER EVER REPEAT THE SAME INGREDIENT MORE THAN ONCE IN THE RECIPE
+8. If the request is not food-related, output: "Not a cooking request"
+
+EXAMPLES:
+Input: "pizza"
+Output: Pizza dough, tomato sauce/pizza sauce, mozzarella cheese, olive oil, basil/oregano, garlic
+
+Input: "chocolate chip cookies"  
+Output: All-purpose flour, butter, brown sugar/white sugar, eggs, vanilla extract, baking soda, salt, chocolate chips
+
+Input: "beef stir fry"
+Output: Beef strips, soy sauce, garlic, ginger, bell peppers/onion, broccoli, vegetable oil, cornstarch, sesame oil
+
+Input: "what's the weather"
+Output: Not a cooking request
+
+Remember: ONLY the ingredient list, nothing more. Use "/" for alternatives, not "or"."""
+
+class ChatCache:
+    """SQLite-backed cache of Ollama answers by request key, with per-entry expiry and least-recently-used eviction."""
+
+    def __init__(self, path, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS completions ('
+                'key TEXT PRIMARY KEY, response TEXT NOT NULL, expires_at REAL, used_at REAL)'
+            )
+            self._connection.execute('CREATE INDEX IF NOT EXISTS completions_used_at ON completions (used_at)')
+
+    def get(self, key):
+        """Return the cached answer for key, or None if it is absent or expired."""
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute('SELECT response, expires_at FROM completions WHERE key = ?', (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] < now):
+                return None
+            self._connection.execute('UPDATE completions SET used_at = ? WHERE key = ?', (now, key))
+        return row[0]
+
+    def put(self, key, response, ttl):
+        """Store an answer for ttl seconds (forever if ttl is None), then evict expired and least recently used answers."""
+        now = time.time()
+        expires_at = None if ttl is None else now + ttl
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO completions (key, response, expires_at, used_at) VALUES (?, ?, ?, ?)',
+                (key, response, expires_at, now)
+            )
+            if self._connection.execute('SELECT COUNT(*) FROM completions').fetchone()[0] > self.max_entries:
+                self._connection.execute('DELETE FROM completions WHERE expires_at < ?', (now,))
+                self._connection.execute(
+                    'DELETE FROM completions WHERE key IN ('
+                    'SELECT key FROM completions ORDER BY used_at DESC LIMIT -1 OFFSET ?)', (self.max_entries,)
+                )
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM completions').fetchone()[0]
+
+def open_chat_cache():
+    """Open the persistent chat cache, or return None if it is disabled or can't be opened."""
+    if CHAT_CACHE_MAX_ENTRIES <= 0:
+        return None
+    try:
+        return ChatCache(CHAT_CACHE_PATH, CHAT_CACHE_MAX_ENTRIES)
+    except sqlite3.Error as e:
+        logger.warning("Chat cache unavailable, answers won't be cached: %s", e)
+        return None
+
+chat_cache = open_chat_cache()
+
+def chat_cache_key(model_name, mode, user_prompt, system_prompt, options):
+    """Cache key of a chat: model, mode, case- and whitespace-normalized prompt, system prompt hash and sampling options."""
+    normalized_prompt = ' '.join(user_prompt.lower().split())
+    system_prompt_hash = hashlib.sha256(system_prompt.encode('utf-8')).hexdigest()
+    key = json.dumps([model_name, mode, normalized_prompt, system_prompt_hash, options], sort_keys=True)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+def get_cached_chat(cache_key):
+    """Look up a chat answer in the cache, counting the hit or miss; None if absent or uncacheable."""
+    if cache_key is None or chat_cache is None:
+        return None
+    try:
+        cached = chat_cache.get(cache_key)
+    except sqlite3.Error as e:
+        logger.warning("Chat cache lookup failed: %s", e)
+        return None
+    metrics.inc('cooker_chat_cache_lookups_total', result='miss' if cached is None else 'hit')
+    return cached
+
+def cache_chat_response(cache_key, response):
+    """Remember a complete, non-empty chat answer in the persistent chat cache."""
+    if cache_key is None or chat_cache is None or not response:
+        return
+    try:
+        chat_cache.put(cache_key, response, CHAT_CACHE_TTL)
+    except sqlite3.Error as e:
+        logger.warning("Could not cache chat answer: %s", e)
+
+def cached_chat_events(response, metadata):
+    """NDJSON events replaying a cached chat answer: the whole answer as one 'token' event, then 'done'."""
+    yield json.dumps({'type': 'token', 'token': response}) + '\n'
+    yield json.dumps({'type': 'done', 'response': response, 'cached': True, **metadata}) + '\n'
+
+def stream_ollama_tokens(ollama_response):
+    """Yield the text chunks of a streaming Ollama /api/generate response as they arrive."""
+    for line in ollama_response.iter_lines():
+        if not line:
+            continue
+        token, done = parse_ollama_chunk(line)
+        if token:
+            yield token
+        if done:
+            break
+
+def parse_ollama_chunk(line):
+    """Decode one NDJSON line of a streaming Ollama response into (text, done), raising ValueError on an error chunk."""
+    chunk = json.loads(line)
+    if chunk.get('error'):
+        raise ValueError(chunk['error'])
+    return chunk.get('response', ''), bool(chunk.get('done'))
+
+class GenerationRejected(Exception):
+    """An Ollama generation turned away: status is 429 when the queue is full, 503 when its wait timed out."""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class GenerationScheduler:
+    """Admission control for Ollama: at most `limit` generations run at once and at most `max_queue` wait.
+
+    Waiting generations are admitted by kind, 'normal' ingredient lists before 'recipe' generations, then in
+    arrival order. A waiter is only an entry in the queue: it holds no thread, and its wake callback starts the
+    generation once a slot is free, from whichever thread or event loop freed it."""
+
+    PRIORITIES = {'normal': 0, 'recipe': 1}
+
+    def __init__(self, limit, max_queue):
+        self.limit = limit
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._running = 0
+        self._queue = []  # heap of (priority, arrival, waiter)
+        self._arrivals = itertools.count()
+
+    def join(self, kind, wake):
+        """Take a free slot (returns None) or queue for one (returns the waiter), raising GenerationRejected if full.
+
+        wake() is called, from whichever thread frees the slot, once a queued waiter is admitted."""
+        with self._lock:
+            if self._running < self.limit and not self._queue:
+                self._running += 1
+            elif len(self._queue) < self.max_queue:
+                waiter = {'kind': kind, 'wake': wake, 'state': 'queued', 'queued_at': time.perf_counter()}
+                heapq.heappush(self._queue, (self.PRIORITIES[kind], next(self._arrivals), waiter))
+                return waiter
+            else:
+                raise self.reject(kind, 429, 'Too many requests are waiting for Ollama, try again shortly')
+        metrics.observe('cooker_ollama_queue_wait_seconds', 0, kind=kind)
+        return None
+
+    def expire(self, waiter):
+        """Give up on a waiter whose wait timed out, raising GenerationRejected unless it left the queue meanwhile."""
+        if self.cancel(waiter):
+            raise self.reject(waiter['kind'], 503, 'Ollama is busy, try again later')
+
+    def cancel(self, waiter):
+        """Remove a waiter from the queue; False if it was admitted or removed already."""
+        with self._lock:
+            if waiter['state'] != 'queued':
+                return False
+            waiter['state'] = 'removed'
+            self._queue = [entry for entry in self._queue if entry[2] is not waiter]
+            heapq.heapify(self._queue)
+            return True
+
+    def release(self):
+        """Free a slot, handing it straight to the first waiter in line if there is one."""
+        with self._lock:
+            if not self._queue:
+                self._running -= 1
+                return
+            waiter = heapq.heappop(self._queue)[2]
+            waiter['state'] = 'admitted'
+        metrics.observe('cooker_ollama_queue_wait_seconds', time.perf_counter() - waiter['queued_at'], kind=waiter['kind'])
+        waiter['wake']()
+
+    def reject(self, kind, status, message):
+        metrics.inc('cooker_ollama_rejections_total', kind=kind, status=str(status))
+        logger.warning("Turned away a %s generation with %s: %s", kind, status, message)
+        return GenerationRejected(status, message)
+
+    def stats(self):
+        """Generations running and, by kind, waiting."""
+        with self._lock:
+            queued = dict.fromkeys(self.PRIORITIES, 0)
+            for priority, arrival, waiter in self._queue:
+                queued[waiter['kind']] += 1
+            return {'running': self._running, 'queued': queued}
+
+generation_scheduler = GenerationScheduler(OLLAMA_MAX_CONCURRENCY, OLLAMA_MAX_QUEUE)
+
+def generation_kind(mode):
+    """Scheduler kind of a chat: short normal-mode ingredient lists go ahead of full recipes."""
+    return 'normal' if mode == 'normal' else 'recipe'
+
+class OllamaGeneration:
+    """One Ollama generation, shared by every identical chat request while it runs.
+
+    A runner appends Ollama's tokens; each request replays them from the first and then follows new ones.
+    Listeners are called from the runner's thread whenever the generation changes."""
+
+    def __init__(self, key, cache_key=None):
+        self.key = key
+        self.cache_key = cache_key
+        self.tokens = []
+        self.started = False  # Ollama accepted the request and is generating
+        self.finished = False
+        self.error = None
+        self.waiter = None  # its generation_scheduler waiter while it queued for a slot
+        self.followers = 0  # requests reading it; when the last one leaves early it is cancelled
+        self.cancelled = False
+        self.interrupt = None  # set by a runner that can stop sooner than at Ollama's next token
+        self._changed = threading.Condition()
+        self._listeners = []
+
+    def add_listener(self, listener):
+        with self._changed:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self._changed:
+            self._listeners.remove(listener)
+
+    def start(self):
+        with self._changed:
+            self.started = True
+            self._notify()
+
+    def append(self, token):
+        with self._changed:
+            self.tokens.append(token)
+            self._notify()
+
+    def finish(self, error=None):
+        with self._changed:
+            self.error = error
+            self.finished = True
+            self._notify()
+
+    def queue_time_left(self):
+        """Seconds until a generation still queued for a slot is turned away; None once it left the queue."""
+        waiter = self.waiter
+        if waiter is None or waiter['state'] != 'queued':
+            return None
+        return max(0, waiter['queued_at'] + OLLAMA_QUEUE_TIMEOUT - time.perf_counter())
+
+    def wait_started(self):
+        """Wait until Ollama is generating: False if it refused the request, raising the error that stopped it.
+
+        A generation still queued OLLAMA_QUEUE_TIMEOUT seconds after it arrived is turned away with a 503."""
+        while True:
+            with self._changed:
+                if self._changed.wait_for(lambda: self.started or self.finished, self.queue_time_left()):
+                    break
+            expire_ollama_generation(self)
+        if not self.started and self.error is not None:
+            raise self.error
+        return self.started
+
+    def follow(self):
+        """Yield every token from the first, waiting for new ones until the generation ends; re-raises its error."""
+        sent = 0
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: len(self.tokens) > sent or self.finished)
+                tokens, finished = self.tokens[sent:], self.finished
+            yield from tokens
+            sent += len(tokens)
+            if finished:
+                break
+        if self.error is not None:
+            raise self.error
+
+    def _notify(self):
+        self._changed.notify_all()
+        for listener in self._listeners:
+            listener()
+
+# Generation key -> OllamaGeneration in flight, so identical chats share one generation
+ollama_generations_in_flight = {}
+ollama_generations_lock = threading.Lock()
+
+def generation_key(payload):
+    """Identical Ollama requests share a key, whether their clients stream the answer or not."""
+    request_fields = {name: value for name, value in payload.items() if name != 'stream'}
+    return hashlib.sha256(json.dumps(request_fields, sort_keys=True).encode('utf-8')).hexdigest()
+
+def join_ollama_generation(payload, mode, cache_key=None, run=None):
+    """Follow the generation answering payload: the identical one in flight, or a new one queued for a slot.
+
+    run(generation, payload) starts a new generation once it has a slot, by default on a thread of its own; it
+    may be called from another request's thread. Every join is matched by a leave_ollama_generation, which
+    wait_for_ollama_generation and follow_ollama_generation take care of. Raises GenerationRejected at once
+    if the queue is full; a new generation's answer is cached under cache_key."""
+    run = run or start_ollama_generation_thread
+    key = generation_key(payload)
+    with ollama_generations_lock:
+        generation = ollama_generations_in_flight.get(key)
+        if generation is not None:
+            generation.followers += 1
+            metrics.inc('cooker_ollama_coalesced_total')
+            logger.debug("Joining in-flight generation %s", key[:12])
+            return generation
+        generation = OllamaGeneration(key, cache_key)
+        generation.waiter = generation_scheduler.join(generation_kind(mode), lambda: run(generation, payload))
+        generation.followers = 1
+        ollama_generations_in_flight[key] = generation
+
+    if generation.waiter is None:
+        run(generation, payload)
+    return generation
+
+def leave_ollama_generation(generation):
+    """A request stops following generation. Once none follows an unfinished one, it is dequeued or stopped."""
+    with ollama_generations_lock:
+        generation.followers -= 1
+        if generation.followers or generation.finished:
+            return
+        if ollama_generations_in_flight.get(generation.key) is generation:
+            del ollama_generations_in_flight[generation.key]
+        generation.cancelled = True
+
+    metrics.inc('cooker_ollama_cancelled_total')
+    logger.info("Cancelling generation %s, which no request follows any more", generation.key[:12])
+    if generation.waiter is not None and generation_scheduler.cancel(generation.waiter):
+        generation.finish()
+    elif generation.interrupt is not None:
+        generation.interrupt()
+
+def wait_for_ollama_generation(generation):
+    """generation.wait_started() for a request that joined it; a request that gets no answer leaves it again."""
+    try:
+        started = generation.wait_started()
+    except BaseException:
+        leave_ollama_generation(generation)
+        raise
+    if not started:
+        leave_ollama_generation(generation)
+    return started
+
+def follow_ollama_generation(generation):
+    """generation.follow() for a request that joined it, leaving once it has every token or stops reading."""
+    try:
+        yield from generation.follow()
+    finally:
+        leave_ollama_generation(generation)
+
+def expire_ollama_generation(generation):
+    """Turn away a generation whose wait for a slot timed out, unless it left the queue meanwhile."""
+    try:
+        generation_scheduler.expire(generation.waiter)
+    except GenerationRejected as e:
+        end_ollama_generation(generation, e)
+        raise
+
+def start_ollama_generation_thread(generation, payload):
+    threading.Thread(target=run_ollama_generation, args=(generation, payload), name='ollama-generation', daemon=True).start()
+
+def run_ollama_generation(generation, payload):
+    """Stream Ollama's answer into a generation that holds a slot, caching it once complete, then free the slot."""
+    error = None
+    try:
+        if generation.cancelled:
+            return
+        with ollama_session.post(OLLAMA_API_URL, json={**payload, 'stream': True}, stream=True, timeout=OLLAMA_TIMEOUT) as response:
+            if response.status_code != 200:
+                logger.error("Ollama answered with status %s", response.status_code)
+                return
+            generation.start()
+            for token in stream_ollama_tokens(response):
+                # Leaving the with block closes the connection, which makes Ollama stop generating
+                if generation.cancelled:
+                    return
+                generation.append(token)
+        cache_chat_response(generation.cache_key, ''.join(generation.tokens).strip())
+    except Exception as e:
+        logger.warning("Ollama generation failed: %s", e)
+        error = e
+    finally:
+        generation_scheduler.release()
+        end_ollama_generation(generation, error)
+
+def end_ollama_generation(generation, error=None):
+    """Finish a generation; requests arriving from now on start a new one, or find its answer in the chat cache."""
+    with ollama_generations_lock:
+        if ollama_generations_in_flight.get(generation.key) is generation:
+            del ollama_generations_in_flight[generation.key]
+    generation.finish(error)
+
+def stream_chat_events(tokens, metadata):
+    """NDJSON events for a streamed chat: one 'token' event per chunk, then 'done' with the full response and metadata."""
+    collected = []
+    try:
+        for token in tokens:
+            collected.append(token)
+            yield json.dumps({'type': 'token', 'token': token}) + '\n'
+    except (requests.RequestException, ValueError) as e:
+        logger.warning("Ollama stream error: %s", e)
+        yield json.dumps({'type': 'error', 'error': 'Ollama stopped responding mid-generation'}) + '\n'
+        return
+
+    response = ''.join(collected).strip()
+    yield json.dumps({'type': 'done', 'response': response, 'cached': False, **metadata}) + '\n'
+
+def prepare_chat(data):
+    """Turn a /api/chat request body into (ollama_payload, metadata, cache_key), or None if it has no prompt.
+
+    Only normal-mode chats, a bare ingredient list for a dish, get a cache key; recipe mode depends on the scanned items."""
+    user_prompt = data.get('prompt', '')
+    model_name = data.get('model', 'qwen2.5:7b')
+    mode = data.get('mode', 'normal')
+    scanned_ingredients = data.get('scanned_ingredients', [])
+
+    if not user_prompt:
+        return None
     
-    # If the prompt is just a dish name (1-4 words), use it directly
-    words = prompt_lower.split()
-    if len(words) <= 4 and not any(word in prompt_lower for word in ['how', 'what', 'recipe', 'ingredients', 'make', 'cook']):
-        return prompt_lower.title()
+    logger.info("Chat request - Mode: %s, Prompt: %s", mode, user_prompt)
+    if scanned_ingredients:
+        logger.debug("Scanned ingredients: %s", scanned_ingredients)
     
-    # Check for common recipe-related phrases
-    if 'recipe' in prompt_lower or 'cook' in prompt_lower or 'make' in prompt_lower:
-        # Look for a specific dish name, e.g., "pizza", "paella", "cake"
-        dish_match = re.search(r'(?:what|which|how to|how to make|how to cook|what is|what are|how to prepare|how to prepare a|how to prepare a )([a-zA-Z\s]+)(?: recipe| dish| meal| food| dish| meal| food)?', prompt_lower)
-        if dish_match:
-            return dish_match.group(1).strip().title()
-            
-        # Look for a general dish name, e.g., "chicken", "beef", "fish"
-        dish_match = re.search(r'(?:what|which|how to|how to make|how to cook|what is|what are|how to prepare|how to prepare a|how to prepare a )([a-zA-Z\s]+)(?: recipe| dish| meal| food| dish| meal| food)?', prompt_lower)
-        if dish_match:
-            return dish_match.group(1).strip().title()
-            
-        # Look for a specific dish name in a list, e.g., "pizza, chicken, salad"
-        dish_match = re.search(r'(?:what|which|how to|how to make|how to cook|what is|what are|how to prepare|how to prepare a|how to prepare a )([a-zA-Z\s]+)(?: recipe| dish| meal| food| dish| meal| food)?', prompt_lower)
-        if dish_match:
-            return dish_match.group(1).strip().title()
-            
-        # Look for a specific dish name in a list, e.g., "pizza, chicken, salad"
-        dish_match = re.search(r'(?:what|which|how to|how to make|how to cook|what is|what are|how to prepare|how to prepare a|how to prepare a )([a-zA-Z\s]+)(?: recipe| dish| meal| food| dish| meal| food)?', prompt_lower)
-        if dish_match:
-            return dish_match.group(1).strip().title()
-            
-        # Fallback if no specific dish name found, try to extract a general dish name
-        dish_match = re.search(r'(?:what|which|how to|how to make|how to cook|what is|what are|how to prepare|how to prepare a|how to prepare a )([a-zA-Z\s]+)(?: recipe| dish| meal| food| dish| meal| food)?', prompt_lower)
-        if dish_match:
-            return dish_match.group(1).strip().title()
+    system_prompt = build_system_prompt(mode, scanned_ingredients)
+    payload = {
+        'model': model_name,
+        'prompt': f"{system_prompt}\n\nUser: {user_prompt}\n\nAssistant:",
+        'stream': bool(data.get('stream', False))
+    }
+    cache_key = None
+    if mode == 'normal':
+        if CHAT_DETERMINISTIC:
+            payload['options'] = CHAT_DETERMINISTIC_OPTIONS
+        cache_key = chat_cache_key(model_name, mode, user_prompt, system_prompt, payload.get('options'))
+
+    # Extract dish name for shopping list (only in normal mode)
+    dish_name = None
+    if mode == 'normal':
+        dish_name = extract_dish_name_from_prompt(user_prompt)
     
-    # Fallback: if it's a short prompt (likely a dish name), use it
-    if len(prompt_lower) <= 50 and not any(word in prompt_lower for word in ['how', 'what', 'recipe', 'ingredients', 'make', 'cook', 'weather', 'time', 'date']):
-        return prompt_lower.title()
-            
-    return None
+    metadata = {
+        'dish_name': dish_name,
+        'mode': mode,
+        'scanned_ingredients_used': scanned_ingredients if mode == 'recipe' else []
+    }
+    return payload, metadata, cache_key
 
 @app.route('/api/chat', methods=['POST'])
 def chat():
     try:
-        data = request.get_json()
-        user_prompt = data.get('prompt', '')
-        model_name = data.get('model', 'qwen2.5:7b')
-        mode = data.get('mode', 'normal')
-        scanned_ingredients = data.get('scanned_ingredients', [])
-
-        if not user_prompt:
+        prepared = prepare_chat(request.get_json())
+        if prepared is None:
             return jsonify({'error': 'Prompt is required'}), 400
+        payload, metadata, cache_key = prepared
+        stream = payload['stream']
+
+        with timed_stage('chat_cache'):
+            cached = get_cached_chat(cache_key)
+        if cached is not None:
+            if stream:
+                return Response(cached_chat_events(cached, metadata), mimetype='application/x-ndjson')
+            return jsonify({'response': cached, 'cached': True, **metadata})
+
+        # Identical chats in flight share one generation; the wait for a slot is timed with the first chunk
+        generation = join_ollama_generation(payload, metadata['mode'], cache_key)
+        with timed_stage('ollama_first_chunk'):
+            started = wait_for_ollama_generation(generation)
+        if not started:
+            return jsonify({'error': 'Failed to get response from Ollama'}), 500
+
+        if stream:
+            # Relay tokens as NDJSON while Ollama generates them; the metadata follows in the final event
+            return Response(stream_chat_events(follow_ollama_generation(generation), metadata), mimetype='application/x-ndjson')
+
+        with timed_stage('ollama'):
+            ai_response = ''.join(follow_ollama_generation(generation)).strip()
         
-        print(f"Chat request - Mode: {mode}, Prompt: {user_prompt}")
-        if scanned_ingredients:
-            print(f"Scanned ingredients: {scanned_ingredients}")
+        return jsonify({'response': ai_response, 'cached': False, **metadata})
         
-        # Different system prompts based on mode
-        if mode == 'recipe' and scanned_ingredients:
-            # Recipe mode with scanned ingredients
-            ingredients_list = ', '.join(scanned_ingredients)
-            system_prompt = f"""You are a professional chef and recipe creator. The user has scanned these ingredients using their phone: {ingredients_list}
+    except GenerationRejected as e:
+        return jsonify({'error': str(e)}), e.status
+    except requests.RequestException as e:
+        logger.error("Ollama request error: %s", e)
+        return jsonify({'error': 'Failed to connect to Ollama. Make sure it\'s running.'}), 500
+    except Exception as e:
+        logger.error("Chat error: %s", e)
+        return jsonify({'error': f'Chat failed: {str(e)}'}), 500
 
-Your task is to create recipes using PRIMARILY the scanned ingredients they have. Always prioritize using their scanned ingredients as the main components.
+def recipe_cart_events(tokens, metadata, cached=False):
+    """NDJSON events for /api/recipe-cart, from the tokens of an Ollama generation or a cached answer."""
+    cart = RecipeCartStream(metadata, cached)
+    try:
+        for token in tokens:
+            yield from cart.add_token(token)
+    except (requests.RequestException, ValueError) as e:
+        logger.warning("Ollama stream error: %s", e)
+        yield json.dumps({'type': 'error', 'error': 'Ollama stopped responding mid-generation'}) + '\n'
+        return
+    yield from cart.finish()
 
-Guidelines:
-- Create complete, detailed recipes that prominently feature their scanned ingredients
-- Include cooking instructions, prep time, and serving size
-- You may suggest 1-2 common pantry items (salt, pepper, oil, etc.) if needed to complete the recipe
-- If they ask for a specific dish, adapt it to use their scanned ingredients creatively
-- Be encouraging and explain how their scanned ingredients work well together
-- Format your response clearly with ingredients list and step-by-step instructions
-always give a full recipe even though not all ingredients are used, just make sure to use the scanned ingredients as much as possible
-Respond naturally and conversationally, but focus on practical, cookable recipes."""
-        else:
-            # Normal mode - strict ingredient list only
-            system_prompt = """You are a cooking ingredient generator. Your ONLY task is to output a comma-separated list of ingredients for the requested dish.
+class RecipeCartStream:
+    """The /api/recipe-cart events of one answer, produced token by token as the answer arrives.
 
-CRITICAL RULES:
-1. Output ONLY ingredients, nothing else
-2. No introductory text, no explanations, no questions
-3. No "Here are the ingredients:", no "You'll need:", no prefixes
-4. No cooking instructions, no measurements, no descriptions
-5. Format: ingredient1, ingredient2, ingredient3   no parentheses, just pure ingredients, output all the necessary ingredients, no more, no less
-6. Use "/" instead of "or" when listing alternatives (e.g., "tomato sauce/pizza sauce", "basil/oregano")
-7.  really try to figure it out because some dishes are traditional and you might know them, and if you can't, output: "Unknown dish"
-NEVER EVER REPEAT THE SAME INGREDIENT MORE THAN ONCE IN THE RECIPE
-8. If the request is not food-related, output: "Not a cooking request"
+    Tokens are relayed as 'token' events. Each ingredient is matched as soon as the comma or newline after it
+    arrives and sent as an 'item' (or 'unmatched') event; 'done' then carries the whole answer and shopping list."""
 
-EXAMPLES:
-Input: "pizza"
-Output: Pizza dough, tomato sauce/pizza sauce, mozzarella cheese, olive oil, basil/oregano, garlic
+    def __init__(self, metadata, cached=False):
+        self.metadata = metadata
+        self.cached = cached
+        self.matcher = ShoppingListMatcher()
+        self.streamed = []  # (ingredient, products) sent as item events, in list order
+        self.diverged = False  # a longer answer parsed differently from what was already sent
+        self.collected = []
 
-Input: "chocolate chip cookies"  
-Output: All-purpose flour, butter, brown sugar/white sugar, eggs, vanilla extract, baking soda, salt, chocolate chips
+    def add_token(self, token):
+        """Events for the next token of the answer."""
+        self.collected.append(token)
+        yield json.dumps({'type': 'token', 'token': token}) + '\n'
+        if self.diverged or (',' not in token and '\n' not in token):
+            return
 
-Input: "beef stir fry"
-Output: Beef strips, soy sauce, garlic, ginger, bell peppers/onion, broccoli, vegetable oil, cornstarch, sesame oil
+        with timed_stage('extract_ingredients'):
+            ingredients = extract_complete_ingredients(''.join(self.collected))
+        if ingredients is None:
+            return
+        if [ingredient for ingredient, products in self.streamed] != ingredients[:len(self.streamed)]:
+            self.diverged = True
+            return
+        yield from match_recipe_cart_items(self.matcher, ingredients[len(self.streamed):], self.streamed)
 
-Input: "what's the weather"
-Output: Not a cooking request
+    def finish(self):
+        """The remaining events once the answer is complete, ending with 'done'."""
+        response = ''.join(self.collected).strip()
+        with timed_stage('extract_ingredients'):
+            ingredients = extract_ingredients_from_text(response)
+        done = {'type': 'done', 'response': response, 'cached': self.cached, **self.metadata}
 
-Remember: ONLY the ingredient list, nothing more. Use "/" for alternatives, not "or"."""
+        # An answer that turned out to be a question has nothing to buy
+        if len(ingredients) == 1 and '?' in ingredients[0]:
+            yield json.dumps({**done, 'shopping_list': [], 'unmatched_ingredients': [], 'question': ingredients[0]}) + '\n'
+            return
 
-        # Make request to Ollama
-        ollama_response = requests.post('http://localhost:11434/api/generate', json={
-            'model': model_name,
-            'prompt': f"{system_prompt}\n\nUser: {user_prompt}\n\nAssistant:",
-            'stream': False
-        })
-        
-        if ollama_response.status_code != 200:
+        streamed = self.streamed
+        if not self.diverged and [ingredient for ingredient, products in streamed] == ingredients[:len(streamed)]:
+            yield from match_recipe_cart_items(self.matcher, ingredients[len(streamed):], streamed)
+            matches = streamed
+        else:
+            # Items already sent were provisional; the final list is matched afresh, mostly from the match cache
+            matches = list(zip(ingredients, find_matching_products_batch(ingredients)))
+
+        shopping_list = [{'ingredient': ingredient, 'products': products[:3]} for ingredient, products in matches if products]
+        yield json.dumps({
+            **done,
+            'shopping_list': shopping_list,
+            'unmatched_ingredients': [ingredient for ingredient, products in matches if not products],
+            'total_ingredients': len(ingredients),
+            'matched_ingredients': len(shopping_list)
+        }) + '\n'
+
+def match_recipe_cart_items(matcher, ingredients, streamed):
+    """Match the next ingredients of a recipe cart, record them in streamed and yield their item events."""
+    if not ingredients:
+        return
+    for ingredient, products in zip(ingredients, matcher.match(ingredients)):
+        streamed.append((ingredient, products))
+        if products:
+            yield json.dumps({'type': 'item', 'ingredient': ingredient, 'products': products[:3]}) + '\n'
+        else:
+            yield json.dumps({'type': 'unmatched', 'ingredient': ingredient}) + '\n'
+
+@app.route('/api/recipe-cart', methods=['POST'])
+def recipe_cart():
+    """Stream an ingredient list from Ollama and its shopping list together, matching ingredients while Ollama generates"""
+    try:
+        prepared = prepare_chat({**(request.get_json(silent=True) or {}), 'mode': 'normal', 'stream': True})
+        if prepared is None:
+            return jsonify({'error': 'Prompt is required'}), 400
+        payload, metadata, cache_key = prepared
+
+        with timed_stage('chat_cache'):
+            cached = get_cached_chat(cache_key)
+        if cached is not None:
+            return Response(recipe_cart_events([cached], metadata, cached=True), mimetype='application/x-ndjson')
+
+        generation = join_ollama_generation(payload, metadata['mode'], cache_key)
+        with timed_stage('ollama_first_chunk'):
+            started = wait_for_ollama_generation(generation)
+        if not started:
             return jsonify({'error': 'Failed to get response from Ollama'}), 500
-        
-        response_data = ollama_response.json()
-        ai_response = response_data.get('response', '').strip()
-        
-        # Extract dish name for shopping list (only in normal mode)
-        dish_name = None
-        if mode == 'normal':
-            dish_name = extract_dish_name_from_prompt(user_prompt)
-        
-        return jsonify({
-            'response': ai_response,
-            'dish_name': dish_name,
-            'mode': mode,
-            'scanned_ingredients_used': scanned_ingredients if mode == 'recipe' else []
-        })
-        
+
+        return Response(recipe_cart_events(follow_ollama_generation(generation), metadata), mimetype='application/x-ndjson')
+
+    except GenerationRejected as e:
+        return jsonify({'error': str(e)}), e.status
     except requests.RequestException as e:
-        print(f"Ollama request error: {str(e)}")
+        logger.error("Ollama request error: %s", e)
         return jsonify({'error': 'Failed to connect to Ollama. Make sure it\'s running.'}), 500
     except Exception as e:
-        print(f"Chat error: {str(e)}")
-        return jsonify({'error': f'Chat failed: {str(e)}'}), 500
+        logger.error("Recipe cart error: %s", e)
+        return jsonify({'error': f'Recipe cart failed: {str(e)}'}), 500
 
 @app.route('/api/shopping-list', methods=['POST'])
 def generate_shopping_list():
@@ -561,7 +2893,8 @@ def generate_shopping_list():
     if not ingredients_text:
         return jsonify({"error": "Ingredients text is required"}), 400
     
-    ingredients = extract_ingredients_from_text(ingredients_text)
+    with timed_stage('extract_ingredients'):
+        ingredients = extract_ingredients_from_text(ingredients_text)
     
     # If the only "ingredient" is a question, return immediately
     if len(ingredients) == 1 and '?' in ingredients[0]:
@@ -577,32 +2910,14 @@ def generate_shopping_list():
     
     shopping_list = []
     unmatched_ingredients = []
-    used_product_ids = set()  # Track used products to prevent exact duplicates
-    used_product_signatures = set()  # Track similar products to prevent near-duplicates
     
-    for ingredient in ingredients:
-        matching_products = find_matching_products(ingredient, used_product_ids)
-        
-        if matching_products:
-            # Advanced duplicate filtering: remove similar products
-            filtered_products = []
-            for product in matching_products:
-                # Create a product signature for similarity detection
-                signature = create_product_signature(product)
-                
-                if signature not in used_product_signatures:
-                    filtered_products.append(product)
-                    used_product_signatures.add(signature)
-                    if product.get('id'):
-                        used_product_ids.add(product['id'])
-                        
-            if filtered_products:
-                shopping_list.append({
-                    'ingredient': ingredient,
-                    'products': filtered_products[:3]
-                })
-            else:
-                unmatched_ingredients.append(ingredient)
+    # One scoring pass for the whole list; products and near-duplicates are only used once across ingredients
+    for ingredient, filtered_products in zip(ingredients, find_matching_products_batch(ingredients)):
+        if filtered_products:
+            shopping_list.append({
+                'ingredient': ingredient,
+                'products': filtered_products[:3]
+            })
         else:
             unmatched_ingredients.append(ingredient)
     
@@ -614,167 +2929,632 @@ def generate_shopping_list():
         'matched_ingredients': len(shopping_list)
     })
 
+def merge_meal_plan_ingredients(dishes):
+    """Merge the ingredient lists of several dishes: [(ingredient, [dish names])] in first-seen order.
+
+    Ingredients that differ only in case, punctuation or spacing are one entry, named as first written."""
+    merged = {}
+    for dish_name, ingredients in dishes:
+        for ingredient in ingredients:
+            key = ' '.join(re.sub(r'[^\w\s]', '', ingredient.lower()).split())
+            if not key:
+                continue
+            entry = merged.setdefault(key, (ingredient, []))
+            if dish_name not in entry[1]:
+                entry[1].append(dish_name)
+    return list(merged.values())
+
+@app.route('/api/meal-plan', methods=['POST'])
+def generate_meal_plan():
+    """Generate one consolidated shopping list for several dishes, matching each distinct ingredient once"""
+    data = request.get_json(silent=True) or {}
+    dishes = data.get('dishes')
+    if not isinstance(dishes, list) or not dishes:
+        return jsonify({"error": "A list of dishes is required"}), 400
+    if len(dishes) > MEAL_PLAN_MAX_DISHES:
+        return jsonify({"error": f"At most {MEAL_PLAN_MAX_DISHES} dishes per meal plan"}), 400
+
+    dish_names = []
+    dish_ingredients = []
+    skipped_dishes = []
+    with timed_stage('extract_ingredients'):
+        for number, dish in enumerate(dishes, 1):
+            dish = dish if isinstance(dish, dict) else {}
+            dish_name = dish.get('dish_name')
+            if not dish_name or dish_name == 'null' or dish_name == 'None':
+                dish_name = f'Dish {number}'
+            ingredients_text = dish.get('ingredients')
+            ingredients = extract_ingredients_from_text(ingredients_text) if isinstance(ingredients_text, str) else []
+            # A dish whose "ingredients" are only a question from the model has nothing to buy
+            if not ingredients or (len(ingredients) == 1 and '?' in ingredients[0]):
+                skipped_dishes.append(dish_name)
+                continue
+            dish_names.append(dish_name)
+            dish_ingredients.append((dish_name, ingredients))
+
+    merged = merge_meal_plan_ingredients(dish_ingredients)
+    if not merged:
+        return jsonify({"error": "No valid ingredients found in any dish"}), 400
+
+    shopping_list = []
+    unmatched_ingredients = []
+
+    # Shared staples are matched once, and no product or near-duplicate is used for two ingredients across the plan
+    for (ingredient, used_by), filtered_products in zip(merged, find_matching_products_batch([ingredient for ingredient, used_by in merged])):
+        if filtered_products:
+            shopping_list.append({
+                'ingredient': ingredient,
+                'dishes': used_by,
+                'products': filtered_products[:3]
+            })
+        else:
+            unmatched_ingredients.append({'ingredient': ingredient, 'dishes': used_by})
+
+    return jsonify({
+        'dishes': dish_names,
+        'skipped_dishes': skipped_dishes,
+        'shopping_list': shopping_list,
+        'unmatched_ingredients': unmatched_ingredients,
+        'total_ingredients': sum(len(ingredients) for dish_name, ingredients in dish_ingredients),
+        'unique_ingredients': len(merged),
+        'matched_ingredients': len(shopping_list)
+    })
+
+# Browser-like headers for the go-upc.com search page
+GO_UPC_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Connection': 'keep-alive',
+    'Upgrade-Insecure-Requests': '1'
+}
+
+UPCITEMDB_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Accept': 'application/json'
+}
+
 def scrape_go_upc(upc_code):
     """Scrape go-upc.com for product information with improved error handling"""
     try:
         # Search URL using the UPC code
-        url = f"https://go-upc.com/search?q={upc_code}"
-        
-        # Set headers to mimic a browser
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            'Accept-Language': 'en-US,en;q=0.5',
-            'Accept-Encoding': 'gzip, deflate, br',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1'
-        }
+        url = GO_UPC_SEARCH_URL.format(upc=upc_code)
         
-        print(f"Requesting URL: {url}")
+        logger.debug("Requesting URL: %s", url)
         
         # GET request to the URL with headers
-        response = requests.get(url, headers=headers, timeout=15, allow_redirects=True)
+        response = upc_session.get(url, headers=GO_UPC_HEADERS, timeout=GO_UPC_TIMEOUT, allow_redirects=True)
         
-        print(f"Response status: {response.status_code}")
-        print(f"Response headers: {dict(response.headers)}")
+        logger.debug("Response status: %s", response.status_code)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Response headers: %s", dict(response.headers))
         
         # Check if the request was successful
         if response.status_code == 200:
-            # Parse the HTML content
-            soup = BeautifulSoup(response.content, 'html.parser')
-            
-            print(f"Page title: {soup.title.text if soup.title else 'No title'}")
-            
-            # Try multiple selectors to find product name
-            product_name = None
-            
-            # Method 1: Look for h1 with class 'product-name'
-            product_element = soup.find('h1', class_='product-name')
-            if product_element:
-                product_name = product_element.text.strip()
-                print(f"Found product name (method 1): {product_name}")
-            
-            # Method 2: Look for any h1 tag
-            if not product_name:
-                h1_tags = soup.find_all('h1')
-                for h1 in h1_tags:
-                    text = h1.text.strip()
-                    if text and not text.lower().startswith('search') and len(text) > 3:
-                        product_name = text
-                        print(f"Found product name (method 2): {product_name}")
-                        break
-            
-            # Method 3: Look for product details in various containers
-            if not product_name:
-                selectors = [
-                    '.product-title',
-                    '.product-info h1',
-                    '.product-info h2',
-                    '.product-details h1',
-                    '.item-title',
-                    '[data-product-name]'
-                ]
-                
-                for selector in selectors:
-                    element = soup.select_one(selector)
-                    if element:
-                        product_name = element.text.strip()
-                        print(f"Found product name (method 3 - {selector}): {product_name}")
-                        break
-            
-            # Method 4: Look in page title
-            if not product_name and soup.title:
-                title_text = soup.title.text.strip()
-                # Clean up title (remove site name, etc.)
-                if ' - ' in title_text:
-                    title_parts = title_text.split(' - ')
-                    for part in title_parts:
-                        if 'go-upc' not in part.lower() and 'search' not in part.lower() and len(part.strip()) > 3:
-                            product_name = part.strip()
-                            print(f"Found product name (method 4): {product_name}")
-                            break
-                elif 'go-upc' not in title_text.lower() and len(title_text) > 3:
-                    product_name = title_text
-                    print(f"Found product name (method 4 - full title): {product_name}")
-            
-            # Method 5: Look for any text that might be a product name
-            if not product_name:
-                # Look for divs or spans that might contain product info
-                potential_elements = soup.find_all(['div', 'span', 'p'], string=True)
-                for element in potential_elements:
-                    text = element.get_text().strip()
-                    # Skip if it's too short, contains common website text, or looks like navigation
-                    if (len(text) > 10 and 
-                        not any(skip_word in text.lower() for skip_word in ['search', 'home', 'about', 'contact', 'privacy', 'terms', 'login', 'register', 'menu']) and
-                        not text.isdigit() and
-                        not text.startswith('http')):
-                        product_name = text
-                        print(f"Found product name (method 5): {product_name}")
-                        break
-            
-            if product_name:
-                # Clean up the product name
-                product_name = product_name.replace('\n', ' ').replace('\t', ' ')
-                product_name = ' '.join(product_name.split())  # Remove extra whitespace
-                
-                # Remove common prefixes/suffixes
-                prefixes_to_remove = ['Product:', 'Item:', 'Name:']
-                for prefix in prefixes_to_remove:
-                    if product_name.startswith(prefix):
-                        product_name = product_name[len(prefix):].strip()
-                
-                print(f"Final cleaned product name: {product_name}")
-                return product_name
-            else:
-                print("No product name found in page")
-                # Print some of the page content for debugging
-                print(f"Page content preview: {soup.get_text()[:500]}...")
-                return 'N/A'
+            return extract_go_upc_product_name(response.content)
         else:
-            print(f"Request failed with status: {response.status_code}")
-            print(f"Response content: {response.text[:500]}...")
+            logger.info("Request failed with status: %s", response.status_code)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Response content: %s...", response.text[:500])
             return 'N/A'
             
     except requests.RequestException as e:
-        print(f"Request error: {str(e)}")
+        logger.warning("Request error: %s", e)
         return 'N/A'
     except Exception as e:
-        print(f"Scraping error: {str(e)}")
+        logger.warning("Scraping error: %s", e)
+        return 'N/A'
+
+# Characters of a text chunk BeautifulSoup collapses to one space or newline when the chunk holds nothing else
+HTML_ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+
+# Tags inside which BeautifulSoup's heading text differs from the raw character data: strings within them are left
+# out of it (script, style, template, rt, rp) or keep whitespace-only chunks as they are (pre, textarea)
+HTML_OPAQUE_TAGS = {'script', 'style', 'template', 'rt', 'rp', 'pre', 'textarea'}
+
+# Characters of a go-upc.com page fed to the heading parser at a time, between checks for an early stop
+GO_UPC_PARSE_CHUNK = 8192
+
+class GoUpcHeadingParser(HTMLParser):
+    """Streams a go-upc.com page for the <h1> texts extract_go_upc_product_name tries first, without building a tree.
+
+    Headings are read as BeautifulSoup's html.parser tree would read them. Markup where that isn't certain, such as a
+    nested or unclosed heading or a script inside one, sets unsure so the caller can fall back to a full parse."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.open_tags = None  # tags opened inside the current <h1>, None outside one
+        self.strings = []  # finished strings of the current <h1>
+        self.data = []  # character data since the last tag, one string once the next tag starts
+        self.is_product_heading = False
+        self.product_heading = None  # text of the first h1.product-name
+        self.first_heading = None  # text of the first <h1> that looks like a product name
+        self.opaque_depth = 0  # HTML_OPAQUE_TAGS open around the current position
+        self.done = False
+        self.unsure = False
+
+    def give_up(self):
+        # Markup after the answer is settled doesn't matter
+        if not self.done:
+            self.unsure = self.done = True
+
+    def end_data(self):
+        if self.data:
+            text = ''.join(self.data)
+            self.data = []
+            if not text.strip(HTML_ASCII_SPACES):
+                text = '\n' if '\n' in text else ' '
+            self.strings.append(text)
+
+    def handle_starttag(self, tag, attrs):
+        self.end_data()
+        if self.open_tags is not None:
+            if tag == 'h1' or tag in HTML_OPAQUE_TAGS:
+                self.give_up()
+            elif tag not in HTMLTreeBuilder.empty_element_tags:
+                self.open_tags.append(tag)
+        elif tag in HTML_OPAQUE_TAGS:
+            self.opaque_depth += 1
+        elif tag == 'h1':
+            if self.opaque_depth:
+                self.give_up()
+                return
+            self.open_tags = []
+            self.strings = []
+            self.is_product_heading = 'product-name' in (dict(attrs).get('class') or '').split()
+
+    def handle_startendtag(self, tag, attrs):
+        self.end_data()
+        if tag == 'h1' or (self.open_tags is not None and tag in HTML_OPAQUE_TAGS):
+            self.give_up()
+
+    def handle_endtag(self, tag):
+        self.end_data()
+        if self.open_tags is None:
+            if tag in HTML_OPAQUE_TAGS and self.opaque_depth:
+                self.opaque_depth -= 1
+        elif tag == 'h1':
+            self.end_heading(''.join(self.strings).strip())
+        elif tag in self.open_tags:
+            del self.open_tags[len(self.open_tags) - 1 - self.open_tags[::-1].index(tag):]
+        elif tag not in HTMLTreeBuilder.empty_element_tags:
+            # It closes an element outside the heading, which closes the heading too
+            self.give_up()
+
+    def end_heading(self, text):
+        self.open_tags = None
+        if self.is_product_heading and self.product_heading is None:
+            self.product_heading = text
+        if self.first_heading is None and text and not text.lower().startswith('search') and len(text) > 3:
+            self.first_heading = text
+        # Method 1 wins once found; otherwise method 2 needs to have seen that the first h1.product-name is empty
+        self.done = bool(self.product_heading) or (self.product_heading is not None and self.first_heading is not None)
+
+    def handle_data(self, data):
+        if self.open_tags is not None:
+            self.data.append(data)
+
+    def handle_entityref(self, name):
+        if self.open_tags is not None:
+            character = EntitySubstitution.HTML_ENTITY_TO_CHARACTER.get(name)
+            self.data.append(character if character is not None else f"&{name}")
+
+    def handle_charref(self, name):
+        if self.open_tags is None:
+            return
+        code = int(name[1:], 16) if name[:1] in ('x', 'X') else int(name)
+        if code < 256:
+            # BeautifulSoup reads these as Windows-1252, as pages often mean
+            try:
+                self.data.append(bytes([code]).decode('windows-1252'))
+            except UnicodeDecodeError:
+                self.give_up()
+            return
+        try:
+            self.data.append(chr(code))
+        except (ValueError, OverflowError):
+            self.data.append('\N{REPLACEMENT CHARACTER}')
+
+    def handle_comment(self, data):
+        self.end_data()
+
+    def handle_decl(self, data):
+        self.end_data()
+        if self.open_tags is not None:
+            self.give_up()
+
+    handle_pi = unknown_decl = handle_decl
+
+def find_go_upc_heading(html_content):
+    """Stream a go-upc.com page for its h1.product-name, else its first product-like <h1>, stopping once that's settled.
+
+    Returns None when the page has no such heading or the streamed read can't be sure of it."""
+    if isinstance(html_content, bytes):
+        html_content = UnicodeDammit(html_content, is_html=True).unicode_markup
+        if html_content is None:
+            return None
+
+    # A page without <h1>s goes straight to the full parse, and on one that never spells out product-name
+    # the first product-like <h1> settles it
+    if not re.search('<h1', html_content, re.IGNORECASE):
+        return None
+    parser = GoUpcHeadingParser()
+    if 'product-name' not in html_content:
+        parser.product_heading = ''
+
+    for start in range(0, len(html_content), GO_UPC_PARSE_CHUNK):
+        parser.feed(html_content[start:start + GO_UPC_PARSE_CHUNK])
+        if parser.done:
+            break
+    else:
+        parser.close()
+        if parser.open_tags is not None:
+            parser.give_up()
+
+    if parser.unsure:
+        return None
+    return parser.product_heading or parser.first_heading
+
+def extract_go_upc_product_name(html_content):
+    """Pick the product name out of a go-upc.com search result page, or return 'N/A'.
+
+    The product heading is looked for in a streamed pass first; only pages without one are parsed into a full tree."""
+    product_name = find_go_upc_heading(html_content)
+    soup = None
+    if product_name:
+        logger.debug("Found product name (heading): %s", product_name)
+    else:
+        soup = BeautifulSoup(html_content, 'html.parser')
+        product_name = find_go_upc_product_name_in_soup(soup)
+
+    if product_name:
+        product_name = clean_go_upc_product_name(product_name)
+        logger.debug("Final cleaned product name: %s", product_name)
+        return product_name
+    else:
+        logger.info("No product name found in page")
+        # Log some of the page content for debugging
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Page content preview: %s...", soup.get_text()[:500])
         return 'N/A'
 
+def find_go_upc_product_name_in_soup(soup):
+    """Try every way a go-upc.com page can show the product name on its parsed tree; None if none works."""
+    logger.debug("Page title: %s", soup.title.text if soup.title else 'No title')
+
+    # Try multiple selectors to find product name
+    product_name = None
+
+    # Method 1: Look for h1 with class 'product-name'
+    product_element = soup.find('h1', class_='product-name')
+    if product_element:
+        product_name = product_element.text.strip()
+        logger.debug("Found product name (method 1): %s", product_name)
+
+    # Method 2: Look for any h1 tag
+    if not product_name:
+        h1_tags = soup.find_all('h1')
+        for h1 in h1_tags:
+            text = h1.text.strip()
+            if text and not text.lower().startswith('search') and len(text) > 3:
+                product_name = text
+                logger.debug("Found product name (method 2): %s", product_name)
+                break
+
+    # Method 3: Look for product details in various containers
+    if not product_name:
+        selectors = [
+            '.product-title',
+            '.product-info h1',
+            '.product-info h2',
+            '.product-details h1',
+            '.item-title',
+            '[data-product-name]'
+        ]
+
+        for selector in selectors:
+            element = soup.select_one(selector)
+            if element:
+                product_name = element.text.strip()
+                logger.debug("Found product name (method 3 - %s): %s", selector, product_name)
+                break
+
+    # Method 4: Look in page title
+    if not product_name and soup.title:
+        title_text = soup.title.text.strip()
+        # Clean up title (remove site name, etc.)
+        if ' - ' in title_text:
+            title_parts = title_text.split(' - ')
+            for part in title_parts:
+                if 'go-upc' not in part.lower() and 'search' not in part.lower() and len(part.strip()) > 3:
+                    product_name = part.strip()
+                    logger.debug("Found product name (method 4): %s", product_name)
+                    break
+        elif 'go-upc' not in title_text.lower() and len(title_text) > 3:
+            product_name = title_text
+            logger.debug("Found product name (method 4 - full title): %s", product_name)
+
+    # Method 5: Look for any text that might be a product name
+    if not product_name:
+        # Look for divs or spans that might contain product info
+        potential_elements = soup.find_all(['div', 'span', 'p'], string=True)
+        for element in potential_elements:
+            text = element.get_text().strip()
+            # Skip if it's too short, contains common website text, or looks like navigation
+            if (len(text) > 10 and 
+                not any(skip_word in text.lower() for skip_word in ['search', 'home', 'about', 'contact', 'privacy', 'terms', 'login', 'register', 'menu']) and
+                not text.isdigit() and
+                not text.startswith('http')):
+                product_name = text
+                logger.debug("Found product name (method 5): %s", product_name)
+                break
+
+    return product_name
+
+def clean_go_upc_product_name(product_name):
+    """Collapse whitespace and strip label prefixes from a scraped product name."""
+    # Clean up the product name
+    product_name = product_name.replace('\n', ' ').replace('\t', ' ')
+    product_name = ' '.join(product_name.split())  # Remove extra whitespace
+
+    # Remove common prefixes/suffixes
+    prefixes_to_remove = ['Product:', 'Item:', 'Name:']
+    for prefix in prefixes_to_remove:
+        if product_name.startswith(prefix):
+            product_name = product_name[len(prefix):].strip()
+    return product_name
+
 def scrape_upcitemdb(upc_code):
     """Alternative UPC lookup using upcitemdb.com API"""
     try:
-        url = f"https://api.upcitemdb.com/prod/trial/lookup?upc={upc_code}"
-        
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
-            'Accept': 'application/json'
-        }
+        url = UPCITEMDB_LOOKUP_URL.format(upc=upc_code)
         
-        print(f"Trying UPCItemDB API: {url}")
+        logger.debug("Trying UPCItemDB API: %s", url)
         
-        response = requests.get(url, headers=headers, timeout=10)
+        response = upc_session.get(url, headers=UPCITEMDB_HEADERS, timeout=UPCITEMDB_TIMEOUT)
         
         if response.status_code == 200:
-            data = response.json()
-            
-            if data.get('code') == 'OK' and data.get('items'):
-                item = data['items'][0]
-                product_name = item.get('title') or item.get('brand', '') + ' ' + item.get('model', '')
-                product_name = product_name.strip()
-                
-                if product_name:
-                    print(f"Found product via UPCItemDB: {product_name}")
-                    return product_name
+            product_name = extract_upcitemdb_product_name(response.json())
+            if product_name:
+                return product_name
         
-        print("UPCItemDB lookup failed")
+        logger.info("UPCItemDB lookup failed")
         return 'N/A'
         
     except Exception as e:
-        print(f"UPCItemDB error: {str(e)}")
+        logger.warning("UPCItemDB error: %s", e)
         return 'N/A'
 
+def extract_upcitemdb_product_name(data):
+    """Product name from a UPCItemDB lookup response, or None if it has no items."""
+    if data.get('code') == 'OK' and data.get('items'):
+        item = data['items'][0]
+        product_name = item.get('title') or item.get('brand', '') + ' ' + item.get('model', '')
+        product_name = product_name.strip()
+        
+        if product_name:
+            logger.debug("Found product via UPCItemDB: %s", product_name)
+            return product_name
+    return None
+
+# Common test barcodes, used when no lookup service knows the product
+TEST_PRODUCTS = {
+    '049000028911': 'Coca-Cola Classic 12 fl oz Can',
+    '044000032296': 'Oreo Chocolate Sandwich Cookies',
+    '028400064057': 'Pepsi Cola 12 fl oz Can',
+    '012000161155': 'Planters Dry Roasted Peanuts',
+    '041220576463': 'Heinz Tomato Ketchup',
+    '018200001031': 'Campbell\'s Chicken Noodle Soup',
+    '072250007019': 'Lay\'s Classic Potato Chips',
+    '030000056110': 'Cheerios Cereal',
+    '011110021304': 'Kraft Mac & Cheese Original'
+}
+
+class BarcodeCache:
+    """SQLite-backed UPC -> product name cache with per-entry expiry.
+
+    A NULL product name is a negative entry: nobody could resolve the UPC, so don't scrape it again until it expires."""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS barcodes ('
+                'upc TEXT PRIMARY KEY, product_name TEXT, source TEXT, expires_at REAL)'
+            )
+
+    def get(self, upc_code):
+        """Return (product_name, source) for a live entry, with product_name None for a negative one, or None if absent."""
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT product_name, source, expires_at FROM barcodes WHERE upc = ?', (upc_code,)
+            ).fetchone()
+        if row is None or (row[2] is not None and row[2] < time.time()):
+            return None
+        return row[0], row[1]
+
+    def put(self, upc_code, product_name, source, ttl):
+        """Store a lookup result for ttl seconds (forever if ttl is None)."""
+        expires_at = None if ttl is None else time.time() + ttl
+        with self._lock, self._connection:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO barcodes (upc, product_name, source, expires_at) VALUES (?, ?, ?, ?)',
+                (upc_code, product_name, source, expires_at)
+            )
+
+    def seed(self, products, source):
+        """Add permanent entries for UPCs the cache doesn't know yet."""
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR IGNORE INTO barcodes (upc, product_name, source, expires_at) VALUES (?, ?, ?, NULL)',
+                [(upc_code, product_name, source) for upc_code, product_name in products.items()]
+            )
+
+def open_barcode_cache():
+    """Open the persistent barcode cache seeded with TEST_PRODUCTS, or return None if it can't be opened."""
+    try:
+        cache = BarcodeCache(BARCODE_CACHE_PATH)
+        cache.seed(TEST_PRODUCTS, 'test_products')
+        return cache
+    except sqlite3.Error as e:
+        logger.warning("Barcode cache unavailable, lookups won't be cached: %s", e)
+        return None
+
+barcode_cache = open_barcode_cache()
+
+# UPC -> Future of the lookup currently scraping it, so concurrent scans of one code share a single scrape
+barcode_lookups_in_flight = {}
+barcode_lookups_lock = threading.Lock()
+
+# Lookup providers in order of preference: (name, function taking a UPC and returning a product name or 'N/A')
+barcode_providers = [
+    ('go-upc', scrape_go_upc),
+    ('upcitemdb', scrape_upcitemdb)
+]
+
+# How many lookups each provider answered first
+barcode_provider_wins = defaultdict(int)
+barcode_provider_wins_lock = threading.Lock()
+
+barcode_provider_executor = ThreadPoolExecutor(max_workers=BARCODE_PROVIDER_WORKERS, thread_name_prefix='upc-provider')
+
+def register_barcode_provider(name, lookup, first=False):
+    """Add a UPC lookup source, e.g. a local or offline database. lookup(upc_code) returns a product name, or 'N/A'/None."""
+    if first:
+        barcode_providers.insert(0, (name, lookup))
+    else:
+        barcode_providers.append((name, lookup))
+
+def is_product_name(product_name):
+    """Providers report a miss as 'N/A' or an empty value."""
+    return bool(product_name) and product_name != 'N/A'
+
+def timed_provider_lookup(name, lookup, upc_code):
+    with timed_stage(f'upc_{name}'):
+        return lookup(upc_code)
+
+def race_barcode_providers(upc_code, providers):
+    """Query all providers in parallel and return (product_name, provider) from the first that finds the UPC."""
+    # Each lookup runs in a copy of this request's context so its timing lands in the request's profile
+    futures = {barcode_provider_executor.submit(contextvars.copy_context().run, timed_provider_lookup, name, lookup, upc_code): name
+               for name, lookup in providers}
+    try:
+        for future in as_completed(futures, timeout=BARCODE_LOOKUP_TIMEOUT):
+            try:
+                product_name = future.result()
+            except Exception as e:
+                logger.warning("Provider %s failed: %s", futures[future], e)
+                continue
+            if is_product_name(product_name):
+                return product_name, futures[future]
+            logger.debug("Provider %s has no product for UPC %s", futures[future], upc_code)
+    except FutureTimeoutError:
+        logger.warning("No provider answered UPC %s within %ss", upc_code, BARCODE_LOOKUP_TIMEOUT)
+    finally:
+        # Providers that haven't started are dropped; slower ones finish in the background and are ignored
+        for future in futures:
+            future.cancel()
+    return None, None
+
+def query_barcode_providers_in_order(upc_code, providers):
+    """Query providers one after another and return (product_name, provider) from the first that finds the UPC."""
+    for name, lookup in providers:
+        logger.debug("Trying lookup provider %s...", name)
+        product_name = timed_provider_lookup(name, lookup, upc_code)
+        if is_product_name(product_name):
+            return product_name, name
+    return None, None
+
+def scrape_product_name(upc_code):
+    """Ask the lookup providers for a UPC and return (product_name, source), or (None, None) if none knows it."""
+    providers = list(barcode_providers)
+    if BARCODE_LOOKUP_MODE == 'sequential':
+        product_name, source = query_barcode_providers_in_order(upc_code, providers)
+    else:
+        product_name, source = race_barcode_providers(upc_code, providers)
+    return settle_provider_result(upc_code, product_name, source)
+
+def settle_provider_result(upc_code, product_name, source):
+    """Count the winning provider, or fall back to TEST_PRODUCTS when none found the UPC."""
+    if product_name:
+        with barcode_provider_wins_lock:
+            barcode_provider_wins[source] += 1
+        return product_name, source
+    
+    # If every provider fails, try some common test barcodes
+    logger.debug("All lookups failed, checking test barcodes...")
+    if upc_code in TEST_PRODUCTS:
+        logger.info("Using test product: %s", TEST_PRODUCTS[upc_code])
+        return TEST_PRODUCTS[upc_code], 'test_products'
+    
+    return None, None
+
+def lookup_product_name(upc_code):
+    """Resolve a UPC to (product_name, source, cached) via the cache, joining an identical lookup already in flight."""
+    if barcode_cache is not None:
+        cached = barcode_cache.get(upc_code)
+        if cached is not None:
+            return cached[0], cached[1], True
+
+    with barcode_lookups_lock:
+        in_flight = barcode_lookups_in_flight.get(upc_code)
+        if in_flight is None:
+            # A lookup for this UPC may have cached its result and left since the check above
+            cached = barcode_cache.get(upc_code) if barcode_cache is not None else None
+            if cached is not None:
+                return cached[0], cached[1], True
+            lookup = barcode_lookups_in_flight[upc_code] = Future()
+
+    if in_flight is not None:
+        logger.debug("Joining in-flight lookup for UPC %s", upc_code)
+        product_name, source = in_flight.result()
+        return product_name, source, False
+
+    try:
+        product_name, source = scrape_product_name(upc_code)
+        cache_barcode_result(upc_code, product_name, source)
+        lookup.set_result((product_name, source))
+        return product_name, source, False
+    except Exception as e:
+        lookup.set_exception(e)
+        raise
+    finally:
+        with barcode_lookups_lock:
+            barcode_lookups_in_flight.pop(upc_code, None)
+
+def cache_barcode_result(upc_code, product_name, source):
+    """Remember a lookup result, found or not, in the persistent barcode cache."""
+    if barcode_cache is None:
+        return
+    try:
+        ttl = BARCODE_CACHE_TTL if product_name else BARCODE_NEGATIVE_TTL
+        barcode_cache.put(upc_code, product_name, source, ttl)
+    except sqlite3.Error as e:
+        logger.warning("Could not cache UPC %s: %s", upc_code, e)
+
+def barcode_lookup_result(upc_code, product_name, source, cached):
+    """Response body for /api/barcode-lookup."""
+    if product_name:
+        logger.info("Found product '%s' for UPC %s (%s%s)", product_name, upc_code, source, ', cached' if cached else '')
+        return {
+            'success': True,
+            'upc': upc_code,
+            'product_name': product_name,
+            'source': 'lookup_service',
+            'provider': source,
+            'cached': cached
+        }
+    logger.info("No product found for UPC %s%s", upc_code, ' (cached)' if cached else '')
+    return {
+        'success': False,
+        'upc': upc_code,
+        'error': 'Product not found in any database',
+        'fallback_name': f'Unknown Product ({upc_code})',
+        'cached': cached
+    }
+
 @app.route('/api/barcode-lookup', methods=['POST'])
 def barcode_lookup():
     try:
@@ -784,60 +3564,104 @@ def barcode_lookup():
         if not upc_code:
             return jsonify({'error': 'UPC code is required'}), 400
             
-        print(f"=== Looking up UPC: {upc_code} ===")
-        
-        # Try primary source (go-upc.com)
-        print("Trying primary lookup (go-upc.com)...")
-        product_name = scrape_go_upc(upc_code)
-        
-        # If primary fails, try alternative source
-        if not product_name or product_name == 'N/A':
-            print("Primary lookup failed, trying alternative (UPCItemDB)...")
-            product_name = scrape_upcitemdb(upc_code)
-        
-        # If both fail, try some common test barcodes
-        if not product_name or product_name == 'N/A':
-            print("Both lookups failed, checking test barcodes...")
-            test_products = {
-                '049000028911': 'Coca-Cola Classic 12 fl oz Can',
-                '044000032296': 'Oreo Chocolate Sandwich Cookies',
-                '028400064057': 'Pepsi Cola 12 fl oz Can',
-                '012000161155': 'Planters Dry Roasted Peanuts',
-                '041220576463': 'Heinz Tomato Ketchup',
-                '018200001031': 'Campbell\'s Chicken Noodle Soup',
-                '072250007019': 'Lay\'s Classic Potato Chips',
-                '030000056110': 'Cheerios Cereal',
-                '011110021304': 'Kraft Mac & Cheese Original'
-            }
-            
-            if upc_code in test_products:
-                product_name = test_products[upc_code]
-                print(f"Using test product: {product_name}")
+        logger.debug("Looking up UPC: %s", upc_code)
         
-        if product_name and product_name != 'N/A':
-            print(f"=== SUCCESS: Found product '{product_name}' for UPC {upc_code} ===")
-            return jsonify({
-                'success': True,
-                'upc': upc_code,
-                'product_name': product_name,
-                'source': 'lookup_service'
-            })
-        else:
-            print(f"=== FAILED: No product found for UPC {upc_code} ===")
-            return jsonify({
-                'success': False,
-                'upc': upc_code,
-                'error': 'Product not found in any database',
-                'fallback_name': f'Unknown Product ({upc_code})'
-            })
+        product_name, source, cached = lookup_product_name(upc_code)
+        return jsonify(barcode_lookup_result(upc_code, product_name, source, cached))
             
     except Exception as e:
-        print(f"=== ERROR: Barcode lookup failed: {str(e)} ===")
+        logger.error("Barcode lookup failed: %s", e)
         return jsonify({'error': f'Lookup failed: {str(e)}'}), 500
 
-# Load grocery data when the app starts
-load_grocery_data()
+@app.route('/api/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Request and stage timings, catalog size, match cache, Ollama queue and UPC provider counters in the Prometheus text format."""
+    catalog = current_catalog
+    cache_stats = match_cache.stats()
+    with barcode_provider_wins_lock:
+        provider_wins = dict(barcode_provider_wins)
+    gauges = [
+        ('cooker_catalog_products', {}, catalog.product_count()),
+        ('cooker_catalog_index_words', {}, len(catalog.product_index)),
+        ('cooker_catalog_version', {}, catalog.version),
+        ('cooker_match_cache_entries', {}, cache_stats['size']),
+        ('cooker_match_cache_hits_total', {}, cache_stats['hits']),
+        ('cooker_match_cache_misses_total', {}, cache_stats['misses'])
+    ]
+    if chat_cache is not None:
+        gauges.append(('cooker_chat_cache_entries', {}, len(chat_cache)))
+    generation_stats = generation_scheduler.stats()
+    gauges.append(('cooker_ollama_generations_running', {}, generation_stats['running']))
+    gauges += [('cooker_ollama_queue_depth', {'kind': kind}, queued) for kind, queued in generation_stats['queued'].items()]
+    if catalog_reload_status.get('rss_peak_bytes') is not None:
+        gauges.append(('cooker_catalog_reload_peak_rss_bytes', {}, catalog_reload_status['rss_peak_bytes']))
+    gauges += [('cooker_barcode_provider_wins_total', {'provider': provider}, wins) for provider, wins in provider_wins.items()]
+    return Response(metrics.render(gauges), content_type='text/plain; version=0.0.4; charset=utf-8')
 
-if __name__ == '__main__':
+def check_admin_token():
+    """Error response for an admin request without the right X-Admin-Token, or None. Fails closed while ADMIN_TOKEN is unset."""
+    if not ADMIN_TOKEN:
+        return jsonify({'error': 'Admin endpoints are disabled; set ADMIN_TOKEN to enable them'}), 403
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN):
+        return jsonify({'error': 'Invalid admin token'}), 403
+    return None
+
+def catalog_status():
+    catalog = current_catalog
+    return {
+        'version': catalog.version,
+        'products': catalog.product_count(),
+        'index_words': len(catalog.product_index),
+        'reloading': catalog_reload_lock.locked(),
+        'last_reload': dict(catalog_reload_status)
+    }
+
+@app.route('/api/admin/catalog', methods=['GET'])
+def admin_catalog():
+    """Version and size of the loaded catalog, plus the duration and memory use of the last reload."""
+    refused = check_admin_token()
+    if refused:
+        return refused
+    return jsonify(catalog_status())
+
+@app.route('/api/admin/reload-catalog', methods=['POST'])
+def admin_reload_catalog():
+    """Rebuild the catalog from the CSV in the background; requests keep using the current one until the swap."""
+    refused = check_admin_token()
+    if refused:
+        return refused
+    if catalog_reload_lock.locked():
+        return jsonify(catalog_status()), 409
+    threading.Thread(target=load_grocery_data, name='catalog-reload', daemon=True).start()
+    status = catalog_status()
+    status['reloading'] = True
+    return jsonify(status), 202
+
+@app.route('/api/admin/catalog-delta', methods=['POST'])
+def admin_catalog_delta():
+    """Apply upserted and deleted SKUs from a CSV (text/csv) or JSON Lines (application/x-ndjson) body to the loaded catalog."""
+    refused = check_admin_token()
+    if refused:
+        return refused
+    delta_format = {'text/csv': 'csv', 'application/x-ndjson': 'jsonl'}.get(request.mimetype)
+    if delta_format is None:
+        return jsonify({'error': 'Send the delta as text/csv or application/x-ndjson'}), 415
+    try:
+        changes = read_catalog_delta(io.StringIO(request.get_data(as_text=True)), delta_format)
+    except (ValueError, csv.Error) as e:
+        return jsonify({'error': f'Invalid catalog delta: {e}'}), 400
+    return jsonify(apply_catalog_delta(changes))
+
+# Shard and CSV parse worker processes import this module too; only the server itself loads and watches the catalog
+if multiprocessing.parent_process() is None:
+    # Load grocery data when the app starts (once; loading before workers fork lets them share it)
     load_grocery_data()
+
+    if MATCH_ENGINE == 'sharded':
+        # Start the shard workers and send them the catalog now rather than on the first query
+        get_match_shards(current_catalog)
+
+    start_catalog_watcher()
+
+if __name__ == '__main__':
     app.run(port=5001, debug=True)
@@ -0,0 +1,1020 @@
+"""Performance benchmarks for the backend.
+
+Generates a synthetic WMT-style grocery catalog, loads it through backend.py
+and times the matching code paths. Run from the project folder, e.g.:
+
+    python benchmark.py suite --sizes 10000 100000 1000000 --output results.json
+    python benchmark.py compare old-results.json results.json
+    python benchmark.py matching --rows 568534
+    python benchmark.py sharding --shards 1 2 4 8
+    python benchmark.py memory --rows 1000000
+    python benchmark.py similarity
+    python benchmark.py parsers
+    python benchmark.py go-upc
+    python benchmark.py http
+    python benchmark.py load --endpoint chat
+"""
+import argparse
+import asyncio
+import csv
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CSV_HEADERS = [
+    'index', 'SHIPPING_LOCATION', 'DEPARTMENT', 'CATEGORY', 'SUBCATEGORY', 'BREADCRUMBS', 'SKU',
+    'PRODUCT_URL', 'PRODUCT_NAME', 'BRAND', 'PRICE_RETAIL', 'PRICE_CURRENT', 'PRODUCT_SIZE',
+    'PROMOTION', 'RunDate', 'tid'
+]
+
+BRANDS = [
+    'Great Value', 'Marketside', 'Morton', 'Domino', 'McCormick', 'Kraft', "Hunt's", 'Heinz',
+    'Barilla', "Lay's", 'Oreo', 'Land O Lakes', 'King Arthur', 'Organic Valley', 'Goya', ''
+]
+DESCRIPTORS = [
+    'Organic', 'Fresh', 'Frozen', 'Sea', 'Kosher', 'Extra Virgin', 'Whole', 'Ground', 'Black',
+    'White', 'Brown', 'Instant', 'Smoked', 'Low-Fat', 'Imitation', 'Classic', 'Original',
+    'Shredded', 'Sliced', 'Mozzarella', 'Cheddar', 'Spicy', 'Honey', 'Roasted'
+]
+FOODS = [
+    'Salt', 'Pepper', 'Sugar', 'Flour', 'Olive Oil', 'Vegetable Oil', 'Garlic', 'Onion',
+    'Tomato Sauce', 'Pizza Sauce', 'Eggs', 'Milk', 'Butter', 'Cheese', 'Chicken Breast',
+    'Beef Strips', 'Rice', 'Pasta', 'Chips', 'Cookies', 'Basil', 'Oregano', 'Vanilla Extract',
+    'Baking Soda', 'Chocolate Chips', 'Soy Sauce', 'Ginger', 'Broccoli', 'Bell Peppers',
+    'Cornstarch', 'Sesame Oil', 'Pizza Dough', 'All-Purpose Flour', 'Ice Cream', 'Yogurt',
+    'Bread', 'Crackers', 'Salmon Fillet', 'Black Beans', 'Lentils', 'Cinnamon', 'Paprika'
+]
+SUFFIXES = ['', '', ', 26 oz', ' - 12 Count', ' (Family Size)', ', 1 lb', ' with Garlic', ' 2-Pack', ', Gluten-Free', ' Mix']
+SIZES = ['', '26 oz', '1 lb', '12 ct', 'N/A', '16 fl oz', '2.5 lb']
+CATEGORIES = ['Pantry', 'Dairy & Eggs', 'Meat & Seafood', 'Snacks', 'Produce', 'Frozen']
+
+# Ingredients as they come out of extract_ingredients_from_text for common dishes
+INGREDIENTS = [
+    'salt', 'pepper', 'garlic', 'olive oil', 'eggs', 'butter', 'onion', 'All-purpose flour',
+    'brown sugar', 'white sugar', 'vanilla extract', 'baking soda', 'chocolate chips',
+    'Pizza dough', 'tomato sauce', 'pizza sauce', 'mozzarella cheese', 'basil', 'oregano',
+    'Beef strips', 'soy sauce', 'ginger', 'bell peppers', 'broccoli', 'vegetable oil',
+    'cornstarch', 'sesame oil', 'chicken breast', 'rice', 'black beans'
+]
+
+# Ingredient mixes that stress different scorer paths
+INGREDIENT_MIXES = {
+    'single_word': ['salt', 'pepper', 'garlic', 'eggs', 'butter', 'onion', 'basil', 'oregano', 'ginger', 'broccoli', 'rice', 'cinnamon'],
+    'multi_word': ['olive oil', 'brown sugar', 'vanilla extract', 'baking soda', 'chocolate chips', 'tomato sauce',
+                   'mozzarella cheese', 'soy sauce', 'chicken breast', 'extra virgin olive oil', 'All-purpose flour'],
+    'recipe_list': INGREDIENTS,
+    'no_match': ['saffron threads', 'dragon fruit', 'tamarind paste', 'gochujang', 'matcha powder']
+}
+
+# Ollama answers in the shapes extract_ingredients_from_text has to handle
+LLM_OUTPUTS = [
+    'Pizza dough, tomato sauce/pizza sauce, mozzarella cheese, olive oil, basil/oregano, garlic',
+    'All-purpose flour, butter, brown sugar/white sugar, eggs, vanilla extract, baking soda, salt, chocolate chips',
+    'Beef strips, soy sauce, garlic, ginger, bell peppers/onion, broccoli, vegetable oil, cornstarch, sesame oil',
+    'Sure, here are the ingredients for chicken fried rice:\n1. Rice\n2. Chicken breast\n3. Eggs\n4. Soy sauce\n5. Green onions\n6. Sesame oil',
+    '* Black beans\n* Cinnamon\n* Paprika\n* Olive oil\n* Onion\n* Garlic',
+    'Do you mean the Italian or the American version of this dish?'
+]
+
+# Answers Ollama gave to normal-mode chats, including the chatty ones the system prompt asks it to avoid
+OLLAMA_ANSWERS = LLM_OUTPUTS + [
+    'Spaghetti, ground beef, onion, garlic, carrots, celery, crushed tomatoes, tomato paste, red wine, milk, olive oil, salt, pepper',
+    'Lasagna noodles, ricotta cheese, mozzarella cheese, parmesan cheese, ground beef/Italian sausage, marinara sauce, eggs, parsley',
+    'Arborio rice, chicken broth, white wine, onion, butter, parmesan cheese, garlic, olive oil',
+    'Bomba rice/arborio rice, chicken thighs, chorizo, shrimp, mussels, saffron, smoked paprika, bell pepper, peas, garlic, lemon, chicken stock',
+    'Flour tortillas, chicken breast, bell peppers, onion, chili powder, cumin, lime, sour cream, salsa, cheddar cheese',
+    'Ingredients for guacamole: avocados, lime juice, red onion, cilantro, jalapeno, salt',
+    'Here are the ingredients for pancakes:\n- All-purpose flour\n- Milk\n- Eggs\n- Butter\n- Sugar\n- Baking powder\n- Salt',
+    'Sure! Here are the ingredients you need:\n\n1. Chicken thighs\n2. Yogurt\n3. Garam masala\n4. Tomato puree\n5. Heavy cream\n6. Butter\n7. Ginger/garlic paste',
+    'To make a classic margherita pizza, you will need: pizza dough, San Marzano tomatoes, fresh mozzarella, fresh basil, olive oil, salt',
+    'Sure, Romaine lettuce, croutons, parmesan cheese, Caesar dressing/anchovies, lemon juice',
+    'The ingredients for French toast are bread, eggs, milk, cinnamon, vanilla extract, butter, maple syrup',
+    '**Ingredients:**\n* Salmon fillets\n* Soy sauce\n* Honey\n* Garlic\n* Ginger\n* Sesame seeds\n* Green onions',
+    'a) Chickpeas, b) tahini, c) lemon juice, d) garlic, e) olive oil, f) cumin, g) salt',
+    'Ramen noodles, pork belly, soft-boiled eggs, green onions, nori, miso paste, chicken broth, soy sauce, sesame oil, garlic, ginger',
+    'Potatoes, butter, milk/heavy cream, salt, pepper, garlic',
+    'Ground beef, hamburger buns, cheddar cheese, lettuce, tomato, onion, pickles, ketchup/mustard, salt, pepper',
+    'Unknown dish',
+    'Not a cooking request',
+    'Could you tell me which kind of curry you would like?',
+    'Eggs, milk, butter, salt, pepper, chives\n\nEnjoy your meal!',
+    'Black beans, rice, onion, bell pepper, garlic, cumin, oregano, bay leaf, olive oil, salt',
+    'Puff pastry, beef tenderloin, mushrooms, shallots, prosciutto, Dijon mustard, egg yolk, thyme, salt, pepper',
+    'Cream cheese, graham cracker crumbs, sugar, eggs, sour cream, vanilla extract, butter, lemon zest',
+    '1. Apples\n2. Sugar\n3. Cinnamon\n4. Nutmeg\n5. Butter\n6. Pie crust\n7. Lemon juice\n8. Flour',
+    'For chili you need: ground beef, kidney beans, diced tomatoes, onion, garlic, chili powder, cumin, paprika, beef broth',
+    'Tofu, broccoli, carrots, snow peas, soy sauce, hoisin sauce, garlic, ginger, cornstarch, vegetable oil, rice'
+]
+
+# What people type into the chat box
+CHAT_PROMPTS = [
+    'pizza', 'Lasagna', 'chocolate chip cookies', 'beef stir fry', 'Chicken Tikka Masala', 'paella',
+    'what is paella', 'how to make lasagna', 'How to cook risotto at home', 'what are the ingredients for guacamole',
+    'Give me a recipe for pancakes', 'I want to make french toast', 'recipe for banana bread please',
+    'how to prepare a beef wellington', 'what can I cook with chicken and rice tonight', 'spaghetti bolognese',
+    "what's the weather like today", 'what time is it', 'mac and cheese', 'Caesar salad', 'shrimp scampi recipe',
+    'How do I make a classic margherita pizza with fresh mozzarella and basil from scratch',
+    'tacos', 'which dish is best for a dinner party recipe', 'Thai green curry', 'make me something with eggs'
+]
+
+def generate_catalog(path, rows, seed=0):
+    """Write a synthetic catalog with the WMT_Grocery_202209.csv column set."""
+    rng = random.Random(seed)
+    with open(path, 'w', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        writer.writerow(CSV_HEADERS)
+        for i in range(rows):
+            brand = rng.choice(BRANDS)
+            words = [brand] if brand and rng.random() < 0.5 else []
+            words += rng.sample(DESCRIPTORS, rng.randint(0, 3)) + [rng.choice(FOODS)]
+            name = ' '.join(words) + rng.choice(SUFFIXES)
+            category = rng.choice(CATEGORIES)
+            sku = str(100000000 + i)
+            price = rng.choice(['', 'nan', f'{rng.uniform(0.5, 40):.2f}'])
+            writer.writerow([
+                i, '79936', 'Food', category, category + ' Essentials', '', sku,
+                f'https://www.walmart.com/ip/{sku}', name, brand,
+                f'{rng.uniform(0.5, 40):.2f}', price, rng.choice(SIZES),
+                rng.choice(['', '', '', 'Rollback', 'Clearance']), '2022-09-11', i
+            ])
+
+def load_backend(rows, seed=0):
+    """Import backend.py against a freshly generated catalog of the given size, or reload it if already imported."""
+    workdir = tempfile.mkdtemp(prefix='cooker-bench-')
+    generate_catalog(os.path.join(workdir, 'WMT_Grocery_202209.csv'), rows, seed)
+    os.chdir(workdir)
+    if PROJECT_DIR not in sys.path:
+        sys.path.insert(0, PROJECT_DIR)
+    started = time.perf_counter()
+    if 'backend' in sys.modules:
+        backend = sys.modules['backend']
+        backend.load_grocery_data()
+    else:
+        backend = importlib.import_module('backend')
+    print(f"Loaded {len(backend.current_catalog.grocery_data)} products in {time.perf_counter() - started:.2f}s")
+    return backend
+
+def time_per_call(function, items, repeat):
+    """Best-of-repeat mean latency in milliseconds of function over items."""
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for item in items:
+            function(item)
+        best = min(best, (time.perf_counter() - started) / len(items))
+    return best * 1000
+
+def bench_matching(args):
+    """Per-ingredient find_matching_products latency for each scoring engine."""
+    backend = load_backend(args.rows, args.seed)
+    engines = ['python'] + (['numpy'] if backend.np is not None else [])
+
+    def uncached(ingredient, engine):
+        # Score the catalog every time instead of timing match cache hits
+        backend.match_cache.clear()
+        return backend.find_matching_products(ingredient, engine=engine)
+
+    results = {}
+    for engine in engines:
+        # Warm up lazily built structures (e.g. the NumPy arrays) before timing
+        results[engine] = [uncached(ingredient, engine) for ingredient in INGREDIENTS]
+        latency = time_per_call(lambda ingredient: uncached(ingredient, engine), INGREDIENTS, args.repeat)
+        print(f"{engine:>8}: {latency:8.2f} ms/ingredient")
+
+    # Every ranking is in the match cache after the warm-up call
+    for ingredient in INGREDIENTS:
+        backend.find_matching_products(ingredient)
+    latency = time_per_call(backend.find_matching_products, INGREDIENTS, args.repeat)
+    print(f"{'cached':>8}: {latency:8.2f} ms/ingredient")
+
+    if len(engines) > 1:
+        same = results['python'] == results['numpy']
+        print(f"Engines agree on top results: {same}")
+
+def bench_sharding(args):
+    """Uncached scoring of a whole ingredient list in-process versus split across shard worker processes."""
+    backend = load_backend(args.rows, args.seed)
+    queries = [(ingredient.lower(), set(ingredient.lower().split())) for ingredient in INGREDIENTS]
+    print(f"{os.cpu_count()} CPU cores, {len(queries)} ingredients per list")
+
+    expected = backend.score_products(queries)
+    single = time_per_call(backend.score_products, [queries], args.repeat)
+    print(f"{'in-process':>10}: {single:8.1f} ms/list")
+    for shards in args.shards:
+        backend.stop_match_shards()
+        backend.MATCH_SHARDS = shards
+        backend.start_match_shards()
+        same = backend.score_products_sharded(queries) == expected
+        latency = time_per_call(backend.score_products_sharded, [queries], args.repeat)
+        print(f"{shards:>3} shards: {latency:8.1f} ms/list  speedup {single / latency:4.2f}x  same ranking: {same}")
+    backend.stop_match_shards()
+
+def traced_size(build):
+    """Bytes still allocated by build()'s result once it returns, and the result."""
+    tracemalloc.start()
+    try:
+        result = build()
+        size = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return size, result
+
+def bench_memory(args):
+    """Memory of the catalog's products as one dict each versus the columnar ProductTable."""
+    backend = load_backend(args.rows, args.seed)
+
+    # Both parse the CSV from scratch, so each layout pays for the strings it keeps
+    def read_rows():
+        with open('WMT_Grocery_202209.csv', encoding='utf-8') as file:
+            yield from csv.DictReader(file)
+
+    def build_table():
+        table = backend.ProductTable()
+        for row in read_rows():
+            table.append(backend.parse_product_row(row))
+        return table
+
+    dicts_size, products = traced_size(lambda: [backend.parse_product_row(row) for row in read_rows()])
+    table_size, table = traced_size(build_table)
+    same = all(table[position] == product for position, product in enumerate(products))
+    print(f"{'dicts':>8}: {dicts_size / (1 << 20):9.1f} MiB  {dicts_size / len(products):6.0f} bytes/product")
+    print(f"{'columnar':>8}: {table_size / (1 << 20):9.1f} MiB  {table_size / len(products):6.0f} bytes/product  "
+          f"{dicts_size / table_size:.1f}x smaller  same products: {same}")
+
+    positions = random.Random(args.seed).sample(range(len(table)), min(1000, len(table)))
+    latency = time_per_call(table.__getitem__, positions, args.repeat)
+    print(f"Row view: {latency * 1000:.2f} us/product")
+
+def go_upc_page(product_name, layout, rows):
+    """A go-upc.com-like result page with rows related products below the fold.
+
+    layout is 'product' (the name in an h1.product-name), 'heading' (in a plain <h1>) or 'missing' (not found)."""
+    head = ''.join(f'<meta name="m{i}" content="{"x" * 40}"><link rel="preload" href="/static/{i}.js">' for i in range(30))
+    script = '<script>' + 'window.dataLayer.push({"event": "view", "id": 1});' * 200 + '</script>'
+    nav = '<nav><ul>' + ''.join(f'<li><a href="/c/{i}">Category {i}</a></li>' for i in range(40)) + '</ul></nav>'
+    search = '<form class="search"><input name="q"><button>Search</button></form>'
+    if layout == 'product':
+        main = f'<div class="product-details"><h1 class="product-name">\n  {product_name}\n</h1><img src="/p.jpg"></div>'
+    elif layout == 'heading':
+        main = f'<div class="product-details"><h1>Search results</h1><h1>{product_name}</h1></div>'
+    else:
+        main = '<div class="no-results"><p>We could not find a product for that code.</p></div>'
+    related = '<table>' + ''.join(
+        f'<tr><td><a href="/p/{i}">Related product &amp; item {i}</a></td><td>{i * 7 % 1000:012d}</td></tr>' for i in range(rows)
+    ) + '</table>'
+    footer = '<footer>' + ''.join(f'<p>About us, privacy and terms {i}</p>' for i in range(20)) + '</footer>' + script
+    return (f'<!DOCTYPE html><html><head><title>{product_name} - Go-UPC</title>{head}{script}</head>'
+            f'<body>{nav}{search}<main>{main}{related}</main>{footer}</body></html>').encode('utf-8')
+
+def traced_peak(function, item):
+    """Peak bytes allocated while function(item) runs."""
+    tracemalloc.start()
+    try:
+        function(item)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def bench_go_upc(args):
+    """Per-page time and peak allocations of go-upc.com product name extraction: full tree versus streamed heading."""
+    backend = load_backend(1000, args.seed)
+    backend.logger.setLevel('WARNING')
+
+    def full_tree(page):
+        # Every page parsed into a BeautifulSoup tree, as before the streamed heading pass
+        product_name = backend.find_go_upc_product_name_in_soup(backend.BeautifulSoup(page, 'html.parser'))
+        return backend.clean_go_upc_product_name(product_name) if product_name else 'N/A'
+
+    print(f"{'layout':>8} {'page KB':>8} {'extractor':>10} {'ms/page':>9} {'peak KB':>9}  result")
+    for layout in ('product', 'heading', 'missing'):
+        pages = [go_upc_page(f"Kraft Mac & Cheese Original {i}", layout, args.rows) for i in range(20)]
+        agree = list(map(full_tree, pages)) == list(map(backend.extract_go_upc_product_name, pages))
+        for label, function in (('full tree', full_tree), ('streamed', backend.extract_go_upc_product_name)):
+            latency = time_per_call(function, pages, args.repeat)
+            peak = max(traced_peak(function, page) for page in pages[:3])
+            print(f"{layout:>8} {len(pages[0]) / 1024:8.1f} {label:>10} {latency:9.3f} {peak / 1024:9.0f}  "
+                  f"{function(pages[0])!r}{'' if agree else '  (results differ)'}")
+
+def time_calls(function, items, repeat, unit='ms'):
+    """time_per_call as a JSON-ready record."""
+    latency = time_per_call(function, items, repeat)
+    return {f'{unit}_per_call': latency * (1000 if unit == 'us' else 1), 'calls': len(items)}
+
+def time_requests(send, bodies, repeat):
+    """Best-of-repeat sequential throughput of send(body) over bodies."""
+    latency = time_per_call(send, bodies, repeat)
+    return {'ms_per_request': latency, 'requests_per_s': 1000 / latency, 'requests': len(bodies)}
+
+def bench_catalog(backend, args):
+    """Suite results for the currently loaded catalog."""
+    results = {}
+
+    # Loading: full CSV parse (including writing the snapshot), then the snapshot fast path
+    os.remove(backend.CATALOG_SNAPSHOT_PATH)
+    for label in ('csv_s', 'snapshot_s'):
+        started = time.perf_counter()
+        backend.load_grocery_data()
+        results.setdefault('load_grocery_data', {})[label] = time.perf_counter() - started
+    # Process memory while the previous and the new catalog were both alive (the snapshot reload)
+    if backend.catalog_reload_status.get('rss_peak_bytes') is not None:
+        results['load_grocery_data']['peak_rss_mb'] = backend.catalog_reload_status['rss_peak_bytes'] / (1 << 20)
+
+    def uncached(ingredient):
+        backend.match_cache.clear()
+        return backend.find_matching_products(ingredient)
+
+    results['find_matching_products'] = {}
+    for mix, ingredients in INGREDIENT_MIXES.items():
+        backend.match_cache.clear()
+        results['find_matching_products'][mix] = {
+            'uncached': time_calls(uncached, ingredients, args.repeat),
+            'cached': time_calls(backend.find_matching_products, ingredients, args.repeat)
+        }
+
+    def uncached_batch(ingredients):
+        backend.match_cache.clear()
+        return backend.find_matching_products_batch(ingredients)
+
+    results['find_matching_products_batch'] = time_calls(uncached_batch, [INGREDIENTS], args.repeat)
+
+    # Dedupe: products that compete for the same ingredient are the ones compared with each other
+    products = []
+    for ranked in backend.score_products([(ingredient.lower(), set(ingredient.lower().split())) for ingredient in INGREDIENTS]):
+        products += [backend.current_catalog.grocery_data[position] for position, score in ranked[:args.top]]
+    pairs = [(products[i], products[j]) for i in range(len(products)) for j in range(i + 1, min(i + args.top, len(products)))]
+    results['create_product_signature'] = time_calls(backend.create_product_signature, products, args.repeat, unit='us')
+    results['are_products_similar'] = time_calls(lambda pair: backend.are_products_similar(*pair), pairs, args.repeat, unit='us')
+
+    client = backend.app.test_client()
+    bodies = [{'ingredients': text, 'dish_name': 'benchmark'} for text in LLM_OUTPUTS]
+
+    def uncached_request(body):
+        backend.match_cache.clear()
+        return client.post('/api/shopping-list', json=body)
+
+    results['shopping_list'] = {
+        'uncached': time_requests(uncached_request, bodies, args.repeat),
+        'cached': time_requests(lambda body: client.post('/api/shopping-list', json=body), bodies, args.repeat)
+    }
+
+    # A two-week plan: each dish's list once per request, matched as one consolidated cart
+    plan = {'dishes': [{'dish_name': f'dish {i}', 'ingredients': LLM_OUTPUTS[i % len(LLM_OUTPUTS)]} for i in range(14)]}
+
+    def uncached_plan(body):
+        backend.match_cache.clear()
+        return client.post('/api/meal-plan', json=body)
+
+    results['meal_plan'] = time_requests(uncached_plan, [plan], args.repeat)
+    return results
+
+def bench_catalog_independent(backend, args):
+    """Suite results that don't depend on the catalog: ingredient extraction and /api/chat against a stand-in Ollama."""
+    results = {'extract_ingredients_from_text': time_calls(backend.extract_ingredients_from_text, LLM_OUTPUTS * 50, args.repeat, unit='us')}
+
+    upstream = start_stand_in_server(UpstreamStandInHandler)
+    ollama_api_url = backend.OLLAMA_API_URL
+    backend.OLLAMA_API_URL = f"http://127.0.0.1:{upstream.server_address[1]}/api/generate"
+    chat_cache = backend.chat_cache
+    try:
+        client = backend.app.test_client()
+        prompts = [{'prompt': dish, 'mode': 'normal'} for dish in ('pizza', 'chocolate chip cookies', 'beef stir fry', 'what is paella')]
+        backend.chat_cache = None
+        uncached = time_requests(lambda body: client.post('/api/chat', json=body), prompts * 25, args.repeat)
+        backend.chat_cache = chat_cache
+        results['chat'] = {
+            'uncached': uncached,
+            'cached': time_requests(lambda body: client.post('/api/chat', json=body), prompts * 25, args.repeat)
+        }
+    finally:
+        backend.OLLAMA_API_URL = ollama_api_url
+        backend.chat_cache = chat_cache
+        upstream.shutdown()
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=PROJECT_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def bench_suite(args):
+    """Full suite over catalogs of several sizes, written as JSON for comparing commits."""
+    output_path = os.path.abspath(args.output)
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'seed': args.seed,
+            'repeat': args.repeat
+        },
+        'catalogs': {}
+    }
+
+    for rows in args.sizes:
+        backend = load_backend(rows, args.seed)
+        # Per-request log lines would otherwise be part of every timing
+        backend.logger.setLevel(args.log_level)
+        report['meta']['match_engine'] = backend.MATCH_ENGINE
+        report['catalogs'][str(rows)] = bench_catalog(backend, args)
+        print(f"{rows} rows: {json.dumps(report['catalogs'][str(rows)]['load_grocery_data'])}")
+    report['catalog_independent'] = bench_catalog_independent(backend, args)
+
+    with open(output_path, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Wrote {output_path}")
+
+def flatten_results(results, prefix=''):
+    """{'a': {'b': 1}} -> {'a.b': 1} for the numeric leaves of a suite report."""
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten_results(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[prefix + key] = value
+    return flat
+
+def bench_compare(args):
+    """Side-by-side timings of two suite reports; ratio > 1 means the second is slower (or, for throughput, faster)."""
+    with open(args.baseline) as file:
+        baseline = json.load(file)
+    with open(args.candidate) as file:
+        candidate = json.load(file)
+    print(f"baseline {baseline['meta'].get('commit')} vs candidate {candidate['meta'].get('commit')}")
+
+    old = flatten_results({key: baseline.get(key, {}) for key in ('catalogs', 'catalog_independent')})
+    new = flatten_results({key: candidate.get(key, {}) for key in ('catalogs', 'catalog_independent')})
+    for metric in sorted(old.keys() & new.keys()):
+        if metric.endswith(('.calls', '.requests')):
+            continue
+        ratio = new[metric] / old[metric] if old[metric] else float('nan')
+        print(f"{metric:<70} {old[metric]:>12.3f} {new[metric]:>12.3f} {ratio:>7.2f}x")
+
+def baseline_find_matching_products(backend, ingredient, used_product_ids=None, top_n=3):
+    """find_matching_products as it was before the inverted index: every product in the catalog scored in turn."""
+    catalog = backend.current_catalog
+    grocery_data = [catalog.grocery_data[position] for position in range(len(catalog.grocery_data))
+                    if position not in catalog.deleted_positions]
+    if not grocery_data:
+        return []
+
+    if used_product_ids is None:
+        used_product_ids = set()
+
+    ingredient_clean = re.sub(r'[^\w\s]', '', ingredient.lower().strip())
+    ingredient_words = set(ingredient_clean.split())
+
+    processed_keywords = {
+        'chips', 'crackers', 'cookies', 'candy', 'cake', 'pie', 'bread', 'pasta', 'noodles',
+        'soup', 'sauce', 'dressing', 'marinade', 'seasoning', 'mix', 'powder', 'extract',
+        'frozen', 'canned', 'jarred', 'pickled', 'smoked', 'dried', 'instant', 'prepared',
+        'cooked', 'baked', 'fried', 'roasted', 'grilled', 'bar', 'drink', 'beverage',
+        'cereal', 'granola', 'yogurt', 'ice', 'cream', 'snack', 'treat', 'dessert',
+        'muffin', 'donut', 'cookie', 'cracker', 'chip'
+    }
+    basic_ingredients = {
+        'salt', 'pepper', 'sugar', 'flour', 'oil', 'vinegar', 'water', 'milk', 'eggs',
+        'onion', 'garlic', 'tomato', 'potato', 'carrot', 'celery', 'lemon', 'lime',
+        'parsley', 'basil', 'oregano', 'thyme', 'rosemary', 'paprika', 'cumin', 'cinnamon',
+        'vanilla', 'honey', 'butter', 'cheese', 'rice', 'chicken', 'beef', 'pork', 'fish',
+        'salmon', 'tuna', 'shrimp', 'beans', 'lentils', 'saffron', 'ginger'
+    }
+    ingredient_exceptions = {
+        'salt': ['sea salt', 'kosher salt', 'table salt', 'rock salt', 'himalayan salt', 'iodized salt'],
+        'pepper': ['black pepper', 'white pepper', 'ground pepper', 'peppercorns', 'cracked pepper'],
+        'sugar': ['white sugar', 'brown sugar', 'raw sugar', 'cane sugar', 'granulated sugar'],
+        'oil': ['olive oil', 'vegetable oil', 'coconut oil', 'canola oil', 'sunflower oil'],
+        'vinegar': ['white vinegar', 'apple cider vinegar', 'balsamic vinegar', 'rice vinegar'],
+        'flour': ['all purpose flour', 'wheat flour', 'bread flour', 'cake flour', 'whole wheat flour']
+    }
+    trusted_brands = {
+        'great value', 'marketside', 'equate', 'morton', 'domino', 'crisco',
+        'heinz', 'hellmann', 'best foods', 'mccormick', 'king arthur',
+        'land o lakes', 'philadelphia', 'kraft', 'hunts'
+    }
+    ultra_processed_keywords = {
+        'instant', 'microwaveable', 'ready to eat', 'pre-cooked', 'just add water',
+        'artificial', 'imitation', 'substitute', 'replacement', 'alternative'
+    }
+
+    product_scores = []
+    for product in grocery_data:
+        if product.get('id') in used_product_ids:
+            continue
+
+        product_name_lower = product['name'].lower()
+        product_name_clean = re.sub(r'[^\w\s]', '', product_name_lower)
+        product_words = set(product_name_clean.split())
+
+        intersection = len(ingredient_words.intersection(product_words))
+        union = len(ingredient_words.union(product_words))
+        jaccard_score = intersection / union if union != 0 else 0
+
+        words_found = sum(1 for word in ingredient_words if word in product_words)
+        coverage_score = words_found / len(ingredient_words) if ingredient_words else 0
+
+        length_diff = len(product_words) - len(ingredient_words)
+        penalty = 1 - (length_diff / len(product_words)) if len(product_words) > len(ingredient_words) else 1
+        penalty_score = max(0, penalty)
+
+        prefix_bonus = 1.3 if product_name_lower.startswith(ingredient_clean) else 1.0
+
+        is_basic_ingredient = any(basic_word in ingredient_clean for basic_word in basic_ingredients)
+        has_processed_words = any(proc_word in product_name_lower for proc_word in processed_keywords)
+        if is_basic_ingredient and has_processed_words:
+            is_valid_exception = False
+            main_ingredient = list(ingredient_words)[0] if len(ingredient_words) == 1 else ingredient_clean
+            if main_ingredient in ingredient_exceptions:
+                for exception in ingredient_exceptions[main_ingredient]:
+                    if exception in product_name_lower:
+                        is_valid_exception = True
+                        break
+            if not is_valid_exception:
+                continue
+
+        if len(ingredient_words) == 1:
+            main_word = list(ingredient_words)[0]
+            if main_word not in product_name_lower.split():
+                continue
+
+        if len(ingredient_words) > 1:
+            word_match_ratio = words_found / len(ingredient_words)
+            if word_match_ratio < 0.7:
+                continue
+
+        simplicity_bonus = 1.0
+        if len(product_words) <= 3:
+            simplicity_bonus = 1.3
+        elif len(product_words) <= 5:
+            simplicity_bonus = 1.1
+        elif len(product_words) > 8:
+            simplicity_bonus = 0.6
+
+        brand_bonus = 1.0
+        product_brand = product.get('brand', '').lower()
+        if product_brand:
+            if any(brand in product_brand for brand in trusted_brands):
+                brand_bonus = 1.15
+
+        ultra_processed_penalty = 1.0
+        if any(keyword in product_name_lower for keyword in ultra_processed_keywords):
+            if not any(proc in ingredient_clean for proc in ['instant', 'ready', 'quick']):
+                ultra_processed_penalty = 0.3
+
+        final_score = ((jaccard_score * 0.25) + (coverage_score * 0.55) + (penalty_score * 0.2)) * prefix_bonus * simplicity_bonus * brand_bonus * ultra_processed_penalty
+        if final_score > 0.5:
+            product_scores.append((product, final_score))
+
+    product_scores.sort(key=lambda x: x[1], reverse=True)
+
+    final_products = []
+    seen_signatures = set()
+    for product, score in product_scores:
+        signature = backend.create_product_signature(product)
+        if signature not in seen_signatures:
+            final_products.append(product)
+            seen_signatures.add(signature)
+            is_too_similar = False
+            for existing_product in final_products[:-1]:
+                if backend.are_products_similar(product, existing_product, similarity_threshold=0.8):
+                    is_too_similar = True
+                    break
+            if is_too_similar:
+                final_products.pop()
+                seen_signatures.remove(signature)
+        if len(final_products) >= top_n:
+            break
+
+    return final_products
+
+def baseline_levenshtein_distance(s1, s2):
+    """Full-matrix edit distance, as are_products_similar computed it before the banded check."""
+    if len(s1) < len(s2):
+        return baseline_levenshtein_distance(s2, s1)
+    if len(s2) == 0:
+        return len(s1)
+    previous_row = list(range(len(s2) + 1))
+    for i, c1 in enumerate(s1):
+        current_row = [i + 1]
+        for j, c2 in enumerate(s2):
+            current_row.append(min(previous_row[j + 1] + 1, current_row[j] + 1, previous_row[j] + (c1 != c2)))
+        previous_row = current_row
+    return previous_row[-1]
+
+def baseline_extract_ingredients_from_text(text):
+    """extract_ingredients_from_text as it was before its patterns were precompiled and merged into one pass."""
+    # If the AI is asking a question, return it as a single item.
+    if '?' in text and len(text.split()) < 20:
+        return [text.strip()]
+
+    # Remove common introductory phrases that aren't ingredients
+    text = re.sub(r'^\s*(?:Sure,?\s*)?(?:Here are the ingredients for|The ingredients for|Ingredients for|For|To make).*?(?::|are|include)', '', text, flags=re.IGNORECASE).strip()
+    text = re.sub(r'^\s*(?:Sure,?\s*)?here are.*?:', '', text, flags=re.IGNORECASE).strip()
+    text = re.sub(r'^\s*Sure,?\s*', '', text, flags=re.IGNORECASE).strip()  # Remove standalone "Sure"
+    text = re.sub(r'^\*+\s*', '', text).strip()
+    
+    # Split by both commas and newlines
+    lines = text.strip().split('\n')
+    all_ingredients = []
+    
+    for line in lines:
+        line = line.strip()
+        # Skip empty lines, "Sure" responses, or introductory text
+        if (not line or 
+            re.match(r'^(?:sure|here are|the ingredients|for|to make)$', line, re.IGNORECASE) or
+            re.match(r'^(?:here are|the ingredients|for|to make)', line, re.IGNORECASE)):
+            continue
+            
+        # Split by comma and clean up each potential ingredient
+        if ',' in line:
+            ingredients = [ing.strip() for ing in line.split(',') if ing.strip()]
+        else:
+            # If no comma, treat the whole line as one ingredient
+            ingredients = [line] if line else []
+            
+        all_ingredients.extend(ingredients)
+    
+    final_ingredients = []
+    for ingredient in all_ingredients:
+        # Remove any lingering list markers, numbers, or formatting
+        cleaned_ingredient = re.sub(r'^[\d\.\-\*•\)\]]+\s*', '', ingredient).strip()
+        cleaned_ingredient = re.sub(r'^[a-z]\)\s*', '', cleaned_ingredient).strip()  # Remove "a)" style
+        
+        # Handle "/" separators within ingredients (e.g., "tomato sauce/pizza sauce")
+        if '/' in cleaned_ingredient:
+            # Split by "/" and add each alternative as a separate ingredient
+            alternatives = [alt.strip() for alt in cleaned_ingredient.split('/') if alt.strip()]
+            final_ingredients.extend(alternatives)
+        else:
+            # Skip if it's too short, contains only punctuation, looks like intro text, or is just "Sure"
+            if (cleaned_ingredient and len(cleaned_ingredient) > 2 and 
+                not re.match(r'^[^\w]*$', cleaned_ingredient) and
+                not re.match(r'^(?:sure|ingredients|for|here|the|are|include)$', cleaned_ingredient, re.IGNORECASE) and
+                not re.match(r'^(?:ingredients|for|here|the|are|include)', cleaned_ingredient, re.IGNORECASE)):
+                final_ingredients.append(cleaned_ingredient)
+            
+    return final_ingredients
+
+def baseline_extract_dish_name_from_prompt(prompt):
+    """extract_dish_name_from_prompt as it was before its pattern was compiled once and searched once."""
+    prompt_lower = prompt.lower().strip()
+    
+    # If the prompt is just a dish name (1-4 words), use it directly
+    words = prompt_lower.split()
+    if len(words) <= 4 and not any(word in prompt_lower for word in ['how', 'what', 'recipe', 'ingredients', 'make', 'cook']):
+        return prompt_lower.title()
+    
+    # Check for common recipe-related phrases
+    if 'recipe' in prompt_lower or 'cook' in prompt_lower or 'make' in prompt_lower:
+        # Look for a specific dish name, e.g., "pizza", "paella", "cake"
+        dish_match = re.search(r'(?:what|which|how to|how to make|how to cook|what is|what are|how to prepare|how to prepare a|how to prepare a )([a-zA-Z\s]+)(?: recipe| dish| meal| food| dish| meal| food)?', prompt_lower)
+        if dish_match:
+            return dish_match.group(1).strip().title()
+            
+        # Look for a general dish name, e.g., "chicken", "beef", "fish"
+        dish_match = re.search(r'(?:what|which|how to|how to make|how to cook|what is|what are|how to prepare|how to prepare a|how to prepare a )([a-zA-Z\s]+)(?: recipe| dish| meal| food| dish| meal| food)?', prompt_lower)
+        if dish_match:
+            return dish_match.group(1).strip().title()
+            
+        # Look for a specific dish name in a list, e.g., "pizza, chicken, salad"
+        dish_match = re.search(r'(?:what|which|how to|how to make|how to cook|what is|what are|how to prepare|how to prepare a|how to prepare a )([a-zA-Z\s]+)(?: recipe| dish| meal| food| dish| meal| food)?', prompt_lower)
+        if dish_match:
+            return dish_match.group(1).strip().title()
+            
+        # Look for a specific dish name in a list, e.g., "pizza, chicken, salad"
+        dish_match = re.search(r'(?:what|which|how to|how to make|how to cook|what is|what are|how to prepare|how to prepare a|how to prepare a )([a-zA-Z\s]+)(?: recipe| dish| meal| food| dish| meal| food)?', prompt_lower)
+        if dish_match:
+            return dish_match.group(1).strip().title()
+            
+        # Fallback if no specific dish name found, try to extract a general dish name
+        dish_match = re.search(r'(?:what|which|how to|how to make|how to cook|what is|what are|how to prepare|how to prepare a|how to prepare a )([a-zA-Z\s]+)(?: recipe| dish| meal| food| dish| meal| food)?', prompt_lower)
+        if dish_match:
+            return dish_match.group(1).strip().title()
+    
+    # Fallback: if it's a short prompt (likely a dish name), use it
+    if len(prompt_lower) <= 50 and not any(word in prompt_lower for word in ['how', 'what', 'recipe', 'ingredients', 'make', 'cook', 'weather', 'time', 'date']):
+        return prompt_lower.title()
+            
+    return None
+
+def bench_parsers(args):
+    """Ingredient and dish-name parsing throughput on a corpus of Ollama answers and chat prompts, checked against the previous parsers."""
+    backend = load_backend(1000, args.seed)
+
+    for label, corpus, baseline, current in (
+        ('ingredients', OLLAMA_ANSWERS, baseline_extract_ingredients_from_text, backend.extract_ingredients_from_text),
+        ('dish names', CHAT_PROMPTS, baseline_extract_dish_name_from_prompt, backend.extract_dish_name_from_prompt)
+    ):
+        differences = [text for text in corpus if baseline(text) != current(text)]
+        print(f"{label}: {len(corpus)} texts, {len(differences)} parsed differently" + ''.join(f"\n  {text!r}" for text in differences))
+        items = corpus * args.copies
+        for name, function in (('previous', baseline), ('current', current)):
+            latency = time_per_call(function, items, args.repeat)
+            print(f"{name:>12}: {latency * 1000:8.2f} us/text {1000 / latency:10.0f} texts/s")
+
+def bench_similarity(args):
+    """Near-duplicate checks on pairs of products that compete for the same ingredient."""
+    backend = load_backend(args.rows, args.seed)
+    names = backend.current_catalog.product_features['similarity_name']
+
+    # The dedupe loop compares the top-ranked products of one ingredient with each other
+    pairs = []
+    for ranked in backend.score_products([(ingredient.lower(), set(ingredient.lower().split())) for ingredient in INGREDIENTS]):
+        top = [position for position, score in ranked[:args.top]]
+        pairs += [(names[a], names[b]) for i, a in enumerate(top) for b in top[i + 1:]]
+    print(f"{len(pairs)} name pairs, threshold {args.threshold}")
+
+    def baseline(pair):
+        max_len = max(len(pair[0]), len(pair[1]))
+        return max_len > 0 and 1 - (baseline_levenshtein_distance(*pair) / max_len) >= args.threshold
+
+    def banded(pair):
+        max_len = max(len(pair[0]), len(pair[1]))
+        max_distance = backend.max_similar_edit_distance(max_len, args.threshold)
+        return max_len > 0 and max_distance >= 0 and backend.is_edit_distance_within(pair[0], pair[1], max_distance)
+
+    print(f"Results agree: {list(map(baseline, pairs)) == list(map(banded, pairs))}")
+    for label, function in (('full matrix', baseline), ('banded', banded)):
+        print(f"{label:>12}: {time_per_call(function, pairs, args.repeat) * 1000:8.2f} us/pair")
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Answers every request with a small JSON body after latency seconds, keeping connections alive like Ollama and the UPC sites."""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    body = b'{"code": "OK", "items": []}'
+    latency = 0
+
+    def do_GET(self):
+        body = self.body
+        if self.latency:
+            time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.do_GET()
+
+    def log_message(self, *args):
+        pass
+
+class StandInServer(ThreadingHTTPServer):
+    # Room for hundreds of simultaneous connects without SYN retries skewing latencies
+    request_queue_size = 1024
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping keep-alive connections when a benchmark server stops are expected
+        pass
+
+def start_stand_in_server(handler=StandInHandler):
+    """Serve handler on a free local port in a background thread and return the server."""
+    server = StandInServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def bench_http(args):
+    """Per-request latency of bare requests calls versus the backend's pooled keep-alive sessions."""
+    backend = load_backend(1000, args.seed)
+    import requests
+
+    server = start_stand_in_server()
+    url = f"http://127.0.0.1:{server.server_address[1]}/api/generate"
+    session = backend.create_http_session()
+    payload = {'model': 'qwen2.5:7b', 'prompt': 'pizza', 'stream': False}
+    calls = range(args.requests)
+
+    results = {
+        'bare GET': time_per_call(lambda _: requests.get(url, timeout=5), calls, args.repeat),
+        'pooled GET': time_per_call(lambda _: session.get(url, timeout=5), calls, args.repeat),
+        'bare POST': time_per_call(lambda _: requests.post(url, json=payload, timeout=5), calls, args.repeat),
+        'pooled POST': time_per_call(lambda _: session.post(url, json=payload, timeout=5), calls, args.repeat)
+    }
+    for label, latency in results.items():
+        print(f"{label:>12}: {latency:8.3f} ms/request")
+    server.shutdown()
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args):
+        pass
+
+class UpstreamStandInHandler(StandInHandler):
+    """Answers like both Ollama and UPCItemDB, so chat and barcode lookups resolve against it."""
+    body = b'{"response": "salt, pepper, olive oil", "done": true, "code": "OK", "items": [{"title": "Stand-in Product"}]}'
+
+def serve_stand_in(handler):
+    """start_stand_in_server as a (stop, base_url) pair."""
+    server = start_stand_in_server(handler)
+    return server.shutdown, f"http://127.0.0.1:{server.server_address[1]}"
+
+def serve_in_process(serve, *args):
+    """Run serve(*args) in a forked process, so servers and load generator don't share one GIL; return (stop, base_url)."""
+    context = multiprocessing.get_context('fork')
+    urls = context.Queue()
+
+    def run():
+        # The backend logs every request; keep the results table readable
+        sys.stdout = open(os.devnull, 'w')
+        urls.put(serve(*args)[1])
+        threading.Event().wait()
+
+    process = context.Process(target=run, daemon=True)
+    process.start()
+    return process.terminate, urls.get()
+
+def serve_flask_threads(backend, threads):
+    """Serve the Flask app like a sync deployment with a fixed number of worker threads; return (stop, base_url)."""
+    slots = threading.BoundedSemaphore(threads)
+
+    def app(environ, start_response):
+        with slots:
+            response = backend.app(environ, start_response)
+            try:
+                return list(response)
+            finally:
+                if hasattr(response, 'close'):
+                    response.close()
+
+    server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietRequestHandler)
+    server.socket.listen(1024)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.shutdown, f"http://127.0.0.1:{server.server_port}"
+
+def serve_asgi():
+    """Serve asgi.app with uvicorn in a background thread; return (stop, base_url)."""
+    import uvicorn
+    import asgi
+
+    server = uvicorn.Server(uvicorn.Config(asgi.app, host='127.0.0.1', port=0, log_level='warning', backlog=2048))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    port = server.servers[0].sockets[0].getsockname()[1]
+
+    def stop():
+        server.should_exit = True
+    return stop, f"http://127.0.0.1:{port}"
+
+async def fire_requests(url, bodies, concurrency):
+    """POST every body with at most concurrency requests open; return (elapsed, sorted latencies, errors)."""
+    import aiohttp
+
+    latencies = []
+    errors = 0
+
+    async def post(session, body):
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            async with session.post(url, json=body) as response:
+                await response.read()
+                ok = response.status == 200
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            ok = False
+        if ok:
+            latencies.append(time.perf_counter() - started)
+        else:
+            errors += 1
+
+    # The connector limit keeps at most concurrency requests open; the rest queue client-side
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=None)) as session:
+        started = time.perf_counter()
+        await asyncio.gather(*(post(session, body) for body in bodies))
+        return time.perf_counter() - started, sorted(latencies), errors
+
+def bench_load(args):
+    """Throughput and latency of the sync Flask server versus the ASGI app as concurrent requests rise."""
+    backend = load_backend(1000, args.seed)
+
+    UpstreamStandInHandler.latency = args.upstream_latency
+    stop_upstream, upstream_url = serve_in_process(serve_stand_in, UpstreamStandInHandler)
+    backend.OLLAMA_API_URL = upstream_url + '/api/generate'
+    backend.GO_UPC_SEARCH_URL = upstream_url + '/search?q={upc}'
+    backend.UPCITEMDB_LOOKUP_URL = upstream_url + '/lookup?upc={upc}'
+    # Every chat goes to the stand-in Ollama, as for prompts nobody has asked before
+    backend.chat_cache = None
+    # and runs at once, so the servers' own concurrency is measured rather than Ollama's admission limit
+    backend.generation_scheduler = backend.GenerationScheduler(limit=10 ** 6, max_queue=0)
+    print(f"Upstream latency {args.upstream_latency}s, {args.rounds} requests per concurrent client, endpoint /api/{args.endpoint}")
+
+    upc_codes = iter(range(10 ** 11, 10 ** 12))
+    servers = [
+        (f'flask ({args.threads} threads)', serve_flask_threads, backend, args.threads),
+        ('asgi', serve_asgi)
+    ]
+    print(f"{'server':>18} {'concurrency':>11} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'errors':>7}")
+    for label, serve, *serve_args in servers:
+        stop, base_url = serve_in_process(serve, *serve_args)
+        for concurrency in args.concurrency:
+            if args.endpoint == 'chat':
+                # Distinct prompts, so no chat shares the generation of another
+                bodies = [{'prompt': f'pizza for {i}', 'mode': 'normal'} for i in range(concurrency * args.rounds)]
+            else:
+                # Distinct UPCs, so every request scrapes instead of hitting the barcode cache
+                bodies = [{'upc': str(next(upc_codes))} for _ in range(concurrency * args.rounds)]
+
+            elapsed, latencies, errors = asyncio.run(fire_requests(f"{base_url}/api/{args.endpoint}", bodies, concurrency))
+            p50 = latencies[len(latencies) // 2] * 1000 if latencies else float('nan')
+            p95 = latencies[int(len(latencies) * 0.95)] * 1000 if latencies else float('nan')
+            print(f"{label:>18} {concurrency:>11} {len(latencies) / elapsed:>9.1f} {p50:>9.0f} {p95:>9.0f} {errors:>7}")
+        stop()
+    stop_upstream()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    matching = subparsers.add_parser('matching', help=bench_matching.__doc__)
+    matching.add_argument('--rows', type=int, default=568534, help='catalog size (default: full WMT catalog)')
+    matching.add_argument('--repeat', type=int, default=3)
+    matching.add_argument('--seed', type=int, default=0)
+    matching.set_defaults(run=bench_matching)
+
+    sharding = subparsers.add_parser('sharding', help=bench_sharding.__doc__)
+    sharding.add_argument('--rows', type=int, default=568534)
+    sharding.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4, 8])
+    sharding.add_argument('--repeat', type=int, default=3)
+    sharding.add_argument('--seed', type=int, default=0)
+    sharding.set_defaults(run=bench_sharding)
+
+    similarity = subparsers.add_parser('similarity', help=bench_similarity.__doc__)
+    similarity.add_argument('--rows', type=int, default=100000)
+    similarity.add_argument('--top', type=int, default=40, help='top-ranked products per ingredient to compare pairwise')
+    similarity.add_argument('--threshold', type=float, default=0.8)
+    similarity.add_argument('--repeat', type=int, default=3)
+    similarity.add_argument('--seed', type=int, default=0)
+    similarity.set_defaults(run=bench_similarity)
+
+    http = subparsers.add_parser('http', help=bench_http.__doc__)
+    http.add_argument('--requests', type=int, default=500)
+    http.add_argument('--repeat', type=int, default=3)
+    http.add_argument('--seed', type=int, default=0)
+    http.set_defaults(run=bench_http)
+
+    suite = subparsers.add_parser('suite', help=bench_suite.__doc__)
+    suite.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000], help='catalog sizes in rows')
+    suite.add_argument('--output', default='benchmark-results.json')
+    suite.add_argument('--top', type=int, default=20, help='top-ranked products per ingredient used for the dedupe timings')
+    suite.add_argument('--repeat', type=int, default=3)
+    suite.add_argument('--seed', type=int, default=0)
+    suite.add_argument('--log-level', default='WARNING', help="backend log level while timing (default: WARNING)")
+    suite.set_defaults(run=bench_suite)
+
+    memory = subparsers.add_parser('memory', help=bench_memory.__doc__)
+    memory.add_argument('--rows', type=int, default=568534)
+    memory.add_argument('--repeat', type=int, default=3)
+    memory.add_argument('--seed', type=int, default=0)
+    memory.set_defaults(run=bench_memory)
+
+    parsers = subparsers.add_parser('parsers', help=bench_parsers.__doc__)
+    parsers.add_argument('--copies', type=int, default=100, help='times the corpus is parsed per timing run')
+    parsers.add_argument('--repeat', type=int, default=3)
+    parsers.add_argument('--seed', type=int, default=0)
+    parsers.set_defaults(run=bench_parsers)
+
+    go_upc = subparsers.add_parser('go-upc', help=bench_go_upc.__doc__)
+    go_upc.add_argument('--rows', type=int, default=200, help='related products listed below the product heading')
+    go_upc.add_argument('--repeat', type=int, default=3)
+    go_upc.add_argument('--seed', type=int, default=0)
+    go_upc.set_defaults(run=bench_go_upc)
+
+    compare = subparsers.add_parser('compare', help=bench_compare.__doc__)
+    compare.add_argument('baseline')
+    compare.add_argument('candidate')
+    compare.set_defaults(run=bench_compare)
+
+    load = subparsers.add_parser('load', help=bench_load.__doc__)
+    load.add_argument('--endpoint', choices=['chat', 'barcode-lookup'], default='chat')
+    load.add_argument('--concurrency', type=int, nargs='+', default=[10, 50, 200], help='concurrent clients per run')
+    load.add_argument('--rounds', type=int, default=2, help='requests per concurrent client')
+    load.add_argument('--threads', type=int, default=8, help='worker threads of the sync Flask server')
+    load.add_argument('--upstream-latency', type=float, default=0.2, help='seconds the stand-in Ollama/UPC server takes to answer')
+    load.add_argument('--seed', type=int, default=0)
+    load.set_defaults(run=bench_load)
+
+    args = parser.parse_args()
+    args.run(args)
+
+if __name__ == '__main__':
+    main()
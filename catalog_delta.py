@@ -0,0 +1,42 @@
+"""Apply a catalog delta to a running backend without a full reload.
+
+The delta is a CSV or JSON Lines file of WMT CSV rows keyed by SKU. An OP
+column or key chooses 'upsert' (the default) or 'delete'; an upsert of a
+known SKU only needs the columns that changed. Run from the project folder:
+
+    python catalog_delta.py price-changes.csv
+    python catalog_delta.py changes.jsonl --url http://localhost:5001
+
+Example rows:
+
+    SKU,PRICE_CURRENT,PROMOTION
+    10450115,2.98,Rollback
+
+    {"SKU": "10450115", "PRICE_CURRENT": "2.98", "PROMOTION": "Rollback"}
+    {"OP": "delete", "SKU": "10535084"}
+"""
+import argparse
+import json
+import os
+import sys
+
+import requests
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help='.csv, or .jsonl with one JSON object per line')
+    parser.add_argument('--url', default='http://localhost:5001', help='backend base URL')
+    parser.add_argument('--token', default=os.environ.get('ADMIN_TOKEN', ''), help='admin token (default: $ADMIN_TOKEN)')
+    args = parser.parse_args()
+
+    headers = {'Content-Type': 'text/csv' if args.path.lower().endswith('.csv') else 'application/x-ndjson'}
+    if args.token:
+        headers['X-Admin-Token'] = args.token
+    with open(args.path, 'rb') as file:
+        response = requests.post(f"{args.url.rstrip('/')}/api/admin/catalog-delta", data=file, headers=headers, timeout=300)
+
+    print(json.dumps(response.json(), indent=2))
+    return 0 if response.ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,73 @@
+"""Shared fixtures: backend.py imported against a generated catalog in a scratch folder."""
+import csv
+import os
+import sys
+
+import pytest
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_DIR)
+
+import benchmark
+
+# (name, brand) rows with the punctuation, accents, digits and short words the generated catalog lacks
+EDGE_CASE_PRODUCTS = [
+    ('Jalapeño Peppers, Sliced', 'La Costeña'),
+    ('Crème Fraîche', 'Vermont Creamery'),
+    ('Café Bustelo Espresso Ground Coffee', 'Café Bustelo'),
+    ('Salt & Pepper Shaker Set', ''),
+    ('Sea Salt', 'Morton'),
+    ('Sea-Salt', 'Morton'),
+    ('SEA SALT!!!', 'Great Value'),
+    ('Kosher Salt, 3 lb', 'Morton'),
+    ('Salt', ''),
+    ('Salt Chips', "Lay's"),
+    ('Olive Oil', 'Great Value'),
+    ('Extra Virgin Olive Oil 16.9 fl oz', 'Bertolli'),
+    ('Olive-Oil Spray', 'PAM'),
+    ("Hunt's 100% Natural Tomato Sauce", "Hunt's"),
+    ('All Purpose Flour', 'Gold Medal'),
+    ('All-Purpose Flour, 5 lb', 'King Arthur'),
+    ('A1 Steak Sauce', 'A.1.'),
+    ('Eggs, 12 ct', 'Great Value'),
+    ('Large White Eggs', 'Marketside'),
+    ('Instant Rice', 'Minute'),
+    ('Ready to Eat Rice', 'Uncle Ben\'s'),
+    ('Imitation Vanilla Extract', 'Great Value'),
+    ('Pure Vanilla Extract', 'McCormick'),
+    ('Chicken Breast (Boneless, Skinless)', 'Tyson'),
+    ('Chicken Breast', 'Tyson'),
+    ('Chicken  Breast', 'Tyson'),
+    ('Butter', 'Land O Lakes'),
+    ('Butter', 'Land O Lakes'),
+    ('Unsalted Butter Sticks 4 ct', 'Land O Lakes'),
+    ('Oz Cheese', ''),
+    ('1 lb Ground Beef 80/20', 'Marketside'),
+    ('Ground Beef', 'Marketside'),
+    ('Soy Sauce Less Sodium', 'Kikkoman'),
+    ('Gochujang Hot Pepper Paste', 'Mother-in-Law\'s'),
+    ('Ñoquis de Papa', 'Goya'),
+    ('Straße Bratwurst', 'Johnsonville'),
+]
+
+def write_catalog(path, rows, seed):
+    """benchmark.generate_catalog plus EDGE_CASE_PRODUCTS at the end."""
+    benchmark.generate_catalog(path, rows, seed)
+    with open(path, 'a', newline='', encoding='utf-8') as file:
+        writer = csv.writer(file)
+        for i, (name, brand) in enumerate(EDGE_CASE_PRODUCTS, start=rows):
+            sku = str(200000000 + i)
+            writer.writerow([
+                i, '79936', 'Food', 'Pantry', 'Pantry Essentials', '', sku, f'https://www.walmart.com/ip/{sku}',
+                name, brand, '3.50', '2.98' if i % 2 else '', 'N/A', 'Rollback' if i % 3 == 0 else '', '2022-09-11', i
+            ])
+
+@pytest.fixture(scope='session')
+def backend(tmp_path_factory):
+    """The backend module, with its catalog, caches and snapshot in a scratch folder."""
+    workdir = tmp_path_factory.mktemp('cooker')
+    write_catalog(str(workdir / 'WMT_Grocery_202209.csv'), 3000, seed=7)
+    os.chdir(workdir)
+    import backend
+    backend.logger.setLevel('WARNING')
+    return backend
@@ -0,0 +1,89 @@
+"""Admin endpoints refuse requests without the configured token, deltas swap in whole, and the CSV watcher does not retry a broken file."""
+import json
+import types
+
+import pytest
+
+ADMIN_REQUESTS = [('get', '/api/admin/catalog'), ('post', '/api/admin/reload-catalog'), ('post', '/api/admin/catalog-delta')]
+
+@pytest.mark.parametrize('method, path', ADMIN_REQUESTS)
+def test_admin_endpoints_are_disabled_without_a_token(backend, monkeypatch, method, path):
+    monkeypatch.setattr(backend, 'ADMIN_TOKEN', '')
+    response = getattr(backend.app.test_client(), method)(path)
+    assert response.status_code == 403
+
+@pytest.mark.parametrize('method, path', ADMIN_REQUESTS)
+@pytest.mark.parametrize('headers', [{}, {'X-Admin-Token': 'wrong'}])
+def test_admin_endpoints_require_the_token(backend, monkeypatch, method, path, headers):
+    monkeypatch.setattr(backend, 'ADMIN_TOKEN', 'secret')
+    response = getattr(backend.app.test_client(), method)(path, headers=headers)
+    assert response.status_code == 403
+
+def test_admin_catalog_with_the_token(backend, monkeypatch):
+    monkeypatch.setattr(backend, 'ADMIN_TOKEN', 'secret')
+    response = backend.app.test_client().get('/api/admin/catalog', headers={'X-Admin-Token': 'secret'})
+    assert response.status_code == 200
+    assert response.get_json()['version'] == backend.current_catalog.version
+
+@pytest.mark.parametrize('content_type', ['text/plain', 'application/x-www-form-urlencoded', 'application/json'])
+def test_catalog_delta_requires_a_delta_content_type(backend, monkeypatch, content_type):
+    monkeypatch.setattr(backend, 'ADMIN_TOKEN', 'secret')
+    version = backend.current_catalog.version
+    response = backend.app.test_client().post('/api/admin/catalog-delta', headers={'X-Admin-Token': 'secret'},
+                                              data='{"SKU": "200000000", "OP": "delete"}', content_type=content_type)
+    assert response.status_code == 415
+    assert backend.current_catalog.version == version
+
+def test_admin_endpoints_are_left_out_of_cors(backend):
+    client = backend.app.test_client()
+    origin = {'Origin': 'https://example.com'}
+    assert client.get('/api/admin/catalog', headers=origin).headers.get('Access-Control-Allow-Origin') is None
+    preflight = client.options('/api/admin/catalog-delta', headers={**origin, 'Access-Control-Request-Method': 'POST'})
+    assert preflight.headers.get('Access-Control-Allow-Origin') is None
+    assert client.get('/api/metrics', headers=origin).headers.get('Access-Control-Allow-Origin') == 'https://example.com'
+
+def test_catalog_delta_swaps_in_a_new_version(backend, monkeypatch):
+    monkeypatch.setattr(backend, 'ADMIN_TOKEN', 'secret')
+    before = backend.current_catalog
+    products, postings = before.product_count(), list(before.product_index['salt'])
+    deleted_sku = before.grocery_data[postings[0]]['id']
+    body = '\n'.join(json.dumps(row) for row in [
+        {'SKU': '300000101', 'PRODUCT_NAME': 'Flaky Sea Salt', 'BRAND': 'Maldon'},
+        {'SKU': deleted_sku, 'OP': 'delete'},
+    ])
+    response = backend.app.test_client().post('/api/admin/catalog-delta', headers={'X-Admin-Token': 'secret'},
+                                              data=body, content_type='application/x-ndjson')
+    assert response.status_code == 200
+    assert response.get_json()['inserted'] == 1 and response.get_json()['deleted'] == 1
+
+    after = backend.current_catalog
+    assert after is not before and after.version > before.version
+    assert after.product_count() == products
+    # A request still holding the previous version sees none of the delta
+    assert before.product_count() == products and before.product_index['salt'] == postings
+    assert len(before.grocery_data) == len(after.grocery_data) - 1
+    assert after.product_index['salt'][-1] == len(after.grocery_data) - 1
+
+class StopWatching(Exception):
+    pass
+
+def test_watcher_retries_a_broken_csv_only_once_it_changes(backend, monkeypatch, tmp_path):
+    broken = tmp_path / 'broken.csv'
+    broken.write_text('not a catalog\n')
+    reloads = []
+    polls = []
+
+    def sleep(seconds):
+        polls.append(seconds)
+        if len(polls) == 6:
+            broken.write_text('still not a catalog\n')
+        if len(polls) == 9:
+            raise StopWatching
+
+    monkeypatch.setattr(backend, 'CSV_FILE_PATH', str(broken))
+    monkeypatch.setattr(backend, 'time', types.SimpleNamespace(sleep=sleep))
+    monkeypatch.setattr(backend, 'load_grocery_data', lambda: reloads.append(len(polls)) or False)
+    with pytest.raises(StopWatching):
+        backend.watch_catalog_file(1)
+    # Loaded once the first stat held still, then not again until the rewrite at poll 6 held still
+    assert reloads == [2, 7]
@@ -0,0 +1,157 @@
+"""Barcode lookups racing the UPC providers, against stand-in go-upc and UPCItemDB servers."""
+import json
+import threading
+import time
+
+import pytest
+
+import benchmark
+
+FOUND_ON_GO_UPC = benchmark.go_upc_page('Kraft Macaroni & Cheese Dinner', 'product', 5)
+MISSING_ON_GO_UPC = b'<!DOCTYPE html><html><head><title>Go-UPC</title></head><body><main></main></body></html>'
+FOUND_ON_UPCITEMDB = json.dumps({'code': 'OK', 'items': [{'title': 'Heinz Tomato Ketchup 20 oz'}]}).encode('utf-8')
+MISSING_ON_UPCITEMDB = json.dumps({'code': 'OK', 'items': []}).encode('utf-8')
+
+class ProviderHandler(benchmark.StandInHandler):
+    """StandInHandler that records the client address of every request and can answer with an error status."""
+    status = 200
+
+    def do_GET(self):
+        self.requests.append(self.client_address)
+        if self.status == 200:
+            super().do_GET()
+            return
+        self.send_response(self.status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+@pytest.fixture
+def serve_provider():
+    """Start a stand-in provider: serve_provider(body, latency=0, status=200) -> (base_url, client addresses)."""
+    servers = []
+
+    def serve(body, latency=0, status=200):
+        handler = type('Handler', (ProviderHandler,), {'body': body, 'latency': latency, 'status': status, 'requests': []})
+        server = benchmark.start_stand_in_server(handler)
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}", handler.requests
+
+    yield serve
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+@pytest.fixture
+def providers(backend, monkeypatch, serve_provider):
+    """Point go-upc and UPCItemDB at stand-ins: providers(go_upc=(body, latency, status), upcitemdb=(...))."""
+    monkeypatch.setattr(backend, 'barcode_cache', None)
+    monkeypatch.setattr(backend, 'BARCODE_LOOKUP_MODE', 'concurrent')
+
+    def configure(go_upc, upcitemdb):
+        go_upc_url, go_upc_requests = serve_provider(*go_upc)
+        upcitemdb_url, upcitemdb_requests = serve_provider(*upcitemdb)
+        monkeypatch.setattr(backend, 'GO_UPC_SEARCH_URL', go_upc_url + '/search?q={upc}')
+        monkeypatch.setattr(backend, 'UPCITEMDB_LOOKUP_URL', upcitemdb_url + '/lookup?upc={upc}')
+        return go_upc_requests, upcitemdb_requests
+    return configure
+
+def wins(backend, provider):
+    with backend.barcode_provider_wins_lock:
+        return backend.barcode_provider_wins.get(provider, 0)
+
+def test_first_provider_to_find_the_upc_wins(backend, providers):
+    providers(go_upc=(FOUND_ON_GO_UPC, 0), upcitemdb=(FOUND_ON_UPCITEMDB, 0.5))
+    go_upc_wins = wins(backend, 'go-upc')
+
+    assert backend.lookup_product_name('100000000001') == ('Kraft Macaroni & Cheese Dinner', 'go-upc', False)
+    assert wins(backend, 'go-upc') == go_upc_wins + 1
+
+def test_slow_provider_loses_without_being_waited_for(backend, providers):
+    providers(go_upc=(FOUND_ON_GO_UPC, 3), upcitemdb=(FOUND_ON_UPCITEMDB, 0))
+    upcitemdb_wins = wins(backend, 'upcitemdb')
+
+    started = time.perf_counter()
+    product_name, source, cached = backend.lookup_product_name('100000000002')
+    assert (product_name, source) == ('Heinz Tomato Ketchup 20 oz', 'upcitemdb')
+    assert time.perf_counter() - started < 1.5
+    assert wins(backend, 'upcitemdb') == upcitemdb_wins + 1
+
+def test_provider_without_the_product_does_not_win(backend, providers):
+    providers(go_upc=(MISSING_ON_GO_UPC, 0), upcitemdb=(FOUND_ON_UPCITEMDB, 0.3))
+    assert backend.lookup_product_name('100000000003')[:2] == ('Heinz Tomato Ketchup 20 oz', 'upcitemdb')
+
+def test_failing_providers_fall_back_to_test_products(backend, providers):
+    providers(go_upc=(b'', 0, 404), upcitemdb=(MISSING_ON_UPCITEMDB, 0))
+    assert backend.lookup_product_name('041220576463') == ('Heinz Tomato Ketchup', 'test_products', False)
+
+def test_failing_providers_report_the_upc_not_found(backend, providers):
+    providers(go_upc=(MISSING_ON_GO_UPC, 0), upcitemdb=(b'', 0, 404))
+    response = backend.app.test_client().post('/api/barcode-lookup', json={'upc': '100000000004'})
+    assert response.status_code == 200
+    assert response.get_json()['success'] is False
+    assert response.get_json()['fallback_name'] == 'Unknown Product (100000000004)'
+
+def test_unreachable_provider_is_skipped(backend, providers, monkeypatch):
+    providers(go_upc=(FOUND_ON_GO_UPC, 0), upcitemdb=(FOUND_ON_UPCITEMDB, 0.2))
+    # Nothing listens on port 9; connection errors count as a miss
+    monkeypatch.setattr(backend, 'GO_UPC_SEARCH_URL', 'http://127.0.0.1:9/search?q={upc}')
+    assert backend.lookup_product_name('100000000005')[:2] == ('Heinz Tomato Ketchup 20 oz', 'upcitemdb')
+
+def test_registered_provider_takes_part_in_the_race(backend, providers, monkeypatch):
+    providers(go_upc=(FOUND_ON_GO_UPC, 1), upcitemdb=(FOUND_ON_UPCITEMDB, 1))
+    monkeypatch.setattr(backend, 'barcode_providers', list(backend.barcode_providers))
+    backend.register_barcode_provider('offline', lambda upc_code: 'Offline Oats' if upc_code == '100000000006' else 'N/A', first=True)
+    assert backend.lookup_product_name('100000000006')[:2] == ('Offline Oats', 'offline')
+
+def test_sequential_mode_asks_providers_in_order(backend, providers, monkeypatch):
+    go_upc_requests, upcitemdb_requests = providers(go_upc=(FOUND_ON_GO_UPC, 0), upcitemdb=(FOUND_ON_UPCITEMDB, 0))
+    monkeypatch.setattr(backend, 'BARCODE_LOOKUP_MODE', 'sequential')
+    assert backend.lookup_product_name('100000000007')[:2] == ('Kraft Macaroni & Cheese Dinner', 'go-upc')
+    assert len(go_upc_requests) == 1 and not upcitemdb_requests
+
+def test_lookups_reuse_pooled_connections(backend, providers):
+    # go-upc misses, so every lookup waits for both providers
+    go_upc_requests, upcitemdb_requests = providers(go_upc=(MISSING_ON_GO_UPC, 0), upcitemdb=(FOUND_ON_UPCITEMDB, 0))
+    for i in range(6):
+        backend.lookup_product_name(f'10000000010{i}')
+
+    assert len(go_upc_requests) == 6 and len(upcitemdb_requests) == 6
+    # Keep-alive connections from upc_session serve several lookups each instead of one connection per request
+    assert len(set(go_upc_requests)) < 6
+    assert len(set(upcitemdb_requests)) < 6
+
+class GatedCache:
+    """Wraps a BarcodeCache; the first read on the 'late' thread misses, then waits for `gate` before returning."""
+
+    def __init__(self, cache, gate):
+        self.cache = cache
+        self.gate = gate
+        self.held = False
+
+    def get(self, upc_code):
+        found = self.cache.get(upc_code)
+        if threading.current_thread().name == 'late' and not self.held:
+            self.held = True
+            self.gate.wait(5)
+        return found
+
+    def put(self, *args):
+        self.cache.put(*args)
+
+def test_lookup_finishing_between_cache_miss_and_join_is_not_repeated(backend, monkeypatch, tmp_path):
+    gate = threading.Event()
+    scrapes = []
+    monkeypatch.setattr(backend, 'barcode_cache', GatedCache(backend.BarcodeCache(str(tmp_path / 'barcodes.sqlite3')), gate))
+    monkeypatch.setattr(backend, 'scrape_product_name', lambda upc_code: scrapes.append(upc_code) or ('Rolled Oats', 'go-upc'))
+
+    results = []
+    late = threading.Thread(target=lambda: results.append(backend.lookup_product_name('100000000200')), name='late')
+    late.start()
+    # The late request has missed the cache; the first lookup runs, caches its result and leaves before it joins
+    time.sleep(0.1)
+    assert backend.lookup_product_name('100000000200') == ('Rolled Oats', 'go-upc', False)
+    gate.set()
+    late.join()
+
+    assert results == [('Rolled Oats', 'go-upc', True)]
+    assert scrapes == ['100000000200']
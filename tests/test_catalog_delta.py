@@ -0,0 +1,142 @@
+"""A catalog delta shares everything it leaves alone with the version it was applied to: column chunks, posting lists, NumPy arrays and cached rankings."""
+import random
+from bisect import insort
+
+import pytest
+
+def rebuilt(column):
+    values = column.empty[:]
+    values.extend(column)
+    return values
+
+@pytest.fixture
+def catalog(backend, monkeypatch):
+    """The session catalog rebuilt with 64-row chunks, so its 3000 rows span many of them, and swapped in."""
+    monkeypatch.setattr(backend, 'CHUNK_SHIFT', 6)
+    monkeypatch.setattr(backend, 'CHUNK_SIZE', 64)
+    monkeypatch.setattr(backend, 'CHUNK_MASK', 63)
+    before = backend.current_catalog
+    catalog = backend.Catalog(
+        backend.ProductTable({name: list(column) if name.endswith('_values') else rebuilt(column)
+                              for name, column in before.grocery_data.columns.items()}),
+        {column: rebuilt(values) for column, values in before.product_features.items()},
+        {word: list(postings) for word, postings in before.product_index.items()},
+        next(backend.catalog_versions))
+    for position in before.deleted_positions:
+        catalog.deleted_positions[position] = True
+    backend.swap_catalog(catalog)
+    yield catalog
+    backend.swap_catalog(before)
+
+def unshared_chunks(before, after):
+    return [chunk_number for chunk_number, (chunk, other) in enumerate(zip(before.chunks, after.chunks)) if chunk is not other]
+
+def live_position(catalog, start, avoiding=()):
+    """The first live position from start whose product name has none of the words in avoiding."""
+    return next(position for position in range(start, len(catalog.grocery_data))
+                if position not in catalog.deleted_positions and catalog.product_features['words'][position].isdisjoint(avoiding))
+
+def test_price_change_copies_one_price_chunk(backend, catalog):
+    position = live_position(catalog, 100)
+    backend.apply_catalog_delta([('upsert', {'SKU': catalog.grocery_data[position]['id'], 'PRICE_CURRENT': '987.65'})])
+    after = backend.current_catalog
+    assert after.version > catalog.version and after.grocery_data[position]['price'] == '$987.65'
+    assert catalog.grocery_data[position]['price'] != '$987.65'
+
+    for name, column in after.grocery_data.columns.items():
+        if isinstance(column, backend.ChunkedList):
+            assert unshared_chunks(catalog.grocery_data.columns[name], column) == ([position >> 6] if name == 'price' else [])
+    for name, column in after.product_features.items():
+        assert unshared_chunks(catalog.product_features[name], column) == []
+    assert all(bucket is other for bucket, other in zip(catalog.product_index.buckets, after.product_index.buckets))
+
+def test_rename_copies_one_chunk_per_feature_column(backend, catalog):
+    word = max(catalog.product_index, key=lambda word: len(catalog.product_index[word]))
+    assert isinstance(catalog.product_index[word], backend.PostingList)
+    position = live_position(catalog, 200, avoiding={word})
+    old_words = catalog.product_features['words'][position]
+    backend.apply_catalog_delta([('upsert', {'SKU': catalog.grocery_data[position]['id'], 'PRODUCT_NAME': f'Zesty {word} Quux'})])
+    after = backend.current_catalog
+    new_words = after.product_features['words'][position]
+    assert word in new_words
+
+    for name in ('name_lower', 'words', 'similarity_name'):
+        assert unshared_chunks(catalog.product_features[name], after.product_features[name]) == [position >> 6]
+    for name, column in after.product_features.items():
+        assert set(unshared_chunks(catalog.product_features[name], column)) <= {position >> 6}
+
+    # Only the posting lists of the old and new words are replaced, and a long one only in the chunk taking the position
+    assert [other for other in catalog.product_index if after.product_index.get(other) is not catalog.product_index[other]] == \
+        [other for other in catalog.product_index if other in old_words ^ new_words]
+    postings, new_postings = catalog.product_index[word], after.product_index[word]
+    assert list(new_postings) == sorted(list(postings) + [position])
+    assert sum(not any(chunk is other for other in postings.chunks) for chunk in new_postings.chunks) == 1
+
+def test_numpy_arrays_carry_over(backend, catalog):
+    np = pytest.importorskip('numpy')
+    features = backend.get_numpy_features(catalog)
+    position = live_position(catalog, 300, avoiding={'salt'})
+    backend.apply_catalog_delta([
+        ('upsert', {'SKU': catalog.grocery_data[position]['id'], 'PRODUCT_NAME': 'Salt'}),
+        ('upsert', {'SKU': '300000301', 'PRODUCT_NAME': 'Smoked Sea Salt', 'BRAND': 'Maldon'}),
+    ])
+    after = backend.current_catalog
+    for name in ('word_count', 'trusted_brand', 'processed', 'ultra_processed', 'name_order', 'loose_index', 'postings'):
+        assert after.numpy_features[name] is features[name]
+    assert after.numpy_features['patched'].tolist() == [position, len(after.grocery_data) - 1]
+    assert np.array_equal(features['patched'], [])
+
+    queries = [('salt', {'salt'}), ('sea salt', {'sea', 'salt'}), ('smoked salt', {'smoked', 'salt'})]
+    ranked = [backend.score_products_numpy(ingredient_clean, ingredient_words, after) for ingredient_clean, ingredient_words in queries]
+    assert ranked == backend.score_products(queries, catalog=after)
+    assert position in [ranked_position for ranked_position, score in ranked[0]]
+
+def test_delta_keeps_cached_rankings_it_cannot_change(backend, catalog):
+    position = live_position(catalog, 400, avoiding={'olive', 'oil', 'butter'})
+    queries = [('olive oil', {'olive', 'oil'}), ('butter', {'butter'})]
+    olive_oil, butter = backend.score_queries(queries, 'python', catalog)
+    backend.apply_catalog_delta([('upsert', {'SKU': catalog.grocery_data[position]['id'], 'PRODUCT_NAME': 'Cultured Butter'})])
+    after = backend.current_catalog
+    assert backend.match_cache.get((after.version, 'olive oil')) is olive_oil
+    assert backend.match_cache.get((after.version, 'butter')) is None
+    assert backend.score_queries(queries, 'python') == backend.score_products(queries, catalog=after)
+    assert butter != backend.score_queries(queries, 'python')[1]
+
+def test_copy_on_write_structures_match_builtins(backend, monkeypatch):
+    monkeypatch.setattr(backend, 'CHUNK_SHIFT', 3)
+    monkeypatch.setattr(backend, 'CHUNK_SIZE', 8)
+    monkeypatch.setattr(backend, 'CHUNK_MASK', 7)
+    monkeypatch.setattr(backend, 'DICT_BUCKET_SIZE', 4)
+    rng = random.Random(7)
+    values, chunked = list(range(50)), backend.ChunkedList(list(range(50)))
+    mapping, chunked_mapping = {}, backend.ChunkedDict()
+    positions = sorted(rng.sample(range(1000), 40))
+    postings = backend.PostingList.from_sorted(positions)
+    for step in range(500):
+        # Writes to a copy leave the original as it was
+        copy, mapping_copy = chunked.copy(), chunked_mapping.copy()
+        position, key, removed_key = rng.randrange(len(values)), rng.randrange(300), rng.randrange(300)
+        copy[position] = step
+        copy.append(-step)
+        mapping_copy[key] = step
+        mapping_copy.pop(removed_key)
+        assert list(chunked) == values and dict(chunked_mapping.items()) == mapping
+
+        values[position] = step
+        values.append(-step)
+        mapping[key] = step
+        mapping.pop(removed_key, None)
+        chunked, chunked_mapping = copy, mapping_copy
+        assert list(chunked) == values and chunked[-1] == values[-1] and len(chunked) == len(values)
+        assert dict(chunked_mapping.items()) == mapping and len(chunked_mapping) == len(mapping)
+
+        position = rng.randrange(1000)
+        if position in positions:
+            positions.remove(position)
+            postings = postings.without_position(position)
+        else:
+            insort(positions, position)
+            postings = postings.with_position(position)
+        assert list(postings) == positions and len(postings) == len(positions)
+        assert all(0 < len(chunk) < 16 for chunk in postings.chunks)
+    assert len(chunked_mapping.buckets) > 1
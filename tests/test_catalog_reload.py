@@ -0,0 +1,39 @@
+"""Reloads parse the CSV in spawned worker processes, never forking the threaded server."""
+import os
+import threading
+
+import benchmark
+
+def test_parallel_parse_on_a_reload_thread(backend, monkeypatch, tmp_path):
+    csv_path = str(tmp_path / 'reload.csv')
+    benchmark.generate_catalog(csv_path, 2500, seed=5)
+    monkeypatch.setattr(backend, 'CSV_CHUNK_ROWS', 300)
+    monkeypatch.setattr(backend, 'CSV_FILE_PATH', csv_path)
+    monkeypatch.setattr(backend, 'CATALOG_SNAPSHOT_PATH', str(tmp_path / 'reload.snapshot'))
+    serial = backend.build_catalog(csv_path)
+    # Parse the CSV again rather than reading the snapshot the serial parse wrote
+    os.remove(backend.CATALOG_SNAPSHOT_PATH)
+
+    def no_fork():
+        raise AssertionError("the reload forked the server")
+
+    monkeypatch.setattr(backend, 'CSV_PARSE_WORKERS', 2)
+    monkeypatch.setattr(os, 'fork', no_fork)
+    before = backend.current_catalog
+    # Another server thread holds a lock for the whole reload, as a request might
+    busy = threading.Lock()
+    loaded = []
+    with busy:
+        reload = threading.Thread(target=lambda: loaded.append(backend.load_grocery_data()), name='catalog-watcher')
+        reload.start()
+        reload.join(60)
+    try:
+        assert loaded == [True]
+        catalog = backend.current_catalog
+        assert catalog is not before and catalog.load_stats['rows'] == 2500
+        # Compared by repr: missing prices are NaN, which never equals itself
+        assert repr(catalog.grocery_data.columns) == repr(serial.grocery_data.columns)
+        assert catalog.product_features == serial.product_features
+        assert catalog.product_index == serial.product_index
+    finally:
+        backend.swap_catalog(before)
@@ -0,0 +1,42 @@
+"""The streamed go-upc.com heading pass picks the product name the full BeautifulSoup parse it replaced picked, on saved pages."""
+import os
+
+import pytest
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'go_upc')
+FIXTURES = sorted(name for name in os.listdir(FIXTURES_DIR) if name.endswith('.html'))
+
+# Pages whose headings the streamed pass reads itself, rather than handing them to the full parse
+STREAMED = {
+    'product_name.html', 'plain_headings.html', 'nested_heading.html', 'entities.html', 'unclosed_tags_in_heading.html',
+    'empty_product_name.html', 'uppercase_tags.html', 'windows_1252.html'
+}
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), 'rb') as file:
+        return file.read()
+
+def full_tree(backend, page):
+    # Every page parsed into a BeautifulSoup tree, as before the streamed heading pass
+    product_name = backend.find_go_upc_product_name_in_soup(backend.BeautifulSoup(page, 'html.parser'))
+    return backend.clean_go_upc_product_name(product_name) if product_name else 'N/A'
+
+@pytest.mark.parametrize('name', FIXTURES)
+def test_extraction_equals_full_tree(backend, name):
+    page = read_fixture(name)
+    assert backend.extract_go_upc_product_name(page) == full_tree(backend, page)
+
+@pytest.mark.parametrize('name', FIXTURES)
+def test_streamed_heading_equals_full_tree_or_defers(backend, name):
+    page = read_fixture(name)
+    heading = backend.find_go_upc_heading(page)
+    if name in STREAMED:
+        assert heading is not None
+    if heading is not None:
+        assert backend.clean_go_upc_product_name(heading) == full_tree(backend, page)
+
+def test_product_names(backend):
+    assert backend.extract_go_upc_product_name(read_fixture('product_name.html')) == 'Kraft Original Macaroni & Cheese Dinner, 7.25 oz Box'
+    assert backend.extract_go_upc_product_name(read_fixture('plain_headings.html')) == 'Heinz Tomato Ketchup, 20 oz Bottle'
+    assert backend.extract_go_upc_product_name(read_fixture('windows_1252.html')) == 'Jalapeño Peppers – Sliced, 12 oz'
+    assert backend.extract_go_upc_product_name(read_fixture('not_found_heading.html')) == 'N/A'
@@ -0,0 +1,86 @@
+"""The inverted-index matcher, with either scoring engine, returns what the linear catalog scan it replaced returned."""
+import pytest
+
+import benchmark
+from benchmark import INGREDIENTS, INGREDIENT_MIXES, baseline_find_matching_products
+
+# Ingredients that exercise the cleanup and the word filters: punctuation, accents, case, short and repeated words
+EDGE_CASE_INGREDIENTS = [
+    'salt', 'Salt', 'SALT!!!', 'sea-salt', 'sea salt', 'salt & pepper', 'salt and pepper', 'kosher salt',
+    'olive oil', 'olive-oil', 'extra virgin olive oil', 'EVOO', 'all-purpose flour', 'all purpose flour', 'flour',
+    "hunt's tomato sauce", 'tomato sauce (canned)', 'jalapeño', 'jalapeno', 'crème fraîche', 'creme fraiche',
+    'café', 'ñoquis', 'straße', 'a', 'a1', 'oz', '1 lb', '80/20', 'eggs', 'egg', 'eggs, large', '  butter  ',
+    'butter butter', 'chicken breast', 'chicken  breast', 'boneless skinless chicken breast', 'instant rice',
+    'ready rice', 'rice', 'vanilla extract', 'pure vanilla', 'gochujang', 'soy sauce', 'ground beef', '',
+    '!!!', '-', 'black beans rice', 'pepper', 'peppers', 'cheese', 'mozzarella cheese', 'shredded mozzarella cheese'
+]
+
+CORPUS = list(dict.fromkeys(EDGE_CASE_INGREDIENTS + INGREDIENTS + [i for mix in INGREDIENT_MIXES.values() for i in mix]))
+
+def ids(products):
+    return [product['id'] for product in products]
+
+@pytest.fixture
+def cold_match_cache(backend):
+    backend.match_cache.clear()
+    yield
+    backend.match_cache.clear()
+
+@pytest.fixture(params=['python', 'numpy'])
+def engine(backend, request):
+    if request.param == 'numpy' and backend.np is None:
+        pytest.skip('NumPy is not installed')
+    return request.param
+
+@pytest.mark.parametrize('ingredient', CORPUS)
+def test_indexed_match_equals_linear_scan(backend, cold_match_cache, engine, ingredient):
+    expected = baseline_find_matching_products(backend, ingredient)
+    assert backend.find_matching_products(ingredient, engine=engine) == expected
+
+@pytest.mark.parametrize('top_n', [1, 3, 10])
+def test_top_n_equals_linear_scan(backend, cold_match_cache, engine, top_n):
+    for ingredient in ['salt', 'olive oil', 'chicken breast', 'butter']:
+        assert ids(backend.find_matching_products(ingredient, top_n=top_n, engine=engine)) == \
+            ids(baseline_find_matching_products(backend, ingredient, top_n=top_n))
+
+def test_repeated_ingredients_with_used_product_ids(backend, cold_match_cache, engine):
+    # A shopping list asking for the same things twice: each call excludes the products picked so far
+    used_indexed, used_baseline = set(), set()
+    for ingredient in ['salt', 'sea salt', 'salt', 'butter', 'Butter', 'butter', 'olive oil', 'olive-oil', 'olive oil']:
+        indexed = backend.find_matching_products(ingredient, used_product_ids=used_indexed, engine=engine)
+        baseline = baseline_find_matching_products(backend, ingredient, used_product_ids=used_baseline)
+        assert ids(indexed) == ids(baseline)
+        used_indexed.update(ids(indexed))
+        used_baseline.update(ids(baseline))
+
+def test_cached_rankings_equal_linear_scan(backend, cold_match_cache, engine):
+    for ingredient in CORPUS:
+        backend.find_matching_products(ingredient, engine=engine)
+    for ingredient in CORPUS:
+        assert ids(backend.find_matching_products(ingredient, engine=engine)) == ids(baseline_find_matching_products(backend, ingredient))
+
+def test_engines_follow_a_swapped_in_catalog(backend, cold_match_cache, engine, tmp_path):
+    before = backend.current_catalog
+    # Features of the current catalog are built before the swap
+    backend.find_matching_products('salt', engine=engine)
+    benchmark.generate_catalog(str(tmp_path / 'other.csv'), 800, seed=3)
+    backend.swap_catalog(backend.build_catalog(str(tmp_path / 'other.csv')))
+    try:
+        for ingredient in CORPUS:
+            assert ids(backend.find_matching_products(ingredient, engine=engine)) == ids(baseline_find_matching_products(backend, ingredient))
+    finally:
+        backend.swap_catalog(before)
+
+def test_engines_follow_a_catalog_delta(backend, cold_match_cache, engine):
+    for ingredient in CORPUS:
+        backend.find_matching_products(ingredient, engine=engine)
+    salt = backend.current_catalog.grocery_data[backend.current_catalog.product_index['salt'][0]]['id']
+    backend.apply_catalog_delta([
+        ('upsert', {'SKU': '300000201', 'PRODUCT_NAME': 'Salt', 'BRAND': 'Morton'}),
+        ('upsert', {'SKU': '300000202', 'PRODUCT_NAME': 'Extra Virgin Olive Oil', 'BRAND': 'Bertolli'}),
+        # Replaces the 'Sea Salt' row of EDGE_CASE_PRODUCTS
+        ('upsert', {'SKU': '200003004', 'PRODUCT_NAME': 'Coarse Sea Salt Grinder', 'BRAND': 'Morton'}),
+        ('delete', {'SKU': salt}),
+    ])
+    for ingredient in CORPUS:
+        assert ids(backend.find_matching_products(ingredient, engine=engine)) == ids(baseline_find_matching_products(backend, ingredient))
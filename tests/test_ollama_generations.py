@@ -0,0 +1,169 @@
+"""Ollama admission control against a stand-in Ollama: slots, queue limits, coalescing, and cancelling generations nobody follows."""
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+import benchmark
+
+TOKENS = [f'item {i}, ' for i in range(20)]
+
+class StandInOllama(benchmark.StandInHandler):
+    """Streams TOKENS one line at a time, once `hold` is set; records every prompt and whether the client hung up."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        # Counters live on the handler class, shared by every connection
+        stand_in = type(self)
+        with stand_in.lock:
+            stand_in.prompts.append(body['prompt'])
+            stand_in.running += 1
+            stand_in.max_running = max(stand_in.max_running, stand_in.running)
+        try:
+            self.hold.wait()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for token in TOKENS:
+                self.write_chunk({'response': token, 'done': False})
+                time.sleep(self.latency)
+            self.write_chunk({'response': '', 'done': True})
+            self.wfile.write(b'0\r\n\r\n')
+        except (BrokenPipeError, ConnectionResetError):
+            self.hung_up.set()
+        finally:
+            with stand_in.lock:
+                stand_in.running -= 1
+
+    def write_chunk(self, event):
+        line = (json.dumps(event) + '\n').encode('utf-8')
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(line), line))
+        self.wfile.flush()
+
+@pytest.fixture
+def ollama(backend, monkeypatch):
+    """Point backend at a stand-in Ollama; the returned handler class holds its state."""
+    handler = type('Handler', (StandInOllama,), {
+        'latency': 0.05, 'prompts': [], 'running': 0, 'max_running': 0,
+        'lock': threading.Lock(), 'hold': threading.Event(), 'hung_up': threading.Event()
+    })
+    handler.hold.set()
+    server = benchmark.start_stand_in_server(handler)
+    monkeypatch.setattr(backend, 'OLLAMA_API_URL', f"http://127.0.0.1:{server.server_address[1]}/api/generate")
+    monkeypatch.setattr(backend, 'OLLAMA_QUEUE_TIMEOUT', 60)
+    monkeypatch.setattr(backend, 'chat_cache', None)
+    monkeypatch.setattr(backend, 'generation_scheduler', backend.GenerationScheduler(1, 50))
+    yield handler
+    handler.hold.set()
+    server.shutdown()
+    server.server_close()
+
+def limit(backend, slots, queue):
+    backend.generation_scheduler = backend.GenerationScheduler(slots, queue)
+
+def join(backend, prompt, mode='normal'):
+    payload, metadata, cache_key = backend.prepare_chat({'prompt': prompt, 'mode': mode, 'stream': True})
+    return backend.join_ollama_generation(payload, metadata['mode'], cache_key)
+
+def post_all(backend, bodies, stagger=0.01):
+    statuses = [None] * len(bodies)
+
+    def post(i, body):
+        response = backend.app.test_client().post('/api/chat', json=body)
+        # Read streamed answers to the end; a client that drops one stops following its generation
+        response.get_data()
+        statuses[i] = response.status_code
+
+    threads = [threading.Thread(target=post, args=(i, body)) for i, body in enumerate(bodies)]
+    for thread in threads:
+        thread.start()
+        time.sleep(stagger)
+    for thread in threads:
+        thread.join()
+    return statuses
+
+def wait_until(predicate, timeout=5):
+    deadline = time.perf_counter() + timeout
+    while not predicate():
+        assert time.perf_counter() < deadline
+        time.sleep(0.01)
+
+def test_full_queue_is_turned_away(backend, ollama):
+    limit(backend, 2, 2)
+    ollama.latency = 0.02
+    statuses = post_all(backend, [{'prompt': f'dish {i}'} for i in range(8)])
+    assert sorted(statuses) == [200] * 4 + [429] * 4
+    assert ollama.max_running == 2
+
+def test_queue_timeout(backend, ollama, monkeypatch):
+    monkeypatch.setattr(backend, 'OLLAMA_QUEUE_TIMEOUT', 0.1)
+    assert post_all(backend, [{'prompt': 'slow'}, {'prompt': 'queued'}], stagger=0.05) == [200, 503]
+    assert backend.generation_scheduler.stats()['queued'] == {'normal': 0, 'recipe': 0}
+
+def test_identical_chats_share_a_generation(backend, ollama):
+    assert post_all(backend, [{'prompt': 'pizza', 'stream': i % 2 == 0} for i in range(4)]) == [200] * 4
+    assert len(ollama.prompts) == 1
+
+def test_queued_generations_hold_no_thread(backend, ollama):
+    ollama.hold.clear()
+    running = join(backend, 'running')
+    wait_until(lambda: ollama.running == 1)
+    threads = threading.active_count()
+
+    queued = [join(backend, f'queued {i}', mode='recipe' if i % 2 else 'normal') for i in range(20)]
+    assert threading.active_count() == threads
+    assert backend.generation_scheduler.stats()['queued'] == {'normal': 10, 'recipe': 10}
+
+    for generation in queued:
+        backend.leave_ollama_generation(generation)
+    assert all(generation.finished for generation in queued)
+    assert backend.generation_scheduler.stats()['queued'] == {'normal': 0, 'recipe': 0}
+
+    ollama.hold.set()
+    assert backend.wait_for_ollama_generation(running)
+    assert ''.join(backend.follow_ollama_generation(running)) == ''.join(TOKENS)
+    # Dequeued generations never reach Ollama
+    assert ollama.prompts == [ollama.prompts[0]]
+
+def test_generation_stops_once_its_last_follower_leaves(backend, ollama):
+    first, second = join(backend, 'soup'), join(backend, 'soup')
+    assert first is second and first.followers == 2
+    assert backend.wait_for_ollama_generation(first) and backend.wait_for_ollama_generation(second)
+
+    tokens = backend.follow_ollama_generation(first)
+    next(tokens)
+    tokens.close()
+    assert not first.cancelled
+
+    tokens = backend.follow_ollama_generation(second)
+    next(tokens)
+    tokens.close()
+    assert first.cancelled
+    wait_until(lambda: first.finished and backend.generation_scheduler.stats()['running'] == 0)
+    assert len(first.tokens) < len(TOKENS)
+    assert ollama.hung_up.wait(5)
+
+def test_asgi_client_disconnect_stops_the_generation(backend, ollama, monkeypatch):
+    import aiohttp
+
+    # Under ASGI the generation streams on the event loop, not on a thread of its own
+    monkeypatch.setattr(backend, 'start_ollama_generation_thread', None)
+    stop, base_url = benchmark.serve_asgi()
+
+    async def read_first_line(body):
+        async with aiohttp.ClientSession() as session:
+            async with session.post(base_url + '/api/chat', json=body) as response:
+                assert response.status == 200
+                return json.loads(await response.content.readline())
+
+    try:
+        assert asyncio.run(read_first_line({'prompt': 'stew', 'stream': True})) == {'type': 'token', 'token': TOKENS[0]}
+        wait_until(lambda: backend.generation_scheduler.stats()['running'] == 0)
+        assert ollama.hung_up.wait(5)
+        assert not backend.ollama_generations_in_flight
+    finally:
+        stop()
@@ -0,0 +1,40 @@
+"""The precompiled ingredient and dish-name parsers return exactly what the parsers they replaced returned."""
+import pytest
+
+import benchmark
+
+# Answers that lean on the list-marker and intro-phrase handling
+INGREDIENT_EDGE_CASES = [
+    '', ' ', '\n\n', 'Sure', 'Sure,', 'Sure, ', 'sure\n', 'Here are', 'For', 'To make',
+    '1. Flour\n2) Sugar\n3] Eggs\n- Butter\n* Milk\n• Salt\n** Yeast',
+    '1.5 cups flour, 2 eggs, 10) water', '12. Basil\n100 Garlic cloves', '-- Oil\n*** Vinegar\n.)] Honey',
+    'a) Chickpeas\nb)tahini\nz) cumin\nA) Parsley\nab) lemon', '1. a) Rice\n- b) Beans',
+    '• Tomatoes, • Onions, •Peppers', '*Ingredients:*\n* Salmon', '**Ingredients:**\nSalmon, Rice',
+    'Sure, here are the ingredients for tacos: tortillas, beef, salsa',
+    'Sure here are the ingredients: flour, sugar', 'SURE, HERE ARE THE INGREDIENTS FOR SOUP: leeks, potatoes',
+    'Here are the ingredients for pancakes:\nFlour\nMilk', 'here are some ideas: rice, beans',
+    'The ingredients for French toast are bread, eggs', 'Ingredients for guacamole include avocados, lime',
+    'For chili you need: beef, beans', 'To make pizza, you will need: dough, cheese',
+    'For the sauce: tomatoes, garlic\nFor the pasta: spaghetti', 'Forks, spoons, Formaggio, Fortified milk',
+    'Theme, the, There, Here, Herbs, Are, Areca nuts, Include, Includes, Ingredients, ingredient',
+    'Tomato sauce/pizza sauce, basil / oregano, /, //, salt/, /pepper', '1. Milk/cream\n- a) Butter/oil',
+    'Eggs, , ,, milk, ab, abc, ?!, ..., 42', 'Is this a soup or a stew?', 'Which kind of rice? Basmati, jasmine or arborio',
+    'Crème fraîche, jalapeño, café au lait, Ñoquis', 'Eggs\r\nMilk\r\n', '   Sure, Butter, Salt   '
+]
+
+# Prompts around the length, question-word and blocked-word rules
+DISH_NAME_EDGE_CASES = [
+    '', '   ', 'a', 'Pizza', 'PIZZA', '  pad thai  ', 'one two three four', 'one two three four five',
+    'how to make', 'what', 'what is', 'what is a good weather recipe', 'how to prepare a pot roast',
+    'how to prepare a  pot roast dish', 'which soup recipe', 'what are tacos', 'what is 42',
+    'how to cook 2 eggs', 'time for tea', 'date night dinner', 'how about lunch', 'I would like some ramen noodles tonight',
+    'a very long prompt that keeps going on and on about nothing in particular at all', 'crème brûlée', 'what is crème brûlée'
+]
+
+@pytest.mark.parametrize('text', benchmark.OLLAMA_ANSWERS + INGREDIENT_EDGE_CASES)
+def test_ingredients_match_the_previous_parser(backend, text):
+    assert backend.extract_ingredients_from_text(text) == benchmark.baseline_extract_ingredients_from_text(text)
+
+@pytest.mark.parametrize('prompt', benchmark.CHAT_PROMPTS + DISH_NAME_EDGE_CASES)
+def test_dish_names_match_the_previous_parser(backend, prompt):
+    assert backend.extract_dish_name_from_prompt(prompt) == benchmark.baseline_extract_dish_name_from_prompt(prompt)
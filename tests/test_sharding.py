@@ -0,0 +1,48 @@
+"""The sharded engine ranks like the in-process one, before and after the catalog changes under its long-lived workers."""
+import pytest
+
+from benchmark import INGREDIENTS
+
+QUERIES = [(ingredient.lower(), set(ingredient.lower().split())) for ingredient in INGREDIENTS + ['sea salt', 'butter', 'salt']]
+
+@pytest.fixture
+def shards(backend, monkeypatch):
+    monkeypatch.setattr(backend, 'MATCH_SHARDS', 3)
+    backend.stop_match_shards()
+    yield
+    backend.stop_match_shards()
+
+def test_sharded_ranking_equals_in_process(backend, shards):
+    assert backend.score_products_sharded(QUERIES) == backend.score_products(QUERIES)
+
+def test_workers_receive_deltas_without_restarting(backend, shards):
+    backend.score_products_sharded(QUERIES)
+    pools = list(backend.match_shard_pools)
+
+    backend.apply_catalog_delta([
+        ('upsert', {'SKU': '300000001', 'PRODUCT_NAME': 'Flaky Sea Salt', 'BRAND': 'Maldon'}),
+        ('upsert', {'SKU': '300000002', 'PRODUCT_NAME': 'Salted Butter', 'BRAND': 'Kerrygold'}),
+        ('delete', {'SKU': '200000004'}),
+    ])
+    assert backend.score_products_sharded(QUERIES) == backend.score_products(QUERIES)
+    assert backend.match_shard_pools == pools
+    assert backend.match_shard_version == backend.current_catalog.version
+
+def test_stale_workers_fall_back_to_in_process_scoring(backend, shards):
+    backend.score_products_sharded(QUERIES)
+    version = backend.current_catalog.version
+    assert [pool.submit(backend.score_match_shard, version + 1, QUERIES).result() for pool in backend.match_shard_pools] == [None] * 3
+
+def test_workers_receive_only_the_changes_of_a_delta(backend, shards, monkeypatch):
+    backend.score_products_sharded(QUERIES)
+
+    def split_catalog(catalog, shard_count):
+        raise AssertionError('the whole catalog was sent again')
+
+    monkeypatch.setattr(backend, 'split_catalog', split_catalog)
+    for delta in ([('upsert', {'SKU': '300000011', 'PRODUCT_NAME': 'Pink Himalayan Salt', 'BRAND': 'Morton'}),
+                   ('upsert', {'SKU': '300000012', 'PRODUCT_NAME': 'Cultured Butter', 'BRAND': 'Vermont Creamery'})],
+                  [('upsert', {'SKU': '300000011', 'PRODUCT_NAME': 'Coarse Sea Salt'}), ('delete', {'SKU': '200000005'})]):
+        backend.apply_catalog_delta(delta)
+        assert backend.match_shard_version == backend.current_catalog.version
+        assert backend.score_products_sharded(QUERIES) == backend.score_products(QUERIES)
@@ -0,0 +1,74 @@
+"""The banded edit-distance check agrees with the full Levenshtein matrix it replaced."""
+import random
+
+import pytest
+
+import benchmark
+
+EDGE_CASE_PAIRS = [
+    ('', ''), ('', 'a'), ('a', ''), ('', 'salt'), ('a', 'a'), ('a', 'b'), ('ab', 'ba'), ('abc', 'abcd'),
+    ('kitten', 'sitting'), ('flaw', 'lawn'), ('sea salt', 'sea-salt'), ('sea salt', 'salt sea'),
+    ('olive oil', 'olive oil spray'), ('butter', 'butter'), ('salt', 'saltsalt'),
+    ('jalapeño peppers', 'jalapeno peppers'), ('crème fraîche', 'creme fraiche'), ('straße', 'strasse'),
+    ('ñoquis de papa', 'noquis de papa'), ('café', 'café'), ('🍕 pizza', '🍔 pizza'), ('日本茶', '日本酒')
+]
+
+def random_name(generator):
+    return ''.join(generator.choice('abcde é') for _ in range(generator.randint(0, 12)))
+
+def random_pairs(count, seed=11):
+    generator = random.Random(seed)
+    pairs = []
+    for _ in range(count):
+        name = random_name(generator)
+        # Mostly small edits of one name, which is where the band and the early exit matter
+        edited = list(name)
+        for _ in range(generator.randint(0, 4)):
+            position = generator.randint(0, len(edited))
+            operation = generator.choice('ids')
+            if operation == 'i':
+                edited.insert(position, generator.choice('abcxé'))
+            elif edited and position < len(edited):
+                if operation == 'd':
+                    del edited[position]
+                else:
+                    edited[position] = generator.choice('abcxé')
+        pairs.append((name, ''.join(edited) if generator.random() < 0.8 else random_name(generator)))
+    return pairs
+
+PAIRS = EDGE_CASE_PAIRS + random_pairs(400)
+
+def baseline_are_names_similar(name1, brand1, name2, brand2, similarity_threshold=0.85):
+    """are_names_similar as it was with the full Levenshtein matrix."""
+    if name1 == name2:
+        return True
+    if brand1 and brand2 and brand1 == brand2:
+        words1, words2 = set(name1.split()), set(name2.split())
+        if words1 and words2 and len(words1 & words2) / len(words1 | words2) >= similarity_threshold:
+            return True
+    max_len = max(len(name1), len(name2))
+    if max_len > 0:
+        return 1 - (benchmark.baseline_levenshtein_distance(name1, name2) / max_len) >= similarity_threshold
+    return False
+
+@pytest.mark.parametrize('s1, s2', PAIRS)
+def test_edit_distance_within_matches_levenshtein(backend, s1, s2):
+    distance = benchmark.baseline_levenshtein_distance(s1, s2)
+    for max_distance in range(0, max(len(s1), len(s2)) + 2):
+        assert backend.is_edit_distance_within(s1, s2, max_distance) == (distance <= max_distance)
+
+@pytest.mark.parametrize('max_distance', [0, 1, 2, 3])
+def test_length_difference_at_the_threshold(backend, max_distance):
+    short = 'salt'
+    assert backend.is_edit_distance_within(short, short + 'x' * max_distance, max_distance)
+    assert backend.is_edit_distance_within(short + 'x' * max_distance, short, max_distance)
+    assert not backend.is_edit_distance_within(short, short + 'x' * (max_distance + 1), max_distance)
+    # Same length difference, but a substitution on top takes it over
+    assert not backend.is_edit_distance_within('salt', 'zalt' + 'x' * max_distance, max_distance)
+
+@pytest.mark.parametrize('threshold', [0.5, 0.85, 0.9, 1.0])
+def test_names_similar_matches_levenshtein(backend, threshold):
+    for name1, name2 in PAIRS:
+        for brand1, brand2 in (('', ''), ('morton', 'morton'), ('morton', 'great value')):
+            assert backend.are_names_similar(name1, brand1, name2, brand2, threshold) == \
+                baseline_are_names_similar(name1, brand1, name2, brand2, threshold), (name1, name2, brand1, brand2)